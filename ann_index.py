@@ -0,0 +1,124 @@
+# ann_index.py
+
+import numpy as np
+from scipy import sparse
+
+
+def _combine(query_summary, query_desc, n_summary_features, n_desc_features):
+    """
+    Объединяет векторы запроса по заголовку и описанию в одну строку общего пространства.
+    """
+    parts = []
+    for query, n_features in ((query_summary, n_summary_features), (query_desc, n_desc_features)):
+        parts.append(query if query is not None else sparse.csr_matrix((1, n_features)))
+    return sparse.hstack(parts, format='csr')
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class AnnIndex:
+    """
+    Приближенный поиск ближайших соседей по задачам индекса IssueIndex.
+
+    Строки TF-IDF заголовков и описаний объединяются и сжимаются до плотных векторов
+    небольшой размерности (TruncatedSVD), которые разбиваются на кластеры (k-means).
+    Запрос сравнивается с центрами кластеров, просматриваются только n_probe ближайших
+    кластеров, и из них отбирается n_candidates кандидатов. Точная схожесть затем
+    вычисляется только для кандидатов.
+
+    Чем больше n_probe и n_candidates, тем выше полнота и медленнее запрос;
+    при n_probe, равном числу кластеров, просматриваются все задачи.
+    """
+
+    def __init__(self, components, centroids, vectors, order, offsets, n_summary_features, n_desc_features,
+                 n_probe=8, n_candidates=200):
+        # Матрица проекции TruncatedSVD: сжатый вектор запроса - query @ components.T
+        self.components = components
+        self.centroids = centroids
+        self.vectors = vectors
+        self.order = order
+        self.offsets = offsets
+        self.n_summary_features = n_summary_features
+        self.n_desc_features = n_desc_features
+        self.n_probe = n_probe
+        self.n_candidates = n_candidates
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, index, n_components=64, n_lists=None, n_probe=8, n_candidates=200, random_state=0):
+        """
+        Строит приближенный индекс по готовому TF-IDF индексу.
+
+        :param index: Экземпляр IssueIndex.
+        :param n_components: Размерность сжатых векторов.
+        :param n_lists: Количество кластеров. По умолчанию корень из числа задач.
+        :param n_probe: Количество просматриваемых кластеров на запрос.
+        :param n_candidates: Количество кандидатов, для которых вычисляется точная схожесть.
+        :param random_state: Начальное значение генератора случайных чисел для воспроизводимости.
+        :return: Экземпляр AnnIndex.
+        """
+        from sklearn.cluster import MiniBatchKMeans
+        from sklearn.decomposition import TruncatedSVD
+
+        matrix = sparse.hstack([index.tfidf_summary, index.tfidf_desc], format='csr')
+        n_rows, n_features = matrix.shape
+        n_components = min(n_components, n_features - 1, n_rows - 1)
+        if n_components < 1:
+            raise ValueError("Слишком мало задач или терминов для построения приближенного индекса.")
+
+        svd = TruncatedSVD(n_components=n_components, random_state=random_state)
+        vectors = _normalize(svd.fit_transform(matrix)).astype(np.float32)
+
+        if n_lists is None:
+            n_lists = int(np.sqrt(n_rows))
+        n_lists = max(1, min(n_lists, n_rows))
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=random_state, n_init=3,
+                                 batch_size=min(4096, n_rows))
+        labels = kmeans.fit_predict(vectors)
+
+        # Списки задач по кластерам хранятся подряд: задачи кластера c - order[offsets[c]:offsets[c + 1]]
+        order = np.argsort(labels, kind='stable').astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=n_lists))]).astype(np.int64)
+
+        return cls(
+            components=svd.components_.astype(np.float32),
+            centroids=_normalize(kmeans.cluster_centers_).astype(np.float32),
+            vectors=vectors,
+            order=order,
+            offsets=offsets,
+            n_summary_features=index.tfidf_summary.shape[1],
+            n_desc_features=index.tfidf_desc.shape[1],
+            n_probe=n_probe,
+            n_candidates=n_candidates,
+        )
+
+    def candidates(self, query_summary, query_desc, n_candidates=None):
+        """
+        Отбирает задачи-кандидаты, ближайшие к запросу в сжатом пространстве.
+
+        :param query_summary: TF-IDF вектор запроса в пространстве заголовков (или None).
+        :param query_desc: TF-IDF вектор запроса в пространстве описаний (или None).
+        :param n_candidates: Количество кандидатов. По умолчанию self.n_candidates.
+        :return: Массив номеров задач-кандидатов.
+        """
+        if n_candidates is None:
+            n_candidates = self.n_candidates
+        query = _combine(query_summary, query_desc, self.n_summary_features, self.n_desc_features)
+        if query.nnz == 0:
+            return np.empty(0, dtype=np.int64)
+        reduced = _normalize(np.asarray(query @ self.components.T)).astype(np.float32)[0]
+
+        n_probe = min(self.n_probe, self.n_lists)
+        lists = np.argpartition(-(self.centroids @ reduced), n_probe - 1)[:n_probe]
+        rows = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in lists])
+        if len(rows) > n_candidates:
+            scores = self.vectors[rows] @ reduced
+            rows = rows[np.argpartition(-scores, n_candidates - 1)[:n_candidates]]
+        return np.sort(rows)
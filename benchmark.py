@@ -0,0 +1,286 @@
+# benchmark.py
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows: пиковое потребление памяти не измеряется
+    resource = None
+
+from issue_store import IssueStore
+from issue_index import IssueIndex, load_or_build_index, get_index_path, make_vectorizer
+from incremental_index import IncrementalIssueIndex
+from corpus import Corpus
+from similarity_checker import find_similar_issues, find_similar_issues_batch, iter_duplicate_pairs
+from text_processor import clean_texts
+
+# Очереди синтетических задач (как в фильтре yandex_tracker)
+_QUEUES = ['PLATFORM', 'PLATFORMCOMP', 'PLATFORMUI', 'PLATFORMBPMN', 'PLATFORMNSI']
+
+# Основы слов и окончания для генерации русских словоформ
+_RU_STEMS = ['авторизац', 'пользовател', 'кнопк', 'форм', 'профил', 'отчет', 'выгрузк', 'фильтр', 'сервис',
+             'очеред', 'задач', 'пол', 'таблиц', 'импорт', 'прав', 'рол', 'парол', 'окн', 'списк', 'поиск',
+             'документ', 'справочник', 'процесс', 'маршрут', 'согласовани', 'уведомлени', 'интеграци', 'стату',
+             'карточк', 'вложени', 'комментари', 'шаблон', 'печат', 'экспорт', 'настройк', 'журнал']
+_RU_ENDINGS = ['', 'а', 'и', 'е', 'у', 'ой', 'ами', 'ах', 'ом', 'ия', 'ии', 'ей']
+_RU_WORDS = ['ошибка', 'не', 'работает', 'падает', 'при', 'после', 'открытии', 'сохранении', 'нажатии',
+             'отображается', 'некорректно', 'долго', 'загружается', 'пустой', 'нет', 'доступа', 'в', 'на', 'с']
+_EN_WORDS = ['error', 'null', 'pointer', 'exception', 'timeout', 'api', 'request', 'response', 'bpmn', 'ui',
+             'login', 'export', 'csv', 'xlsx', 'json', 'service', 'deploy', 'build', 'cache', 'index']
+
+
+_CONSONANTS = 'бвгдзклмнпрстфхчш'
+_VOWELS = 'аеиоуя'
+
+
+def _make_vocabulary(n_stems=5000):
+    """
+    Составляет словарь словоформ: реальные основы и сгенерированные из слогов псевдоосновы
+    с русскими окончаниями, а также английские технические термины.
+
+    Словарь не зависит от seed корпуса, чтобы корпус и запросы состояли из одних и тех же слов.
+    """
+    rng = np.random.default_rng(12345)
+    stems = list(_RU_STEMS)
+    while len(stems) < n_stems:
+        syllables = rng.integers(2, 4)
+        stems.append(''.join(rng.choice(list(_CONSONANTS)) + rng.choice(list(_VOWELS)) for _ in range(syllables)))
+    forms = [stem + ending for stem in dict.fromkeys(stems) for ending in rng.choice(_RU_ENDINGS, size=4)]
+    vocabulary = np.array(_RU_WORDS + _EN_WORDS + forms, dtype=object)
+    return vocabulary[rng.permutation(len(vocabulary))]
+
+
+def generate_issues(n_issues, seed=0, duplicate_rate=0.05):
+    """
+    Генерирует синтетический корпус задач, похожий на задачи Yandex Tracker.
+
+    Заголовки и описания состоят из русских словоформ и английских технических терминов,
+    в описаниях встречаются ссылки и HTML-теги. Часть задач - перефразированные дубликаты других.
+
+    :param n_issues: Количество задач.
+    :param seed: Начальное значение генератора для воспроизводимости.
+    :param duplicate_rate: Доля задач-дубликатов.
+    :return: DataFrame с колонками 'key', 'summary', 'description', 'updated'.
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = _make_vocabulary()
+    # Частоты слов по закону Ципфа, как в реальных текстах
+    weights = 1 / np.arange(1, len(vocabulary) + 1)
+    weights = weights / weights.sum()
+
+    def text(n_words):
+        return ' '.join(rng.choice(vocabulary, size=n_words, p=weights))
+
+    queues = rng.choice(_QUEUES, size=n_issues)
+    keys, summaries, descriptions = [], [], []
+    for i in range(n_issues):
+        if i > 10 and rng.random() < duplicate_rate:
+            # Почти дубликат: слова заголовка переставлены и одно заменено, к описанию добавлена фраза
+            source = int(rng.integers(0, i))
+            words = summaries[source].split()
+            rng.shuffle(words)
+            summary = ' '.join(words[:-1] + [text(1)])
+            description = descriptions[source] + ' ' + text(3)
+        else:
+            summary = text(int(rng.integers(3, 10)))
+            description = text(int(rng.integers(0, 80)))
+        if rng.random() < 0.2:
+            description += f' https://wiki.example.ru/page/{i} <b>{text(3)}</b>'
+        keys.append(f'{queues[i]}-{i + 1}')
+        summaries.append(summary.capitalize())
+        descriptions.append(description)
+
+    start = np.datetime64('2020-01-01T00:00:00')
+    updated = start + rng.integers(0, 5 * 365 * 24 * 3600, size=n_issues).astype('timedelta64[s]')
+    return pd.DataFrame({
+        'key': keys,
+        'summary': summaries,
+        'description': descriptions,
+        'updated': [f'{value}.000+0000' for value in updated.astype(str)],
+    })
+
+
+def _percentiles(samples_ms):
+    samples = np.asarray(samples_ms)
+    return {f'p{q}': float(np.percentile(samples, q)) for q in (50, 90, 95, 99)} | {'mean': float(samples.mean())}
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    # На Linux ru_maxrss в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_benchmark(n_issues, n_queries=200, batch_size=1000, dedup_max_issues=20000, seed=0):
+    """
+    Измеряет производительность конвейера поиска на синтетическом корпусе заданного размера.
+
+    :param n_issues: Размер корпуса.
+    :param n_queries: Количество запросов для измерения задержки и пропускной способности.
+    :param batch_size: Размер пакета при пакетном поиске.
+    :param dedup_max_issues: Наибольший размер корпуса, для которого измеряется поиск дубликатов по всему бэклогу.
+    :param seed: Начальное значение генератора корпуса.
+    :return: Словарь с результатами измерений.
+    """
+    result = {'n_issues': n_issues, 'n_queries': n_queries}
+    issues_df = generate_issues(n_issues, seed=seed)
+    queries = generate_issues(n_queries, seed=seed + 1)
+    query_pairs = list(zip(queries['summary'], queries['description']))
+
+    start = time.perf_counter()
+    clean_texts(issues_df['description'])
+    result['clean_text_seconds'] = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_file = os.path.join(tmp_dir, 'issues.db')
+        store = IssueStore(cache_file)
+        start = time.perf_counter()
+        store.replace_all(issues_df)
+        result['store_write_seconds'] = time.perf_counter() - start
+
+        frame = store.read_issues()
+        corpus = store.read_corpus()
+        result['frame_mb'] = float(frame.memory_usage(deep=True).sum()) / 2 ** 20
+        result['corpus_mb'] = corpus.nbytes / 2 ** 20
+        del frame
+
+        start = time.perf_counter()
+        index = IssueIndex.build(corpus, source=None)
+        result['index_build_seconds'] = time.perf_counter() - start
+        result['vocabulary_summary'] = index.tfidf_summary.shape[1]
+        result['vocabulary_description'] = index.tfidf_desc.shape[1]
+
+        # Холодная загрузка сохраненного индекса вместе с корпусом, как при перезапуске бота
+        load_or_build_index(store.read_corpus, cache_file=cache_file)
+        start = time.perf_counter()
+        load_or_build_index(store.read_corpus, cache_file=cache_file)
+        result['cache_load_seconds'] = time.perf_counter() - start
+        result['index_file_mb'] = os.path.getsize(get_index_path(cache_file)) / 2 ** 20
+
+    latencies = []
+    for title, description in query_pairs:
+        start = time.perf_counter()
+        find_similar_issues(title, description, corpus, index=index)
+        latencies.append((time.perf_counter() - start) * 1000)
+    result['query_latency_ms'] = _percentiles(latencies)
+
+    start = time.perf_counter()
+    for _ in find_similar_issues_batch(query_pairs, index, batch_size=batch_size):
+        pass
+    result['batch_queries_per_second'] = n_queries / (time.perf_counter() - start)
+
+    # Обновление индекса по одной измененной задаче и первый запрос к новой версии (с пересчетом IDF)
+    incremental = IncrementalIssueIndex.from_index(index)
+    latencies = []
+    for title, description in query_pairs[:10]:
+        changed = Corpus.from_frame(queries.head(1).assign(key=issues_df['key'][0]))
+        start = time.perf_counter()
+        incremental = incremental.apply_changes(changed)
+        find_similar_issues(title, description, corpus, index=incremental)
+        latencies.append((time.perf_counter() - start) * 1000)
+    result['update_latency_ms'] = _percentiles(latencies)
+
+    if n_issues <= dedup_max_issues:
+        full_text = clean_texts(issues_df['summary'] + ' ' + issues_df['description'])
+        matrix = make_vectorizer().fit_transform(full_text)
+        start = time.perf_counter()
+        result['dedup_pairs'] = sum(1 for _ in iter_duplicate_pairs(matrix, issues_df['key'].tolist(), threshold=0.8))
+        result['dedup_seconds'] = time.perf_counter() - start
+
+    result['peak_rss_mb'] = _peak_rss_mb()
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(sizes, n_queries=200, batch_size=1000, dedup_max_issues=20000, seed=0):
+    """
+    Запускает измерения для нескольких размеров корпуса, каждый в отдельном процессе,
+    чтобы пиковое потребление памяти измерялось независимо.
+
+    :return: Словарь с описанием окружения и списком результатов по размерам.
+    """
+    results = []
+    for n_issues in sizes:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(run_benchmark, n_issues, n_queries, batch_size, dedup_max_issues, seed).result()
+        print(f"{n_issues} задач: индекс {result['index_build_seconds']:.2f} с, "
+              f"запрос p50 {result['query_latency_ms']['p50']:.2f} мс / p99 {result['query_latency_ms']['p99']:.2f} мс, "
+              f"пакет {result['batch_queries_per_second']:.0f} запросов/с", file=sys.stderr)
+        results.append(result)
+    return {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': seed,
+        'results': results,
+    }
+
+
+def compare(current, baseline):
+    """
+    Сравнивает результаты с базовыми и возвращает строки с отношением значений (текущее / базовое).
+    """
+    baseline_by_size = {result['n_issues']: result for result in baseline['results']}
+    metrics = [('index_build_seconds', None), ('cache_load_seconds', None), ('query_latency_ms', 'p50'),
+               ('query_latency_ms', 'p99'), ('update_latency_ms', 'p50'), ('batch_queries_per_second', None),
+               ('corpus_mb', None), ('peak_rss_mb', None)]
+    lines = []
+    for result in current['results']:
+        base = baseline_by_size.get(result['n_issues'])
+        if base is None:
+            continue
+        for name, field in metrics:
+            value, base_value = result.get(name), base.get(name)
+            if field is not None:
+                value = value and value.get(field)
+                base_value = base_value and base_value.get(field)
+            if value is None or not base_value:
+                continue
+            label = f"{name}.{field}" if field else name
+            lines.append(f"{result['n_issues']:>7} {label:<26} {base_value:12.3f} -> {value:12.3f} ({value / base_value:.2f}x)")
+    return lines
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Замеры производительности поиска дубликатов на синтетических корпусах.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="Размеры корпусов (от 1 000 до 500 000 задач).")
+    parser.add_argument('--queries', type=int, default=200, help="Количество запросов на размер корпуса.")
+    parser.add_argument('--batch-size', type=int, default=1000, help="Размер пакета при пакетном поиске.")
+    parser.add_argument('--dedup-max-issues', type=int, default=20000,
+                        help="Наибольший корпус, для которого измеряется поиск дубликатов по всему бэклогу.")
+    parser.add_argument('--seed', type=int, default=0, help="Начальное значение генератора корпуса.")
+    parser.add_argument('--output', '-o', default='benchmark.json', help="Файл для записи результатов (JSON).")
+    parser.add_argument('--compare', help="Файл с результатами предыдущего запуска для сравнения.")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = run_suite(args.sizes, args.queries, args.batch_size, args.dedup_max_issues, args.seed)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в '{args.output}'.", file=sys.stderr)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print('\n'.join(compare(report, json.load(f))))
@@ -0,0 +1,191 @@
+# corpus.py
+
+import zlib
+import numpy as np
+from snapshot_file import StringArray
+
+
+class CompressedStrings:
+    """
+    Неизменяемый массив строк, сжатых блоками по block_size строк (zlib).
+
+    Длинные описания задач нужны только при построении индекса и для вывода отдельных задач,
+    поэтому хранятся сжатыми: строка распаковывается вместе со своим блоком при обращении.
+    """
+
+    BLOCK_SIZE = 64
+
+    def __init__(self, blocks, block_offsets, lengths, block_size=BLOCK_SIZE):
+        self.blocks = blocks
+        self.block_offsets = block_offsets
+        self.lengths = lengths
+        self.block_size = block_size
+
+    @classmethod
+    def from_strings(cls, strings, block_size=BLOCK_SIZE):
+        builder = _CompressedStringsBuilder(block_size)
+        for value in strings:
+            builder.append(value)
+        return builder.build()
+
+    @property
+    def nbytes(self):
+        return self.blocks.nbytes + self.block_offsets.nbytes + self.lengths.nbytes
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def _block(self, block):
+        start, end = self.block_offsets[block], self.block_offsets[block + 1]
+        return zlib.decompress(self.blocks[start:end].tobytes())
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        block, first = divmod(position, self.block_size)
+        block_start = position - first
+        start = int(self.lengths[block_start:position].sum())
+        return self._block(block)[start:start + self.lengths[position]].decode('utf-8')
+
+    def __iter__(self):
+        for block in range(len(self.block_offsets) - 1):
+            data = self._block(block)
+            start = 0
+            for length in self.lengths[block * self.block_size:(block + 1) * self.block_size]:
+                yield data[start:start + length].decode('utf-8')
+                start += length
+
+
+class _CompressedStringsBuilder:
+    """
+    Пополняемый по одной строке CompressedStrings: в памяти несжатым хранится только текущий блок.
+    """
+
+    def __init__(self, block_size=CompressedStrings.BLOCK_SIZE):
+        self.block_size = block_size
+        self.blocks = []
+        self.block_offsets = [0]
+        self.lengths = []
+        self.pending = []
+
+    def _flush(self):
+        self.blocks.append(zlib.compress(b''.join(self.pending)))
+        self.block_offsets.append(self.block_offsets[-1] + len(self.blocks[-1]))
+        self.pending.clear()
+
+    def append(self, value):
+        encoded = _as_text(value).encode('utf-8')
+        self.lengths.append(len(encoded))
+        self.pending.append(encoded)
+        if len(self.pending) == self.block_size:
+            self._flush()
+
+    def build(self):
+        if self.pending:
+            self._flush()
+        return CompressedStrings(np.frombuffer(b''.join(self.blocks), dtype=np.uint8),
+                                 np.asarray(self.block_offsets, dtype=np.int64),
+                                 np.asarray(self.lengths, dtype=np.int32), self.block_size)
+
+
+def _as_text(value):
+    # Пропущенные значения (None или NaN из DataFrame) считаются пустой строкой
+    return value if isinstance(value, str) else ''
+
+
+class Corpus:
+    """
+    Компактный неизменяемый корпус задач.
+
+    Ключи и заголовки хранятся в StringArray (байты UTF-8 подряд), очередь задачи - номером
+    в списке queue_names, время изменения - массивом datetime64, а описания - сжатыми блоками.
+    Все данные лежат в числовых массивах, поэтому корпус сохраняется в файле снимка вместе
+    с индексом и отображается в память разными процессами без копирования.
+    """
+
+    def __init__(self, keys, summaries, descriptions, queue_codes, queue_names, updated):
+        self.keys = keys
+        self.summaries = summaries
+        self.descriptions = descriptions
+        self.queue_codes = queue_codes
+        self.queue_names = queue_names
+        self.updated = updated
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Составляет корпус из записей задач (key, summary, description, updated), например,
+        из курсора SQLite. Записи обрабатываются по одной, без промежуточного DataFrame.
+        """
+        keys, summaries, updated = [], [], []
+        descriptions = _CompressedStringsBuilder()
+        queue_names, queue_codes = {}, []
+        for key, summary, description, updated_at in records:
+            keys.append(key)
+            summaries.append(_as_text(summary))
+            descriptions.append(description)
+            updated.append(updated_at)
+            # Очередь задачи - префикс ключа; названия очередей хранятся один раз
+            queue_codes.append(queue_names.setdefault(key.split('-', 1)[0], len(queue_names)))
+        return cls(
+            keys=StringArray.from_strings(keys),
+            summaries=StringArray.from_strings(summaries),
+            descriptions=descriptions.build(),
+            queue_codes=np.asarray(queue_codes, dtype=np.int32),
+            queue_names=list(queue_names),
+            updated=_parse_updated(updated),
+        )
+
+    @classmethod
+    def from_frame(cls, issues_df):
+        """
+        Составляет корпус из DataFrame с колонками 'key', 'summary', 'description' и необязательной 'updated'.
+        """
+        columns = [issues_df[column].tolist() if column in issues_df.columns else [None] * len(issues_df)
+                   for column in ('key', 'summary', 'description', 'updated')]
+        return cls.from_records(zip(*columns))
+
+    @property
+    def empty(self):
+        return len(self) == 0
+
+    @property
+    def nbytes(self):
+        """
+        Объем данных корпуса в байтах.
+        """
+        return (self.keys.data.nbytes + self.keys.offsets.nbytes + self.summaries.data.nbytes
+                + self.summaries.offsets.nbytes + self.descriptions.nbytes + self.queue_codes.nbytes
+                + self.updated.nbytes)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def description(self, position):
+        """
+        Возвращает описание задачи по ее номеру в корпусе.
+        """
+        return self.descriptions[position]
+
+
+def _parse_updated(values):
+    """
+    Переводит время изменения задач из формата API (например, '2024-01-01T10:00:00.000+0000')
+    в массив datetime64[ns] по UTC. Пропущенные и нераспознанные значения становятся NaT.
+    """
+    if all(value is None for value in values):
+        return np.full(len(values), np.datetime64('NaT'), dtype='datetime64[ns]')
+    import pandas as pd
+    updated = pd.to_datetime(pd.Series(values, dtype=object), utc=True, errors='coerce', format='ISO8601')
+    return updated.to_numpy(dtype='datetime64[ns]')
+
+
+def as_corpus(issues):
+    """
+    Возвращает корпус задач: сам Corpus или корпус, составленный из DataFrame.
+    """
+    if isinstance(issues, Corpus):
+        return issues
+    return Corpus.from_frame(issues)
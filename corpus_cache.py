@@ -0,0 +1,406 @@
+# corpus_cache.py
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from issue_store import IssueStore
+from issue_index import IssueIndex, load_or_build_index, make_source_fingerprint
+from incremental_index import IncrementalIssueIndex
+from embedding_index import EMBEDDING_MIN_SIMILARITY, EmbeddingIndex, SentenceEncoder, get_embedding_cache_path
+from metrics import metrics
+
+
+class CorpusSnapshot:
+    """
+    Неизменяемый снимок корпуса задач: корпус Corpus, построенный по нему индекс,
+    векторы задач для поиска по смыслу (если задана модель) и метаданные хранилища,
+    из которого он загружен.
+    """
+
+    def __init__(self, issues, index, source, refreshed_at, embeddings=None):
+        self.issues = issues
+        self.index = index
+        self.embeddings = embeddings
+        self.source = source
+        self.refreshed_at = refreshed_at
+
+    @property
+    def count(self):
+        return len(self.issues)
+
+    @property
+    def version(self):
+        return self.source[1] if self.source else 0
+
+    def get_update_time(self):
+        """
+        Возвращает время обновления хранилища, из которого загружен снимок.
+        """
+        if self.refreshed_at is None:
+            return "Кэш еще не создан."
+        return self.refreshed_at.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class CorpusHolder:
+    """
+    Общий для всего процесса потокобезопасный кэш корпуса задач и индекса.
+
+    Снимок перезагружается из хранилища, только если изменилась версия хранилища.
+    Новый снимок строится в фоновом потоке и подменяет старый целиком, поэтому запросы
+    не ждут перестроения индекса, а запросы, которые уже получили старый снимок,
+    спокойно дорабатывают с ним.
+
+    Если журнал изменений хранилища покрывает изменения с версии текущего снимка, индекс
+    не перестраивается, а обновляется по измененным задачам (IncrementalIssueIndex).
+    Когда изменений накапливается много или они давно не сворачивались, индекс
+    перестраивается целиком в фоновом потоке (сжатие) и подменяет инкрементальный.
+
+    Если задана модель векторных представлений, вместе с индексом обновляются векторы задач
+    (EmbeddingIndex): заново кодируются только новые и измененные тексты.
+    """
+
+    def __init__(self, cache_file='issues.db', cache_hours=1, ann_min_issues=None, incremental=True,
+                 compact_min_changes=1000, compact_ratio=0.1, compact_seconds=3600, embedding_encoder=None,
+                 embedding_min_similarity=EMBEDDING_MIN_SIMILARITY):
+        """
+        :param incremental: Обновлять индекс по журналу изменений хранилища вместо перестроения.
+        :param compact_min_changes: Наименьшее количество изменений, при котором индекс сжимается.
+        :param compact_ratio: Доля задач базового индекса: индекс сжимается, когда изменений больше этой доли.
+        :param compact_seconds: Время в секундах с первого несжатого изменения, после которого индекс
+                                сжимается при любом количестве изменений.
+        :param embedding_encoder: Модель векторных представлений (например, SentenceEncoder) для поиска по смыслу.
+                                  Если не задана, векторы задач не вычисляются.
+        :param embedding_min_similarity: Наименьшая учитываемая схожесть по смыслу.
+        """
+        self.cache_file = cache_file
+        self.cache_hours = cache_hours
+        self.ann_min_issues = ann_min_issues
+        self.incremental = incremental
+        self.compact_min_changes = compact_min_changes
+        self.compact_ratio = compact_ratio
+        self.compact_seconds = compact_seconds
+        self.embedding_encoder = embedding_encoder
+        self.embedding_min_similarity = embedding_min_similarity
+        self.refresher = None
+        self._snapshot = None
+        self._compacting = False
+        self._reloading = None
+        # _lock защищает подмену снимка и флаги фоновых задач и удерживается недолго,
+        # а _build_lock не дает двум перезагрузкам строить индекс одновременно
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    def is_stale(self):
+        """
+        Проверяет, истекло ли время жизни данных в хранилище.
+        """
+        return self._is_stale(IssueStore(self.cache_file).get_all_meta())
+
+    def _is_stale(self, meta):
+        refreshed_at = meta.get('refreshed_at')
+        if not refreshed_at:
+            return True
+        return datetime.now() - datetime.fromisoformat(refreshed_at) >= timedelta(hours=self.cache_hours)
+
+    def get(self):
+        """
+        Возвращает актуальный снимок корпуса.
+
+        Если хранилище устарело и задан фоновый обновитель, обновление запускается в фоне,
+        а запрос обслуживается последним загруженным снимком. Без обновителя хранилище
+        обновляется из Yandex Tracker синхронно. Если версия хранилища изменилась
+        с момента загрузки снимка, новый снимок строится в фоне, а запрос обслуживается
+        текущим. Синхронно снимок загружается, только если его еще нет совсем.
+
+        :return: Экземпляр CorpusSnapshot.
+        """
+        store = IssueStore(self.cache_file)
+        meta = store.get_all_meta()
+        if self._is_stale(meta):
+            if self.refresher is not None:
+                future, _ = self.refresher.request_refresh()
+                # Ждать обновления приходится, только если данных еще нет совсем
+                if not meta.get('refreshed_at'):
+                    future.result()
+                    meta = store.get_all_meta()
+            else:
+                with self._lock:
+                    meta = store.get_all_meta()
+                    if self._is_stale(meta):
+                        # Клиент Yandex Tracker нужен только для обновления, поэтому модуль импортируется здесь
+                        from yandex_tracker import refresh_store
+                        refresh_store(store)
+                        meta = store.get_all_meta()
+
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self.reload()
+        if snapshot.source != make_source_fingerprint(self.cache_file, meta):
+            self.request_reload()
+        return snapshot
+
+    def request_reload(self):
+        """
+        Запускает перезагрузку снимка в фоне или присоединяется к уже выполняющейся.
+
+        :return: Future с новым снимком корпуса.
+        """
+        with self._lock:
+            if self._reloading is not None and not self._reloading.done():
+                return self._reloading
+            future = self._reloading = Future()
+        threading.Thread(target=self._run_reload, args=(future,), name='corpus-reload', daemon=True).start()
+        return future
+
+    def _run_reload(self, future):
+        try:
+            snapshot = self.reload()
+        except Exception as e:
+            logging.exception("Ошибка перезагрузки снимка корпуса")
+            future.set_exception(e)
+        else:
+            future.set_result(snapshot)
+
+    def reload(self):
+        """
+        Загружает снимок из хранилища и делает его текущим.
+
+        Индекс обновляется или строится без блокировки снимка, поэтому запросы, пришедшие
+        за это время, обслуживаются текущим снимком; под блокировкой снимок только подменяется.
+
+        :return: Экземпляр CorpusSnapshot.
+        """
+        with self._build_lock:
+            store = IssueStore(self.cache_file)
+            meta = store.get_all_meta()
+            source = make_source_fingerprint(self.cache_file, meta)
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.source == source:
+                return snapshot
+
+            index = None
+            if snapshot is not None:
+                index = self._apply_changes(store, snapshot.index, snapshot.version, source)
+            if index is None:
+                # Корпус сохранен вместе с индексом, поэтому из базы он читается, только если индекс нужно построить
+                index = load_or_build_index(metrics.timed('corpus.read_issues')(store.read_corpus),
+                                            cache_file=self.cache_file, source=source,
+                                            ann_min_issues=self.ann_min_issues)
+            new_snapshot = self._make_snapshot(index, source, snapshot.embeddings if snapshot is not None else None)
+            with self._lock:
+                # Сжатие могло за это время подменить снимок более новой версией
+                current = self._snapshot
+                if current is None or current.version <= new_snapshot.version:
+                    self._snapshot = new_snapshot
+                snapshot = self._snapshot
+        self.maybe_compact()
+        return snapshot
+
+    def _make_snapshot(self, index, source, embeddings=None):
+        """
+        :param embeddings: Векторы задач предыдущей версии индекса: повторно используются для неизменных задач.
+        """
+        refreshed_at = source[2]
+        return CorpusSnapshot(
+            issues=index.corpus,
+            index=index,
+            source=source,
+            refreshed_at=datetime.fromisoformat(refreshed_at) if refreshed_at else None,
+            embeddings=self._update_embeddings(index, embeddings),
+        )
+
+    def _update_embeddings(self, index, previous):
+        """
+        Составляет векторы задач индекса, если задана модель векторных представлений.
+        """
+        if self.embedding_encoder is None:
+            return None
+        with metrics.span('embedding.update'):
+            return EmbeddingIndex.for_index(index, self.embedding_encoder,
+                                            cache_path=get_embedding_cache_path(self.cache_file),
+                                            previous=previous, min_similarity=self.embedding_min_similarity)
+
+    def _apply_changes(self, store, index, since_version, source):
+        """
+        Обновляет индекс по задачам, измененным после версии since_version.
+
+        :return: Новая версия индекса или None, если его нужно перестроить.
+        """
+        if not self.incremental or not isinstance(index, IssueIndex):
+            return None
+        changes = store.read_changes(since_version)
+        if changes is None:
+            return None
+        changed, removed_keys = changes
+        with metrics.span('index.apply_changes'):
+            return IncrementalIssueIndex.from_index(index).apply_changes(changed, removed_keys, source=source)
+
+    def needs_compaction(self):
+        """
+        Проверяет, пора ли свернуть накопленные изменения индекса перестроением.
+        """
+        snapshot = self._snapshot
+        index = snapshot.index if snapshot is not None else None
+        if not isinstance(index, IncrementalIssueIndex) or index.pending_changes == 0:
+            return False
+        return (index.pending_changes >= max(self.compact_min_changes, self.compact_ratio * index.n_base)
+                or time.time() - index.changed_at >= self.compact_seconds)
+
+    def maybe_compact(self):
+        """
+        Запускает сжатие индекса в фоновом потоке, если оно нужно и еще не выполняется.
+
+        :return: True, если сжатие запущено.
+        """
+        if not self.needs_compaction():
+            return False
+        with self._lock:
+            if self._compacting:
+                return False
+            self._compacting = True
+        threading.Thread(target=self._run_compaction, name='index-compaction', daemon=True).start()
+        return True
+
+    def _run_compaction(self):
+        try:
+            self.compact()
+        except Exception:
+            logging.exception("Ошибка сжатия индекса")
+        finally:
+            self._compacting = False
+
+    def compact(self):
+        """
+        Перестраивает индекс целиком по хранилищу и подменяет им текущий снимок.
+
+        Индекс строится без блокировок, поэтому запросы и обновления продолжают обслуживаться.
+        Если за это время хранилище изменилось, новый индекс догоняется по журналу изменений.
+
+        :return: Экземпляр CorpusSnapshot.
+        """
+        store = IssueStore(self.cache_file)
+        source = make_source_fingerprint(self.cache_file, store.get_all_meta())
+        with metrics.span('index.compact'):
+            index = load_or_build_index(store.read_corpus, cache_file=self.cache_file, source=source,
+                                        ann_min_issues=self.ann_min_issues)
+        # Векторы нового базового корпуса тоже составляются без блокировок
+        snapshot = self._snapshot
+        embeddings = self._update_embeddings(index, snapshot.embeddings if snapshot is not None else None)
+        with self._build_lock:
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.version > source[1]:
+                index = self._apply_changes(store, index, source[1], snapshot.source)
+                if index is None:
+                    return snapshot
+                source = snapshot.source
+            new_snapshot = self._make_snapshot(index, source, embeddings)
+            with self._lock:
+                self._snapshot = new_snapshot
+            return new_snapshot
+
+
+class RefreshScheduler:
+    """
+    Фоновое обновление хранилища задач из Yandex Tracker и перестроение индекса.
+
+    Обновление выполняется вне обработчиков запросов: пока оно идет, поиск обслуживается
+    последним загруженным снимком. Одновременные запросы на обновление объединяются
+    в одно выполняющееся обновление.
+    """
+
+    def __init__(self, holder: CorpusHolder, check_seconds=60):
+        self.holder = holder
+        self.check_seconds = check_seconds
+        self.started_at = None
+        self.last_success = None
+        self.last_error = None
+        self._current = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def is_running(self):
+        current = self._current
+        return current is not None and not current.done()
+
+    def request_refresh(self, full=False):
+        """
+        Запускает обновление в фоне или присоединяется к уже выполняющемуся.
+
+        :param full: Загрузить все задачи заново вместо загрузки изменений.
+        :return: Кортеж (Future с новым снимком корпуса, признак того, что запущено новое обновление).
+        """
+        with self._lock:
+            if self.is_running():
+                return self._current, False
+            future = Future()
+            self._current = future
+            self.started_at = datetime.now()
+        threading.Thread(target=self._run, args=(future, full), name='corpus-refresh', daemon=True).start()
+        return future, True
+
+    def _run(self, future, full):
+        try:
+            from yandex_tracker import refresh_store
+            refresh_store(IssueStore(self.holder.cache_file), full=full)
+            snapshot = self.holder.reload()
+        except Exception as e:
+            logging.exception("Ошибка фонового обновления базы задач")
+            self.last_error = (datetime.now(), e)
+            future.set_exception(e)
+        else:
+            logging.info(f"База задач обновлена: {snapshot.count} записей.")
+            self.last_success = datetime.now()
+            future.set_result(snapshot)
+
+    def _loop(self):
+        while True:
+            try:
+                if self.holder.is_stale():
+                    self.request_refresh()
+                self.holder.maybe_compact()
+            except Exception:
+                logging.exception("Ошибка проверки актуальности базы задач")
+            if self._stop.wait(self.check_seconds):
+                break
+
+    def start(self):
+        """
+        Запускает периодическую проверку актуальности хранилища в фоновом потоке
+        и подключает обновитель к кэшу корпуса.
+        """
+        self.holder.refresher = self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='corpus-refresh-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.holder.refresher = None
+
+    def get_status(self):
+        """
+        Возвращает текстовое описание состояния обновления.
+        """
+        if self.is_running():
+            return f"идет обновление с {self.started_at.strftime('%H:%M:%S')}"
+        if self.last_error is not None and (self.last_success is None or self.last_error[0] > self.last_success):
+            return f"последнее обновление завершилось ошибкой: {self.last_error[1]}"
+        return "обновление не выполняется"
+
+
+# Общий кэш корпуса для всех обработчиков процесса. Если задана переменная ANN_MIN_ISSUES,
+# для корпусов не меньше этого размера поиск идет через приближенный индекс.
+# INDEX_INCREMENTAL=0 выключает обновление индекса по изменениям: он перестраивается при каждом обновлении.
+# EMBEDDING_MODEL - каталог локальной модели sentence-transformers для поиска по смыслу.
+_embedding_model = os.getenv('EMBEDDING_MODEL')
+corpus = CorpusHolder(ann_min_issues=int(os.getenv('ANN_MIN_ISSUES', 0)) or None,
+                      incremental=os.getenv('INDEX_INCREMENTAL', '1') != '0',
+                      embedding_encoder=SentenceEncoder(_embedding_model) if _embedding_model else None,
+                      embedding_min_similarity=float(os.getenv('EMBEDDING_MIN_SIMILARITY', EMBEDDING_MIN_SIMILARITY)))
+refresher = RefreshScheduler(corpus)
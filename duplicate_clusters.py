@@ -0,0 +1,234 @@
+# duplicate_clusters.py
+
+import heapq
+import json
+import os
+import sys
+from issue_index import make_vectorizer
+from metrics import metrics
+from similarity_checker import iter_duplicate_blocks
+from text_processor import clean_texts
+
+# Версия формата файла состояния прерванного поиска кластеров
+STATE_VERSION = 1
+
+
+class _Cluster:
+    __slots__ = ('members', 'pairs', 'max_similarity', 'last')
+
+    def __init__(self, members, pairs=0, max_similarity=0.0):
+        self.members = members
+        self.pairs = pairs
+        self.max_similarity = max_similarity
+        # Наибольший номер задачи в кластере: после его блока кластер больше не изменится
+        self.last = max(members)
+
+
+class DuplicateClusters:
+    """
+    Кластеры дубликатов, пополняемые по одной паре: система непересекающихся множеств (union-find)
+    со сжатием путей и объединением меньшего кластера с большим.
+
+    Хранятся только задачи, попавшие хотя бы в одну пару, поэтому память и время
+    пропорциональны количеству найденных пар, а не количеству задач.
+    Кластер, все задачи которого уже обработаны, извлекается методом pop_completed.
+    """
+
+    def __init__(self):
+        self._parent = {}
+        self._clusters = {}
+        # Корни кластеров по наибольшему номеру задачи; устаревшие записи пропускаются при извлечении
+        self._heap = []
+
+    def __len__(self):
+        return len(self._clusters)
+
+    def _find(self, position):
+        parent = self._parent
+        while parent[position] != position:
+            # Сжатие пути делением пополам
+            parent[position] = parent[parent[position]]
+            position = parent[position]
+        return position
+
+    def _root(self, position):
+        if position not in self._parent:
+            self._parent[position] = position
+            self._clusters[position] = _Cluster([position])
+            return position
+        return self._find(position)
+
+    def add_pair(self, i, j, similarity):
+        """
+        Добавляет пару задач с номерами i и j и объединяет их кластеры.
+        """
+        root_i, root_j = self._root(i), self._root(j)
+        if root_i != root_j:
+            if len(self._clusters[root_i].members) < len(self._clusters[root_j].members):
+                root_i, root_j = root_j, root_i
+            merged = self._clusters.pop(root_j)
+            self._parent[root_j] = root_i
+            cluster = self._clusters[root_i]
+            cluster.members.extend(merged.members)
+            cluster.pairs += merged.pairs
+            cluster.max_similarity = max(cluster.max_similarity, merged.max_similarity)
+            cluster.last = max(cluster.last, merged.last)
+        cluster = self._clusters[root_i]
+        cluster.pairs += 1
+        cluster.max_similarity = max(cluster.max_similarity, similarity)
+        heapq.heappush(self._heap, (cluster.last, root_i))
+
+    def pop_completed(self, bound=None):
+        """
+        Извлекает кластеры, все задачи которых имеют номера меньше bound (по умолчанию все кластеры).
+
+        Задачи извлеченного кластера забываются: пар с ними больше быть не должно.
+
+        :return: Список кластеров с атрибутами members (номера задач по возрастанию), pairs и max_similarity.
+        """
+        completed = []
+        while self._heap and (bound is None or self._heap[0][0] < bound):
+            last, root = heapq.heappop(self._heap)
+            cluster = self._clusters.get(root)
+            if cluster is None or cluster.last != last:
+                continue
+            del self._clusters[root]
+            for position in cluster.members:
+                del self._parent[position]
+            cluster.members.sort()
+            completed.append(cluster)
+        completed.sort(key=lambda cluster: cluster.members[0])
+        return completed
+
+    def to_state(self):
+        """
+        Возвращает незавершенные кластеры в виде, пригодном для сохранения в JSON.
+        """
+        return [[cluster.members, cluster.pairs, cluster.max_similarity] for cluster in self._clusters.values()]
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Восстанавливает кластеры, сохраненные методом to_state.
+        """
+        clusters = cls()
+        for members, pairs, max_similarity in state:
+            root = members[0]
+            for position in members:
+                clusters._parent[position] = root
+            cluster = clusters._clusters[root] = _Cluster(list(members), pairs, max_similarity)
+            heapq.heappush(clusters._heap, (cluster.last, root))
+        return clusters
+
+
+def build_full_text_matrix(corpus, workers=1):
+    """
+    Строит матрицу TF-IDF по объединенному тексту заголовка и описания каждой задачи корпуса.
+    """
+    full_text = clean_texts((f'{summary} {description}' for summary, description
+                             in zip(corpus.summaries, corpus.descriptions)), workers=workers)
+    return make_vectorizer().fit_transform(full_text)
+
+
+def get_state_path(output):
+    """
+    Возвращает путь к файлу состояния поиска кластеров, записывающего результат в output.
+    """
+    return f'{output}.state'
+
+
+def _load_state(state_path, expected):
+    try:
+        with open(state_path, encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if any(state.get(name) != value for name, value in expected.items()):
+        return None
+    return state
+
+
+def _save_state(state_path, state):
+    tmp_path = f'{state_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def write_duplicate_clusters(corpus, output, source=None, threshold=0.8, block_size=1000, workers=1,
+                             resume=True, matrix=None):
+    """
+    Ищет кластеры дубликатов по всему корпусу и потоково записывает их в файл в формате JSON Lines.
+
+    Пары задач со схожестью выше порога находятся поблочным умножением матрицы TF-IDF
+    и сразу объединяются в кластеры. После каждого блока завершенные кластеры дописываются
+    в файл, а номер обработанной строки и незавершенные кластеры сохраняются в файл состояния
+    рядом с output. Прерванный поиск продолжается с последнего сохраненного блока, если
+    корпус (отпечаток хранилища source) и параметры поиска не изменились. После завершения
+    файл состояния удаляется.
+
+    Каждая строка результата - кластер с полями 'cluster' (номер), 'size', 'pairs'
+    (количество пар выше порога), 'max_similarity' и 'issues' (список {'key', 'summary'}).
+
+    :param corpus: Корпус задач Corpus.
+    :param output: Путь к файлу результата.
+    :param source: Отпечаток хранилища, из которого получен корпус.
+    :param threshold: Порог схожести.
+    :param block_size: Количество строк в одном блоке.
+    :param workers: Количество процессов для обработки блоков.
+    :param resume: Продолжить прерванный поиск, если это возможно.
+    :param matrix: Готовая матрица TF-IDF по корпусу. По умолчанию строится build_full_text_matrix.
+    :return: Количество кластеров в файле.
+    """
+    state_path = get_state_path(output)
+    expected = {'version': STATE_VERSION, 'source': list(source) if source is not None else None,
+                'n_issues': len(corpus), 'threshold': threshold, 'block_size': block_size}
+    state = _load_state(state_path, expected) if resume and os.path.exists(output) else None
+
+    if state is not None:
+        print(f"Продолжение поиска кластеров со строки {state['next_row']} из {len(corpus)}.", file=sys.stderr)
+        # Кластеры, записанные после последнего сохранения состояния, будут записаны заново
+        os.truncate(output, state['output_size'])
+        out = open(output, 'ab')
+        clusters = DuplicateClusters.from_state(state['open'])
+        start_row, written = state['next_row'], state['clusters']
+    else:
+        out = open(output, 'wb')
+        clusters = DuplicateClusters()
+        start_row, written = 0, 0
+
+    def write(completed):
+        nonlocal written
+        for cluster in completed:
+            written += 1
+            record = {
+                'cluster': written,
+                'size': len(cluster.members),
+                'pairs': cluster.pairs,
+                'max_similarity': round(cluster.max_similarity, 4),
+                'issues': [{'key': corpus.keys[position], 'summary': corpus.summaries[position]}
+                           for position in cluster.members],
+            }
+            out.write((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+        metrics.increment('dedup.clusters', len(completed))
+
+    try:
+        if start_row < len(corpus):
+            if matrix is None:
+                matrix = build_full_text_matrix(corpus, workers=workers)
+            for end, (rows, cols, similarities) in iter_duplicate_blocks(matrix, threshold, block_size, workers,
+                                                                         start_row=start_row):
+                for i, j, similarity in zip(rows.tolist(), cols.tolist(), similarities.tolist()):
+                    clusters.add_pair(i, j, similarity)
+                metrics.increment('dedup.pairs', len(rows))
+                write(clusters.pop_completed(end))
+                out.flush()
+                os.fsync(out.fileno())
+                _save_state(state_path, dict(expected, next_row=end, output_size=out.tell(),
+                                             clusters=written, open=clusters.to_state()))
+        write(clusters.pop_completed())
+    finally:
+        out.close()
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    return written
@@ -0,0 +1,280 @@
+# embedding_index.py
+
+import hashlib
+import os
+import sys
+import threading
+import numpy as np
+import snapshot_file
+from incremental_index import IncrementalIssueIndex
+from metrics import metrics
+from snapshot_file import StringArray
+
+# Версия формата файла кэша векторов задач
+CACHE_VERSION = 1
+# Наименьшая схожесть по смыслу, которая учитывается при поиске; ниже нее тексты считаются несвязанными
+EMBEDDING_MIN_SIMILARITY = 0.5
+
+
+def get_embedding_cache_path(cache_file='issues.db'):
+    """
+    Возвращает путь к файлу кэша векторов задач, который хранится рядом с хранилищем задач.
+    """
+    root, _ = os.path.splitext(cache_file)
+    return f"{root}_embeddings.snap"
+
+
+def embedding_text(summary, description):
+    """
+    Возвращает текст задачи для модели: заголовок и описание через перевод строки.
+    """
+    summary = summary if isinstance(summary, str) else ''
+    description = description if isinstance(description, str) else ''
+    return f'{summary}\n{description}'.strip()
+
+
+def _content_hash(text):
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+class SentenceEncoder:
+    """
+    Локально сохраненная модель векторных представлений предложений (sentence-transformers) на CPU.
+
+    Пакет sentence-transformers необязателен: он импортируется, а модель загружается
+    при первом вызове encode. Модель не скачивается, model_path - каталог с уже сохраненной моделью.
+    """
+
+    def __init__(self, model_path, batch_size=32):
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        """
+        Имя модели, по которому проверяется соответствие кэша векторов.
+        """
+        return os.path.normpath(self.model_path)
+
+    def _load(self):
+        with self._lock:
+            if self._model is None:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                except ImportError as e:
+                    raise ImportError("Для поиска по смыслу нужен пакет sentence-transformers: "
+                                      "pip install sentence-transformers") from e
+                with metrics.span('embedding.load_model'):
+                    self._model = SentenceTransformer(self.model_path, device='cpu', local_files_only=True)
+            return self._model
+
+    def encode(self, texts):
+        """
+        Вычисляет нормированные векторы текстов.
+
+        :return: Массив float32 (тексты x размерность модели).
+        """
+        vectors = self._load().encode(list(texts), batch_size=self.batch_size, convert_to_numpy=True,
+                                      normalize_embeddings=True, show_progress_bar=False)
+        return np.asarray(vectors, dtype=np.float32)
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def _load_cache(cache_path, model_name):
+    """
+    Загружает кэш векторов задач.
+
+    :return: Словарь {ключ задачи: (хэш текста, массив векторов, номер строки)} или пустой словарь.
+    """
+    if cache_path is None or not os.path.exists(cache_path):
+        return {}
+    try:
+        cache = snapshot_file.load(cache_path)
+    except Exception as e:
+        print(f"Не удалось загрузить кэш векторов '{cache_path}': {e}", file=sys.stderr)
+        return {}
+    if cache.get('version') != CACHE_VERSION or cache.get('model') != model_name:
+        return {}
+    vectors, hashes = cache['vectors'], cache['hashes']
+    return {key: (hashes[row].tobytes(), vectors, row) for row, key in enumerate(cache['keys'])}
+
+
+def _save_cache(cache_path, model_name, keys, hashes, vectors):
+    try:
+        snapshot_file.dump({'version': CACHE_VERSION, 'model': model_name, 'keys': StringArray.from_strings(keys),
+                            'hashes': hashes, 'vectors': vectors}, cache_path)
+    except OSError as e:
+        print(f"Не удалось сохранить кэш векторов '{cache_path}': {e}", file=sys.stderr)
+
+
+def _embed(keys, texts, encoder, known, batch_size):
+    """
+    Составляет векторы задач: известные векторы неизменных текстов берутся из known,
+    остальные тексты кодируются моделью пакетами по batch_size.
+
+    :param known: Словарь {ключ задачи: (хэш текста, массив векторов, номер строки)}.
+    :return: Кортеж (хэши текстов (задачи x 16) uint8, векторы float32, количество закодированных текстов).
+    """
+    hashes = np.zeros((len(keys), 16), dtype=np.uint8)
+    found, missing = [], []
+    for position, (key, text) in enumerate(zip(keys, texts)):
+        digest = _content_hash(text)
+        hashes[position] = np.frombuffer(digest, dtype=np.uint8)
+        entry = known.get(key)
+        if entry is not None and entry[0] == digest:
+            found.append((position, entry[1], entry[2]))
+        else:
+            missing.append(position)
+
+    encoded = []
+    for start in range(0, len(missing), batch_size):
+        with metrics.span('embedding.encode'):
+            encoded.append(_normalize(encoder.encode([texts[position] for position in missing[start:start + batch_size]])))
+    metrics.increment('embedding.encoded', len(missing))
+
+    if encoded:
+        dimension = encoded[0].shape[1]
+    elif found:
+        dimension = found[0][1].shape[1]
+    else:
+        dimension = 0
+    vectors = np.zeros((len(keys), dimension), dtype=np.float32)
+    for position, source, row in found:
+        vectors[position] = source[row]
+    if encoded:
+        vectors[missing] = np.concatenate(encoded)
+    return hashes, vectors, len(missing)
+
+
+class EmbeddingIndex:
+    """
+    Векторы задач индекса IssueIndex для поиска по смыслу.
+
+    Строки векторов совпадают со строками индекса: векторы задач базового корпуса и, для
+    инкрементального индекса, векторы измененных задач после них. Удаленные задачи исключаются
+    маской live. Векторы хранятся нормированными, поэтому схожесть запроса со всеми задачами -
+    одно кодирование запроса моделью и одно умножение матрицы на вектор.
+
+    Векторы вычисляются только для новых и измененных текстов: неизменные задачи (по ключу и хэшу
+    текста) берутся из предыдущей версии EmbeddingIndex или из кэша векторов на диске.
+    """
+
+    def __init__(self, encoder, base_corpus, base_hashes, base_vectors, delta_keys=(), delta_hashes=None,
+                 delta_vectors=None, live=None, min_similarity=EMBEDDING_MIN_SIMILARITY):
+        self.encoder = encoder
+        self.base_corpus = base_corpus
+        self.base_hashes = base_hashes
+        self.base_vectors = base_vectors
+        self.delta_keys = list(delta_keys)
+        dimension = base_vectors.shape[1]
+        self.delta_hashes = np.zeros((0, 16), dtype=np.uint8) if delta_hashes is None else delta_hashes
+        self.delta_vectors = np.zeros((0, dimension), dtype=np.float32) if delta_vectors is None else delta_vectors
+        self.live = live
+        self.min_similarity = min_similarity
+
+    @classmethod
+    def for_index(cls, index, encoder, cache_path=None, previous=None, min_similarity=EMBEDDING_MIN_SIMILARITY,
+                  batch_size=256):
+        """
+        Составляет векторы задач индекса.
+
+        :param index: Индекс IssueIndex или IncrementalIssueIndex.
+        :param encoder: Модель с методом encode(texts) и атрибутом name, например SentenceEncoder.
+        :param cache_path: Путь к файлу кэша векторов. Кэш читается, только если векторов предыдущей
+                           версии недостаточно, и перезаписывается после построения векторов базового корпуса.
+        :param previous: Векторы предыдущей версии индекса (EmbeddingIndex).
+        :param min_similarity: Наименьшая учитываемая схожесть по смыслу.
+        :param batch_size: Количество текстов в одном обращении к модели.
+        :return: Экземпляр EmbeddingIndex.
+        """
+        if isinstance(index, IncrementalIssueIndex):
+            base_corpus, live, base_positions = index.base.index.corpus, ~index.deleted, index.base.positions()
+            delta_keys = list(index.delta)
+            delta_texts = [embedding_text(issue.summary, issue.description) for issue in index.delta.values()]
+        else:
+            base_corpus, live, base_positions, delta_keys, delta_texts = index.corpus, None, {}, [], []
+        if previous is not None and getattr(previous.encoder, 'name', None) != encoder.name:
+            previous = None
+
+        if previous is not None and previous.base_corpus is base_corpus:
+            # Базовый корпус не изменился: кодируются только измененные задачи, которых нет в предыдущей версии
+            base_hashes, base_vectors = previous.base_hashes, previous.base_vectors
+            known = previous.known(delta_keys, base_positions)
+        else:
+            known = _load_cache(cache_path, encoder.name)
+            if previous is not None:
+                known.update(previous.known())
+            base_keys = base_corpus.keys.tolist()
+            base_texts = [embedding_text(summary, description) for summary, description
+                          in zip(base_corpus.summaries, base_corpus.descriptions)]
+            base_hashes, base_vectors, n_encoded = _embed(base_keys, base_texts, encoder, known, batch_size)
+            if cache_path is not None and (n_encoded or len(known) != len(base_keys)):
+                _save_cache(cache_path, encoder.name, base_keys, base_hashes, base_vectors)
+
+        delta_hashes, delta_vectors, _ = _embed(delta_keys, delta_texts, encoder, known, batch_size)
+        # Размерность пустой части неизвестна, пока модель не закодировала ни одного ее текста
+        if not len(base_vectors):
+            base_vectors = np.zeros((0, delta_vectors.shape[1]), dtype=np.float32)
+        elif not len(delta_vectors):
+            delta_vectors = np.zeros((0, base_vectors.shape[1]), dtype=np.float32)
+        return cls(encoder, base_corpus, base_hashes, base_vectors, delta_keys, delta_hashes, delta_vectors,
+                   live=live, min_similarity=min_similarity)
+
+    def __len__(self):
+        return len(self.base_vectors) + len(self.delta_vectors)
+
+    def known(self, keys=None, base_positions=None):
+        """
+        Возвращает известные векторы задач: {ключ задачи: (хэш текста, массив векторов, номер строки)}.
+
+        :param keys: Ключи задач, векторы которых нужны. По умолчанию возвращаются векторы всех
+                     действующих задач, иначе - векторы измененных задач и задач keys.
+        :param base_positions: Номера строк базового корпуса по ключам задач (нужны вместе с keys).
+        """
+        known = {}
+        if keys is None:
+            for row, key in enumerate(self.base_corpus.keys):
+                if self.live is None or self.live[row]:
+                    known[key] = (self.base_hashes[row].tobytes(), self.base_vectors, row)
+        else:
+            for key in keys:
+                row = base_positions.get(key)
+                if row is not None:
+                    known[key] = (self.base_hashes[row].tobytes(), self.base_vectors, row)
+        for row, key in enumerate(self.delta_keys):
+            known[key] = (self.delta_hashes[row].tobytes(), self.delta_vectors, row)
+        return known
+
+    def encode_query(self, title, description):
+        """
+        Вычисляет нормированный вектор запроса одним обращением к модели.
+        """
+        with metrics.span('embedding.encode_query'):
+            return _normalize(self.encoder.encode([embedding_text(title, description)]))[0]
+
+    def score(self, title, description):
+        """
+        Вычисляет схожесть запроса по смыслу со всеми задачами.
+
+        Схожесть ниже min_similarity и схожесть с удаленными задачами обнуляются.
+
+        :return: Массив float32 по строкам индекса.
+        """
+        query = self.encode_query(title, description)
+        similarity = np.empty(len(self), dtype=np.float32)
+        n_base = len(self.base_vectors)
+        if n_base:
+            np.matmul(self.base_vectors, query, out=similarity[:n_base])
+            if self.live is not None:
+                similarity[:n_base][~self.live] = 0
+        if len(self.delta_vectors):
+            np.matmul(self.delta_vectors, query, out=similarity[n_base:])
+        similarity[similarity < self.min_similarity] = 0
+        return similarity
@@ -0,0 +1,406 @@
+# incremental_index.py
+
+import time
+from collections import ChainMap
+import numpy as np
+from scipy import sparse
+from issue_index import IssueIndex, QueryVectorizer
+from text_processor import clean_text, RussianAnalyzer
+
+
+class _BaseField:
+    """
+    Неизменяемые данные одного поля базового индекса, общие для всех его версий.
+    """
+
+    def __init__(self, vectorizer, matrix):
+        self.matrix = sparse.csr_matrix(matrix)
+        if vectorizer is None:
+            self.vocabulary, self.idf = {}, np.empty(0)
+        else:
+            self.vocabulary, self.idf = vectorizer.vocabulary_, vectorizer.idf_
+        self._document_frequency = None
+        self._squares = None
+
+    @property
+    def n_features(self):
+        return self.matrix.shape[1]
+
+    def document_frequency(self):
+        """
+        Количество задач базового индекса с каждым термином (вычисляется один раз).
+        """
+        if self._document_frequency is None:
+            self._document_frequency = np.bincount(self.matrix.indices, minlength=self.n_features)
+        return self._document_frequency
+
+    def squares(self):
+        """
+        Матрица квадратов весов базового индекса для пересчета норм строк при новых IDF (вычисляется один раз).
+        """
+        if self._squares is None:
+            matrix = self.matrix
+            self._squares = sparse.csr_matrix((matrix.data ** 2, matrix.indices, matrix.indptr), shape=matrix.shape)
+        return self._squares
+
+
+class _IndexBase:
+    """
+    Базовый индекс IssueIndex и вычисленные по нему данные, общие для всех версий инкрементального индекса.
+    """
+
+    def __init__(self, index: IssueIndex):
+        self.index = index
+        self.fields = (_BaseField(index.vectorizer_summary, index.tfidf_summary),
+                       _BaseField(index.vectorizer_desc, index.tfidf_desc))
+        # Новые тексты разбираются тем же анализатором, что и при построении индекса
+        vectorizer = index.vectorizer_summary or index.vectorizer_desc
+        self.analyzer = vectorizer.analyzer if vectorizer is not None else RussianAnalyzer()
+        self._positions = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def positions(self):
+        """
+        Номера строк базового индекса по ключам задач (вычисляются один раз).
+        """
+        if self._positions is None:
+            self._positions = {key: position for position, key in enumerate(self.index.keys)}
+        return self._positions
+
+
+class _DeltaIssue:
+    __slots__ = ('summary', 'description', 'counts')
+
+    def __init__(self, summary, description, counts):
+        self.summary = summary
+        self.description = description
+        # Частоты терминов заголовка и описания: {номер столбца: количество}
+        self.counts = counts
+
+
+class _FieldStats:
+    """
+    Статистика поля, пересчитанная по текущему набору задач: IDF, веса для пересчета
+    строк базового индекса, нормированные строки измененных задач и векторизатор запросов.
+    """
+
+    def __init__(self, base: _BaseField, extra_vocabulary, delta_counts, deleted, n_live, analyzer):
+        n_base_features = base.n_features
+        n_features = n_base_features + len(extra_vocabulary)
+
+        # Частоты документов: базовые без удаленных строк плюс измененные задачи
+        document_frequency = np.zeros(n_features, dtype=np.int64)
+        document_frequency[:n_base_features] = base.document_frequency()
+        deleted_rows = np.flatnonzero(deleted)
+        if len(deleted_rows):
+            document_frequency[:n_base_features] -= np.bincount(base.matrix[deleted_rows].indices,
+                                                                minlength=n_base_features)
+        counts = _counts_matrix(delta_counts, n_features)
+        document_frequency += np.bincount(counts.indices, minlength=n_features)
+
+        # IDF как у TfidfVectorizer (smooth_idf); термины, которых не осталось ни в одной задаче, не учитываются
+        idf = np.zeros(n_features)
+        present = document_frequency > 0
+        idf[present] = np.log((1 + n_live) / (1 + document_frequency[present])) + 1
+        self.idf = idf
+
+        # Строка базового индекса r = tf * idf_old / |tf * idf_old| пересчитывается к новым IDF как
+        # r * ratio / |r * ratio|, где ratio = idf_new / idf_old; множитель нормы хранится отдельно
+        self.ratio = idf[:n_base_features] / base.idf if n_base_features else np.empty(0)
+        norms = np.sqrt(base.squares() @ self.ratio ** 2) if n_base_features else np.zeros(base.matrix.shape[0])
+        self.row_scale = np.zeros(len(norms))
+        live = ~deleted & (norms > 0)
+        self.row_scale[live] = 1 / norms[live]
+
+        counts.data = counts.data * idf[counts.indices]
+        self.delta = _normalize_rows(counts)
+        self.n_features = n_features
+        self.vectorizer = QueryVectorizer(ChainMap(base.vocabulary, extra_vocabulary), idf, analyzer)
+
+
+def _counts_matrix(rows, n_features):
+    indices, data, indptr = [], [], [0]
+    for counts in rows:
+        for column in sorted(counts):
+            indices.append(column)
+            data.append(counts[column])
+        indptr.append(len(indices))
+    return sparse.csr_matrix((np.asarray(data, dtype=np.float64), np.asarray(indices, dtype=np.int32),
+                              np.asarray(indptr, dtype=np.int32)), shape=(len(rows), n_features))
+
+
+def _normalize_rows(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    matrix.data /= np.repeat(norms, np.diff(matrix.indptr))
+    return matrix
+
+
+class _SegmentedStrings:
+    """
+    Строки базового индекса, за которыми следуют строки измененных задач.
+    """
+
+    def __init__(self, base, delta):
+        self.base = base
+        self.delta = delta
+
+    def __len__(self):
+        return len(self.base) + len(self.delta)
+
+    def _get(self, position):
+        n_base = len(self.base)
+        return self.base[position] if position < n_base else self.delta[position - n_base]
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            if item < 0:
+                item += len(self)
+            if not 0 <= item < len(self):
+                raise IndexError(item)
+            return self._get(int(item))
+        positions = np.arange(len(self))[item] if isinstance(item, slice) else np.asarray(item, dtype=np.int64)
+        result = np.empty(len(positions), dtype=object)
+        result[:] = [self._get(int(position)) for position in positions]
+        return result
+
+    def __iter__(self):
+        yield from self.base
+        yield from self.delta
+
+    def tolist(self):
+        return list(self)
+
+
+class LiveCorpus:
+    """
+    Корпус инкрементального индекса: задачи базового индекса и измененные задачи.
+
+    Номера задач совпадают с номерами строк индекса; удаленные и замененные задачи
+    базового индекса остаются на своих местах, но не учитываются в количестве задач.
+    """
+
+    def __init__(self, index):
+        self._index = index
+        base = index.base.index.corpus
+        delta = list(index.delta.values())
+        self.keys = _SegmentedStrings(base.keys, list(index.delta))
+        self.summaries = _SegmentedStrings(base.summaries, [issue.summary for issue in delta])
+        self.descriptions = _SegmentedStrings(base.descriptions, [issue.description for issue in delta])
+
+    @property
+    def empty(self):
+        return len(self) == 0
+
+    def __len__(self):
+        return self._index.n_live
+
+    def description(self, position):
+        return self.descriptions[position]
+
+
+class _IncrementalAnn:
+    """
+    Приближенный индекс базового индекса, дополненный измененными задачами:
+    удаленные задачи исключаются из кандидатов, а измененные задачи добавляются всегда.
+    """
+
+    def __init__(self, ann, live, n_delta):
+        self.ann = ann
+        self.live = live
+        self.n_delta = n_delta
+
+    @property
+    def n_candidates(self):
+        return self.ann.n_candidates
+
+    def candidates(self, query_summary, query_desc, n_candidates=None):
+        # Термины, появившиеся после построения индекса, приближенному индексу неизвестны
+        rows = self.ann.candidates(None if query_summary is None else query_summary[:, :self.ann.n_summary_features],
+                                   None if query_desc is None else query_desc[:, :self.ann.n_desc_features],
+                                   n_candidates)
+        rows = rows[self.live[rows]]
+        n_base = len(self.live)
+        return np.concatenate([rows, np.arange(n_base, n_base + self.n_delta, dtype=np.int64)])
+
+
+class IncrementalIssueIndex(IssueIndex):
+    """
+    Индекс IssueIndex, обновляемый по отдельным задачам без перестроения.
+
+    Базовый индекс (отображенный в память снимок) не изменяется. Новые и измененные задачи
+    векторизуются и добавляются отдельными строками после строк базового индекса, а удаленные
+    и замененные строки базового индекса помечаются удаленными. Частоты документов и IDF
+    пересчитываются лениво, при первом запросе к новой версии, а строки базового индекса
+    пересчитываются к новым IDF весами столбцов и множителем нормы строки, поэтому схожесть
+    совпадает со схожестью по индексу, построенному заново по тем же задачам.
+
+    Каждое обновление возвращает новый экземпляр, а прежний продолжает работать для запросов,
+    которые уже его получили. Накопленные изменения сворачиваются перестроением индекса (сжатием).
+    """
+
+    def __init__(self, base: _IndexBase, deleted, delta, extra_vocabulary, source=None, changed_at=None):
+        self.base = base
+        self.deleted = deleted
+        self.delta = delta
+        self.extra_vocabulary = extra_vocabulary
+        self.source = source
+        self.changed_at = changed_at
+        self.format_version = self.FORMAT_VERSION
+        self.n_deleted = int(np.count_nonzero(deleted))
+        self.corpus = LiveCorpus(self)
+        self._stats = None
+        self._matrices = None
+
+    @classmethod
+    def from_index(cls, index: IssueIndex):
+        """
+        Создает инкрементальный индекс без изменений поверх готового индекса.
+        """
+        if isinstance(index, IncrementalIssueIndex):
+            return index
+        return cls(_IndexBase(index), np.zeros(len(index), dtype=bool), {}, ({}, {}), source=index.source)
+
+    @property
+    def n_base(self):
+        return len(self.base)
+
+    @property
+    def n_live(self):
+        return self.n_base - self.n_deleted + len(self.delta)
+
+    @property
+    def pending_changes(self):
+        """
+        Количество изменений с момента построения базового индекса: удаленных строк и добавленных задач.
+        """
+        return self.n_deleted + len(self.delta)
+
+    def _count_terms(self, field, text, extra_vocabulary):
+        vocabulary = self.base.fields[field].vocabulary
+        n_base_features = self.base.fields[field].n_features
+        counts = {}
+        for term in self.base.analyzer(text):
+            column = vocabulary.get(term)
+            if column is None:
+                column = extra_vocabulary.get(term)
+                if column is None:
+                    column = extra_vocabulary[term] = n_base_features + len(extra_vocabulary)
+            counts[column] = counts.get(column, 0) + 1
+        return counts
+
+    def apply_changes(self, changed, removed_keys=(), source=None):
+        """
+        Возвращает новую версию индекса с измененными и удаленными задачами.
+
+        :param changed: Corpus с новыми и измененными задачами.
+        :param removed_keys: Ключи удаленных задач.
+        :param source: Отпечаток хранилища, которому соответствует новая версия.
+        :return: Экземпляр IncrementalIssueIndex.
+        """
+        deleted = self.deleted.copy()
+        delta = dict(self.delta)
+        extra_vocabulary = tuple(dict(vocabulary) for vocabulary in self.extra_vocabulary)
+        positions = self.base.positions()
+
+        changed_keys = changed.keys.tolist()
+        for key in list(removed_keys) + changed_keys:
+            position = positions.get(key)
+            if position is not None:
+                deleted[position] = True
+            delta.pop(key, None)
+
+        for position, key in enumerate(changed_keys):
+            summary, description = changed.summaries[position], changed.description(position)
+            delta[key] = _DeltaIssue(summary, description, (
+                self._count_terms(0, clean_text(summary), extra_vocabulary[0]),
+                self._count_terms(1, clean_text(description), extra_vocabulary[1]),
+            ))
+
+        changed_at = self.changed_at if self.pending_changes else time.time()
+        return IncrementalIssueIndex(self.base, deleted, delta, extra_vocabulary, source=source, changed_at=changed_at)
+
+    def _field_stats(self):
+        if self._stats is None:
+            delta = list(self.delta.values())
+            self._stats = tuple(
+                _FieldStats(self.base.fields[field], self.extra_vocabulary[field],
+                            [issue.counts[field] for issue in delta], self.deleted, self.n_live, self.base.analyzer)
+                for field in (0, 1)
+            )
+        return self._stats
+
+    @property
+    def vectorizer_summary(self):
+        return self._field_stats()[0].vectorizer
+
+    @property
+    def vectorizer_desc(self):
+        return self._field_stats()[1].vectorizer
+
+    @property
+    def ann(self):
+        if self.base.index.ann is None:
+            return None
+        return _IncrementalAnn(self.base.index.ann, ~self.deleted, len(self.delta))
+
+    def _materialize(self):
+        if self._matrices is None:
+            matrices = []
+            for base, stats in zip(self.base.fields, self._field_stats()):
+                matrix = base.matrix
+                data = matrix.data * stats.ratio[matrix.indices] * np.repeat(stats.row_scale, np.diff(matrix.indptr))
+                base_part = sparse.csr_matrix((data, matrix.indices, matrix.indptr),
+                                              shape=(matrix.shape[0], stats.n_features))
+                matrices.append(sparse.vstack([base_part, stats.delta], format='csr'))
+            self._matrices = tuple(matrices)
+        return self._matrices
+
+    @property
+    def tfidf_summary(self):
+        """
+        Матрица TF-IDF заголовков всех строк индекса при текущих IDF (вычисляется один раз на версию).
+        """
+        return self._materialize()[0]
+
+    @property
+    def tfidf_desc(self):
+        return self._materialize()[1]
+
+    def _score_segments(self, base, stats, query, rows):
+        n_base = self.n_base
+        if rows is None:
+            base_rows, delta_rows = None, None
+        else:
+            split = np.searchsorted(rows, n_base)
+            base_rows, delta_rows = rows[:split], rows[split:] - n_base
+        n_rows = (n_base + len(self.delta)) if rows is None else len(rows)
+        if query is None or query.nnz == 0:
+            return np.zeros(n_rows)
+
+        # Запрос по столбцам базового индекса домножается на ratio, а схожесть строки - на множитель нормы
+        in_base = query.indices < base.n_features
+        columns = query.indices[in_base]
+        weighted = sparse.csr_matrix((query.data[in_base] * stats.ratio[columns], columns, [0, len(columns)]),
+                                     shape=(1, base.n_features))
+        matrix, scale = base.matrix, stats.row_scale
+        if base_rows is not None:
+            matrix, scale = matrix[base_rows], scale[base_rows]
+        base_scores = (matrix @ weighted.T).toarray().ravel() * scale
+
+        delta = stats.delta if delta_rows is None else stats.delta[delta_rows]
+        delta_scores = (delta @ query.T).toarray().ravel()
+        return np.concatenate([base_scores, delta_scores])
+
+    def score_vectors(self, query_summary, query_desc, rows=None):
+        """
+        Вычисляет косинусное сходство векторов запроса с задачами индекса.
+
+        :param rows: Номера строк по возрастанию, для которых нужна схожесть. Если не заданы - для всех строк.
+        :return: Кортеж из двух массивов: схожесть по заголовкам и по описаниям.
+        """
+        stats = self._field_stats()
+        return (self._score_segments(self.base.fields[0], stats[0], query_summary, rows),
+                self._score_segments(self.base.fields[1], stats[1], query_desc, rows))
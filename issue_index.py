@@ -0,0 +1,497 @@
+# issue_index.py
+
+import glob
+import hashlib
+import os
+import sys
+import numpy as np
+from scipy import sparse
+from text_processor import clean_text, clean_texts, RussianAnalyzer
+from issue_store import IssueStore
+from ann_index import AnnIndex
+from metrics import metrics
+import snapshot_file
+from corpus import Corpus, as_corpus
+
+
+def get_index_path(cache_file='issues.db', name='index', source=None):
+    """
+    Возвращает путь к файлу индекса, который хранится рядом с хранилищем задач.
+
+    Каждая версия хранилища получает свой файл, поэтому новый индекс публикуется без изменения
+    файла, который другие процессы уже отобразили в память.
+
+    :param cache_file: Путь к файлу хранилища задач.
+    :param name: Вид индекса (например, 'index' или 'fused_index').
+    :param source: Отпечаток хранилища. Если не задан, читается из хранилища.
+    :return: Путь к файлу индекса.
+    """
+    root, _ = os.path.splitext(cache_file)
+    if source is None:
+        source = get_source_fingerprint(cache_file)
+    if source is None:
+        return f"{root}_{name}.snap"
+    digest = hashlib.blake2b(repr(source).encode('utf-8'), digest_size=8).hexdigest()
+    return f"{root}_{name}-{source[1]}-{digest}.snap"
+
+
+def _remove_old_indexes(cache_file, name, current_path):
+    """
+    Удаляет файлы индексов прежних версий хранилища, кроме самого нового из них:
+    его еще может загружать процесс, прочитавший предыдущую версию хранилища.
+    Файлы, которые нельзя удалить (например, открытые в другом процессе в Windows), пропускаются.
+    """
+    root, _ = os.path.splitext(cache_file)
+    prefix = f"{root}_{name}-"
+    old_paths = []
+    for path in glob.glob(f"{glob.escape(prefix)}*.snap"):
+        version = path[len(prefix):].split('-', 1)[0]
+        if path != current_path and version.isdigit():
+            old_paths.append((int(version), path))
+    old_paths.sort(reverse=True)
+    # Индексы в формате pickle, сохранявшиеся до перехода на снимки
+    legacy_path = f"{root}_{name}.pkl"
+    for path in [path for _, path in old_paths[1:]] + [legacy_path]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def get_source_fingerprint(cache_file='issues.db'):
+    """
+    Возвращает отпечаток хранилища задач (путь, версия и время обновления),
+    по которому определяется, актуален ли сохраненный индекс.
+    """
+    store = IssueStore(cache_file)
+    if not store.exists():
+        return None
+    return make_source_fingerprint(cache_file, store.get_all_meta())
+
+
+def make_source_fingerprint(cache_file, meta):
+    """
+    Составляет отпечаток хранилища по уже прочитанным метаданным.
+    """
+    return (os.path.abspath(cache_file), int(meta.get('version', 0)), meta.get('refreshed_at'))
+
+
+def make_vectorizer(analyzer=None):
+    """
+    Создает TF-IDF векторизатор для очищенных текстов задач.
+
+    :param analyzer: Анализатор, разбивающий текст на термины. По умолчанию RussianAnalyzer
+                     (русские стоп-слова и стемминг).
+    """
+    # scikit-learn импортируется только для обучения, загрузке индекса и поиску он не нужен
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    return TfidfVectorizer(analyzer=analyzer if analyzer is not None else RussianAnalyzer())
+
+
+class QueryVectorizer:
+    """
+    Обученный TF-IDF векторизатор, сохраняемый в индексе: словарь, веса IDF и анализатор.
+
+    Векторизует тексты так же, как TfidfVectorizer с настройками по умолчанию (частоты терминов,
+    умноженные на IDF, с нормировкой по L2), но без scikit-learn, поэтому сохраненный индекс
+    загружается и обслуживает запросы без импорта scikit-learn.
+    """
+
+    def __init__(self, vocabulary, idf, analyzer):
+        self.vocabulary_ = vocabulary
+        self.idf_ = idf
+        self.analyzer = analyzer
+
+    @classmethod
+    def from_fitted(cls, vectorizer):
+        """
+        Создает векторизатор по обученному TfidfVectorizer с анализатором-функцией (см. make_vectorizer).
+        """
+        return cls(dict(vectorizer.vocabulary_), np.asarray(vectorizer.idf_, dtype=np.float64), vectorizer.analyzer)
+
+    def transform(self, texts):
+        """
+        Вычисляет TF-IDF векторы текстов.
+
+        :return: Разреженная матрица CSR, по строке на текст.
+        """
+        indices, values, indptr = [], [], [0]
+        for text in texts:
+            counts = {}
+            for term in self.analyzer(text):
+                column = self.vocabulary_.get(term)
+                if column is not None:
+                    counts[column] = counts.get(column, 0) + 1
+            for column in sorted(counts):
+                indices.append(column)
+                values.append(counts[column])
+            indptr.append(len(indices))
+
+        indices = np.asarray(indices, dtype=np.int32)
+        indptr = np.asarray(indptr, dtype=np.int32)
+        data = np.asarray(values, dtype=np.float64) * self.idf_[indices]
+        # Нормировка строк по L2
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        norms = np.sqrt(np.bincount(rows, weights=data ** 2, minlength=len(indptr) - 1))
+        norms[norms == 0] = 1
+        data /= norms[rows]
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, len(self.idf_)))
+
+
+def _fit_field(texts, analyzer=None):
+    """
+    Обучает TF-IDF векторизатор на одном поле задач.
+
+    Если в поле нет ни одного слова (например, все описания пустые),
+    возвращает (None, пустая матрица), чтобы схожесть по полю была нулевой.
+    """
+    vectorizer = make_vectorizer(analyzer)
+    try:
+        matrix = vectorizer.fit_transform(texts)
+    except ValueError:
+        return None, sparse.csr_matrix((len(texts), 0), dtype=np.float64)
+    return QueryVectorizer.from_fitted(vectorizer), matrix.tocsr()
+
+
+def vocabulary_report(texts, analyzer=None):
+    """
+    Сравнивает размер словаря и матрицы TF-IDF со стандартным токенизатором и с анализатором.
+
+    :param texts: Очищенные тексты.
+    :param analyzer: Анализатор для сравнения. По умолчанию RussianAnalyzer.
+    :return: Словарь с размерами словаря ('vocabulary') и количеством ненулевых элементов
+             матрицы ('nnz') для стандартного токенизатора ('plain_*') и анализатора ('analyzed_*').
+    """
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    report = {}
+    for name, vectorizer in (('plain', TfidfVectorizer()), ('analyzed', make_vectorizer(analyzer))):
+        try:
+            matrix = vectorizer.fit_transform(texts)
+            report[f'{name}_vocabulary'] = len(vectorizer.vocabulary_)
+            report[f'{name}_nnz'] = matrix.nnz
+        except ValueError:
+            report[f'{name}_vocabulary'] = report[f'{name}_nnz'] = 0
+    return report
+
+
+class SavedIndex:
+    """
+    Базовый класс индексов, сохраняемых на диск рядом с хранилищем задач.
+    """
+
+    # Имя файла индекса (см. get_index_path)
+    FILE_NAME = 'index'
+
+    # Версия формата индекса: сохраненные индексы другой версии перестраиваются
+    FORMAT_VERSION = 1
+
+    # Приближенный индекс ближайших соседей (AnnIndex), если он построен
+    ann = None
+
+    def __len__(self):
+        return len(self.corpus)
+
+    @property
+    def keys(self):
+        return self.corpus.keys
+
+    @property
+    def summaries(self):
+        return self.corpus.summaries
+
+    def save(self, path):
+        """
+        Сохраняет индекс на диск в файл снимка (см. snapshot_file). Запись атомарная:
+        сначала во временный файл, затем переименование.
+        """
+        snapshot_file.dump(self, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Загружает индекс с диска. Матрицы TF-IDF, ключи и заголовки задач не копируются в память
+        процесса, а отображаются из файла только для чтения и разделяются между процессами.
+        """
+        index = snapshot_file.load(path)
+        if not isinstance(index, cls):
+            raise ValueError(f"Файл '{path}' не содержит индекс задач.")
+        return index
+
+
+class IssueIndex(SavedIndex):
+    """
+    Предварительно построенный TF-IDF индекс по заголовкам и описаниям задач.
+
+    Индекс строится один раз на каждое обновление кэша: векторизаторы обучаются
+    на всем корпусе, а для запроса выполняется только transform и одно
+    умножение разреженной матрицы на вектор по каждому полю.
+    """
+
+    FORMAT_VERSION = 5
+
+    def __init__(self, corpus: Corpus, vectorizer_summary, tfidf_summary,
+                 vectorizer_desc, tfidf_desc, source=None):
+        self.corpus = corpus
+        self.vectorizer_summary = vectorizer_summary
+        self.tfidf_summary = tfidf_summary
+        self.vectorizer_desc = vectorizer_desc
+        self.tfidf_desc = tfidf_desc
+        self.source = source
+        self.format_version = self.FORMAT_VERSION
+
+    @classmethod
+    def build(cls, issues, source=None, analyzer=None):
+        """
+        Строит индекс по корпусу задач.
+
+        :param issues: Corpus или DataFrame с задачами (колонки: 'key', 'summary', 'description').
+        :param source: Отпечаток хранилища, из которого получены задачи.
+        :param analyzer: Анализатор текста для векторизаторов. По умолчанию RussianAnalyzer.
+        :return: Экземпляр IssueIndex.
+        """
+        corpus = as_corpus(issues)
+        # Очищенные тексты нужны только на время построения и освобождаются вместе с ним
+        cleaned_summary = clean_texts(corpus.summaries)
+        cleaned_description = clean_texts(corpus.descriptions)
+
+        # Один анализатор на оба поля, чтобы кэш основ слов был общим
+        if analyzer is None:
+            analyzer = RussianAnalyzer()
+        vectorizer_summary, tfidf_summary = _fit_field(cleaned_summary, analyzer)
+        vectorizer_desc, tfidf_desc = _fit_field(cleaned_description, analyzer)
+
+        return cls(
+            corpus=corpus,
+            vectorizer_summary=vectorizer_summary,
+            tfidf_summary=tfidf_summary,
+            vectorizer_desc=vectorizer_desc,
+            tfidf_desc=tfidf_desc,
+            source=source,
+        )
+
+    @staticmethod
+    def _vectorize_field(vectorizer, cleaned_text):
+        if vectorizer is None:
+            return None
+        return vectorizer.transform([cleaned_text])
+
+    @staticmethod
+    def _score_field(matrix, query, rows=None):
+        if rows is not None:
+            matrix = matrix[rows]
+        if query is None or matrix.shape[0] == 0:
+            return np.zeros(matrix.shape[0])
+        # Строки TF-IDF нормированы по L2, поэтому скалярное произведение равно косинусному сходству
+        return (matrix @ query.T).toarray().ravel()
+
+    def vectorize(self, new_title: str, new_description: str):
+        """
+        Вычисляет TF-IDF векторы запроса в пространствах заголовков и описаний.
+
+        :return: Кортеж из двух разреженных векторов-строк (None, если по полю нет словаря).
+        """
+        with metrics.span('search.clean_text'):
+            cleaned_title, cleaned_description = clean_text(new_title), clean_text(new_description)
+        with metrics.span('search.vectorize'):
+            return (self._vectorize_field(self.vectorizer_summary, cleaned_title),
+                    self._vectorize_field(self.vectorizer_desc, cleaned_description))
+
+    def vectorize_batch(self, titles, descriptions):
+        """
+        Вычисляет TF-IDF векторы сразу для нескольких запросов.
+
+        :param titles: Названия новых задач.
+        :param descriptions: Описания новых задач в том же порядке.
+        :return: Кортеж из двух разреженных матриц (по строке на запрос) в пространствах
+                 заголовков и описаний; None, если по полю нет словаря.
+        """
+        cleaned_titles = clean_texts(titles)
+        cleaned_descriptions = clean_texts(descriptions)
+        return (None if self.vectorizer_summary is None else self.vectorizer_summary.transform(cleaned_titles),
+                None if self.vectorizer_desc is None else self.vectorizer_desc.transform(cleaned_descriptions))
+
+    def score_vectors(self, query_summary, query_desc, rows=None):
+        """
+        Вычисляет косинусное сходство векторов запроса с задачами индекса.
+
+        :param query_summary: Вектор запроса в пространстве заголовков.
+        :param query_desc: Вектор запроса в пространстве описаний.
+        :param rows: Номера задач, для которых нужна схожесть. Если не заданы - для всех задач.
+        :return: Кортеж из двух массивов: схожесть по заголовкам и по описаниям.
+        """
+        return (self._score_field(self.tfidf_summary, query_summary, rows),
+                self._score_field(self.tfidf_desc, query_desc, rows))
+
+    def score(self, new_title: str, new_description: str):
+        """
+        Вычисляет косинусное сходство запроса со всеми задачами индекса.
+
+        :param new_title: Название новой задачи.
+        :param new_description: Описание новой задачи.
+        :return: Кортеж из двух массивов: схожесть по заголовкам и по описаниям.
+        """
+        return self.score_vectors(*self.vectorize(new_title, new_description))
+
+
+class FusedIssueIndex(SavedIndex):
+    """
+    TF-IDF индекс заголовков и описаний в одном векторном пространстве.
+
+    Один векторизатор обучается на текстах обоих полей, а матрицы заголовков и описаний
+    хранятся рядом: [заголовки | описания]. Запрос с весами полей умножается на эту матрицу
+    один раз, и результат сразу равен взвешенной сумме схожести по полям.
+    Очередь задачи и время ее изменения для бустов по метаданным берутся из корпуса.
+    """
+
+    FILE_NAME = 'fused_index'
+    FORMAT_VERSION = 4
+
+    def __init__(self, corpus: Corpus, vectorizer, tfidf, source=None):
+        self.corpus = corpus
+        self.vectorizer = vectorizer
+        self.tfidf = tfidf
+        self.source = source
+        self.format_version = self.FORMAT_VERSION
+
+    @property
+    def n_features(self):
+        return self.tfidf.shape[1] // 2
+
+    @property
+    def queue_codes(self):
+        return self.corpus.queue_codes
+
+    @property
+    def queue_names(self):
+        return self.corpus.queue_names
+
+    @property
+    def updated(self):
+        return self.corpus.updated
+
+    @classmethod
+    def build(cls, issues, source=None, analyzer=None):
+        """
+        Строит индекс по корпусу задач.
+
+        :param issues: Corpus или DataFrame с задачами (колонки: 'key', 'summary', 'description',
+                       необязательная 'updated').
+        :param source: Отпечаток хранилища, из которого получены задачи.
+        :param analyzer: Анализатор текста для векторизатора. По умолчанию RussianAnalyzer.
+        :return: Экземпляр FusedIssueIndex.
+        """
+        corpus = as_corpus(issues)
+        # Очищенные тексты нужны только на время построения и освобождаются вместе с ним
+        cleaned_summary = clean_texts(corpus.summaries)
+        cleaned_description = clean_texts(corpus.descriptions)
+
+        vectorizer = make_vectorizer(analyzer)
+        try:
+            vectorizer.fit(cleaned_summary + cleaned_description)
+            tfidf = sparse.hstack([vectorizer.transform(cleaned_summary),
+                                   vectorizer.transform(cleaned_description)], format='csr')
+            vectorizer = QueryVectorizer.from_fitted(vectorizer)
+        except ValueError:
+            vectorizer, tfidf = None, sparse.csr_matrix((len(corpus), 0), dtype=np.float64)
+
+        return cls(
+            corpus=corpus,
+            vectorizer=vectorizer,
+            tfidf=tfidf,
+            source=source,
+        )
+
+    def vectorize(self, new_title: str, new_description: str, summary_weight=1.0, description_weight=1.0):
+        """
+        Вычисляет вектор запроса [вес заголовка * заголовок | вес описания * описание].
+        """
+        if self.vectorizer is None:
+            return None
+        with metrics.span('search.clean_text'):
+            cleaned = [clean_text(new_title), clean_text(new_description)]
+        with metrics.span('search.vectorize'):
+            query = self.vectorizer.transform(cleaned)
+        return sparse.hstack([query[0] * summary_weight, query[1] * description_weight], format='csr')
+
+    def score(self, new_title: str, new_description: str, summary_weight=1.0, description_weight=1.0):
+        """
+        Вычисляет взвешенную сумму схожести запроса с задачами по заголовку и описанию
+        одним умножением разреженной матрицы на вектор.
+        """
+        query = self.vectorize(new_title, new_description, summary_weight, description_weight)
+        if query is None or self.tfidf.shape[0] == 0:
+            return np.zeros(len(self))
+        return (self.tfidf @ query.T).toarray().ravel()
+
+    def field_scores(self, rows, new_title: str, new_description: str):
+        """
+        Вычисляет схожесть запроса по каждому полю отдельно, только для задач rows.
+
+        :return: Кортеж из двух массивов: схожесть по заголовкам и по описаниям.
+        """
+        if self.vectorizer is None or len(rows) == 0:
+            return np.zeros(len(rows)), np.zeros(len(rows))
+        query = self.vectorizer.transform([clean_text(new_title), clean_text(new_description)])
+        matrix = self.tfidf[rows]
+        n = self.n_features
+        return ((matrix[:, :n] @ query[0].T).toarray().ravel(),
+                (matrix[:, n:] @ query[1].T).toarray().ravel())
+
+
+def load_or_build_index(issues, cache_file='issues.db', source=None, ann_min_issues=None,
+                        index_class=IssueIndex):
+    """
+    Загружает сохраненный индекс, если он соответствует текущему кэшу задач,
+    иначе строит новый и сохраняет его рядом с кэшем.
+
+    Корпус задач сохраняется вместе с индексом и доступен как index.corpus.
+
+    :param issues: Corpus или DataFrame с задачами, загруженный из кэша, либо функция без аргументов,
+                   которая их загружает. Функция вызывается, только если индекс нужно построить.
+    :param cache_file: Путь к файлу хранилища задач.
+    :param source: Отпечаток хранилища, прочитанный до загрузки задач.
+                   Если не задан, читается из хранилища.
+    :param ann_min_issues: Количество задач, начиная с которого к индексу строится
+                           приближенный индекс ближайших соседей. Если не задано, он не строится.
+    :param index_class: Класс индекса: IssueIndex или FusedIssueIndex.
+    :return: Экземпляр index_class.
+    """
+    if source is None:
+        source = get_source_fingerprint(cache_file)
+    index_path = get_index_path(cache_file, index_class.FILE_NAME, source)
+
+    index = None
+    if source is not None and os.path.exists(index_path):
+        try:
+            with metrics.span('index.load'):
+                loaded = index_class.load(index_path)
+            if (loaded.source == source and (callable(issues) or len(loaded) == len(issues))
+                    and getattr(loaded, 'format_version', 1) == index_class.FORMAT_VERSION):
+                index = loaded
+        except Exception as e:
+            print(f"Не удалось загрузить индекс '{index_path}': {e}", file=sys.stderr)
+
+    changed = index is None
+    if index is None:
+        print("Построение индекса задач...", file=sys.stderr)
+        with metrics.span('index.build'):
+            index = index_class.build(issues() if callable(issues) else issues, source=source)
+
+    if (ann_min_issues is not None and isinstance(index, IssueIndex)
+            and len(index) >= ann_min_issues and index.ann is None):
+        print("Построение приближенного индекса...", file=sys.stderr)
+        with metrics.span('index.build_ann'):
+            index.ann = AnnIndex.build(index)
+        changed = True
+
+    if changed and source is not None:
+        try:
+            with metrics.span('index.save'):
+                index.save(index_path)
+        except OSError as e:
+            # Например, в Windows нельзя заменить файл, отображенный в память другим процессом
+            print(f"Не удалось сохранить индекс '{index_path}': {e}", file=sys.stderr)
+        else:
+            print(f"Индекс сохранен в '{index_path}'.", file=sys.stderr)
+            _remove_old_indexes(cache_file, index_class.FILE_NAME, index_path)
+    return index
@@ -0,0 +1,306 @@
+# issue_store.py
+
+import os
+import sqlite3
+from contextlib import closing, contextmanager
+from datetime import datetime, timezone
+from corpus import Corpus
+
+ISSUE_COLUMNS = ['key', 'summary', 'description', 'updated']
+
+# Количество последних версий хранилища, для которых хранится журнал измененных задач
+CHANGE_LOG_VERSIONS = 100
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS issues (
+    key TEXT PRIMARY KEY,
+    summary TEXT,
+    description TEXT,
+    updated TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS staged_issues (
+    key TEXT PRIMARY KEY,
+    summary TEXT,
+    description TEXT,
+    updated TEXT
+);
+CREATE TABLE IF NOT EXISTS changes (
+    version INTEGER,
+    key TEXT
+);
+CREATE INDEX IF NOT EXISTS changes_version ON changes (version);
+CREATE TABLE IF NOT EXISTS staged_pages (
+    query TEXT,
+    page INTEGER,
+    total_pages INTEGER,
+    PRIMARY KEY (query, page)
+);
+"""
+
+
+class IssueStore:
+    """
+    Локальное хранилище задач на SQLite.
+
+    Каждое изменение выполняется в одной транзакции и увеличивает версию хранилища,
+    поэтому читатели видят либо старое, либо новое состояние целиком. Журнал WAL
+    позволяет читать данные параллельно с записью. Количество задач и метаданные
+    читаются без загрузки самих задач.
+
+    Ключи задач, измененных и удаленных точечными обновлениями, записываются в журнал изменений
+    с номером версии, поэтому индекс можно обновить только по изменившимся задачам.
+
+    Полная загрузка задач складывается постранично в промежуточные таблицы и заменяет
+    основные одной транзакцией, когда загружены все страницы. Уже сохраненные страницы
+    переживают сбой, поэтому прерванная загрузка продолжается с места остановки.
+    """
+
+    def __init__(self, path='issues.db'):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    @contextmanager
+    def _connect(self):
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            with conn:
+                yield conn
+
+    def _set_meta(self, conn, name, value):
+        conn.execute(
+            "INSERT INTO meta (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+            (name, None if value is None else str(value))
+        )
+
+    def _bump_version(self, conn, last_updated=None):
+        row = conn.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+        version = int(row[0]) + 1 if row else 1
+        self._set_meta(conn, 'version', version)
+        self._set_meta(conn, 'refreshed_at', datetime.now().isoformat(timespec='seconds'))
+        if last_updated is not None:
+            self._set_meta(conn, 'last_updated', last_updated)
+        return version
+
+    def _reset_changes(self, conn, version):
+        # После полной замены задач журнал начинается заново: изменения до version не восстановить
+        conn.execute("DELETE FROM changes")
+        self._set_meta(conn, 'changes_from', version)
+
+    @staticmethod
+    def _rows(issues_df):
+        issues_df = issues_df.reindex(columns=ISSUE_COLUMNS)
+        issues_df = issues_df.astype(object).where(issues_df.notna(), None)
+        return issues_df.itertuples(index=False, name=None)
+
+    def get_meta(self, name, default=None):
+        """
+        Возвращает значение метаданных хранилища без загрузки задач.
+        """
+        if not self.exists():
+            return default
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row and row[0] is not None else default
+
+    def get_all_meta(self):
+        """
+        Возвращает все метаданные хранилища одним запросом.
+        """
+        if not self.exists():
+            return {}
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT name, value FROM meta").fetchall())
+
+    def get_version(self):
+        """
+        Возвращает версию хранилища. Версия увеличивается при каждом изменении задач.
+        """
+        return int(self.get_meta('version', 0))
+
+    def get_refreshed_at(self):
+        """
+        Возвращает время последнего обновления хранилища или None, если оно еще не заполнялось.
+        """
+        value = self.get_meta('refreshed_at')
+        return datetime.fromisoformat(value) if value else None
+
+    def count(self):
+        """
+        Возвращает количество задач в хранилище.
+        """
+        if not self.exists():
+            return 0
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM issues").fetchone()[0]
+
+    def read_issues(self):
+        """
+        Загружает все задачи.
+
+        :return: DataFrame с колонками 'key', 'summary', 'description', 'updated'.
+        """
+        # pandas нужен только для чтения задач в DataFrame; поиску по индексу он не нужен
+        import pandas as pd
+
+        if not self.exists():
+            return pd.DataFrame(columns=ISSUE_COLUMNS)
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT {', '.join(ISSUE_COLUMNS)} FROM issues ORDER BY rowid").fetchall()
+        issues_df = pd.DataFrame(rows, columns=ISSUE_COLUMNS)
+        issues_df['description'] = issues_df['description'].fillna('')
+        return issues_df
+
+    def read_corpus(self):
+        """
+        Загружает все задачи в компактный корпус Corpus, читая строки из базы по одной.
+
+        :return: Экземпляр Corpus.
+        """
+        if not self.exists():
+            return Corpus.from_records([])
+        with self._connect() as conn:
+            return Corpus.from_records(conn.execute(f"SELECT {', '.join(ISSUE_COLUMNS)} FROM issues ORDER BY rowid"))
+
+    def replace_all(self, issues_df, last_updated=None):
+        """
+        Атомарно заменяет все задачи в хранилище.
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM issues")
+            conn.executemany(
+                f"INSERT OR REPLACE INTO issues ({', '.join(ISSUE_COLUMNS)}) VALUES (?, ?, ?, ?)",
+                self._rows(issues_df)
+            )
+            self._reset_changes(conn, self._bump_version(conn, last_updated))
+
+    def apply_changes(self, changed_df, removed_keys=(), last_updated=None):
+        """
+        Атомарно обновляет задачи по ключу: измененные заменяются, новые добавляются,
+        задачи из removed_keys удаляются. Ключи всех затронутых задач записываются в журнал изменений.
+        """
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM issues WHERE key = ?", ((key,) for key in removed_keys))
+            conn.executemany(
+                f"INSERT INTO issues ({', '.join(ISSUE_COLUMNS)}) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET summary = excluded.summary, "
+                "description = excluded.description, updated = excluded.updated",
+                self._rows(changed_df)
+            )
+            version = self._bump_version(conn, last_updated)
+
+            row = conn.execute("SELECT value FROM meta WHERE name = 'changes_from'").fetchone()
+            if row is None:
+                # Хранилище заполнено до появления журнала: журнал полон начиная с этого изменения
+                self._set_meta(conn, 'changes_from', version - 1)
+            keys = list(removed_keys) + changed_df['key'].tolist()
+            conn.executemany("INSERT INTO changes (version, key) VALUES (?, ?)", ((version, key) for key in keys))
+
+            # Старые записи журнала удаляются; индексы старше журнала перестраиваются целиком
+            oldest = version - CHANGE_LOG_VERSIONS
+            if row is not None and int(row[0]) < oldest:
+                conn.execute("DELETE FROM changes WHERE version <= ?", (oldest,))
+                self._set_meta(conn, 'changes_from', oldest)
+
+    def read_changes(self, since_version):
+        """
+        Возвращает задачи, измененные после версии хранилища since_version, по журналу изменений.
+
+        :param since_version: Версия хранилища, для которой уже построен индекс.
+        :return: Кортеж (Corpus с новыми и измененными задачами, список ключей удаленных задач)
+                 или None, если журнал не покрывает изменения после since_version
+                 (например, после полной замены задач) и индекс нужно перестроить.
+        """
+        if not self.exists():
+            return None
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE name = 'changes_from'").fetchone()
+            if row is None or since_version < int(row[0]):
+                return None
+            keys = [key for key, in conn.execute(
+                "SELECT DISTINCT key FROM changes WHERE version > ?", (since_version,))]
+            records = []
+            # Задачи читаются порциями, чтобы не превысить ограничение SQLite на число параметров запроса
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                records.extend(conn.execute(
+                    f"SELECT {', '.join(ISSUE_COLUMNS)} FROM issues "
+                    f"WHERE key IN ({', '.join('?' * len(chunk))}) ORDER BY rowid", chunk
+                ))
+        present = {record[0] for record in records}
+        return Corpus.from_records(records), [key for key in keys if key not in present]
+
+    def get_staged_pages(self, staging_id):
+        """
+        Возвращает страницы, уже сохраненные текущей полной загрузкой.
+
+        Если сохраненные страницы относятся к загрузке с другими параметрами (staging_id),
+        промежуточные данные очищаются и запоминается время начала новой загрузки.
+
+        :param staging_id: Идентификатор параметров загрузки (запросы и размер страницы).
+        :return: Словарь {(запрос, номер страницы): общее количество страниц запроса}.
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE name = 'staging_id'").fetchone()
+            if row is None or row[0] != staging_id:
+                conn.execute("DELETE FROM staged_issues")
+                conn.execute("DELETE FROM staged_pages")
+                self._set_meta(conn, 'staging_id', staging_id)
+                self._set_meta(conn, 'staging_started', datetime.now(timezone.utc).isoformat(timespec='seconds'))
+                return {}
+            rows = conn.execute("SELECT query, page, total_pages FROM staged_pages").fetchall()
+        return {(query, page): total_pages for query, page, total_pages in rows}
+
+    def stage_page(self, query, page, total_pages, issues_df):
+        """
+        Атомарно сохраняет страницу задач полной загрузки и отмечает ее загруженной.
+        """
+        with self._connect() as conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO staged_issues ({', '.join(ISSUE_COLUMNS)}) VALUES (?, ?, ?, ?)",
+                self._rows(issues_df)
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO staged_pages (query, page, total_pages) VALUES (?, ?, ?)",
+                (query, page, total_pages)
+            )
+
+    def commit_staged(self):
+        """
+        Атомарно заменяет все задачи задачами полной загрузки и очищает промежуточные таблицы.
+
+        Водяной знак синхронизации - время последнего изменения загруженных задач, но не позже
+        начала загрузки: страницы, сохраненные до перерыва, могли устареть, и следующая загрузка
+        изменений (с запасом SYNC_OVERLAP) должна перезапросить все, что менялось после начала загрузки.
+
+        :return: Количество задач в хранилище.
+        """
+        import pandas as pd
+
+        with self._connect() as conn:
+            updated = pd.to_datetime(
+                pd.Series([row[0] for row in conn.execute("SELECT updated FROM staged_issues")], dtype=object),
+                utc=True, errors='coerce', format='ISO8601'
+            )
+            last_updated = None if updated.isna().all() else updated.max()
+            started = conn.execute("SELECT value FROM meta WHERE name = 'staging_started'").fetchone()
+            if last_updated is not None and started is not None:
+                last_updated = min(last_updated, pd.Timestamp(started[0]))
+            last_updated = last_updated.isoformat() if last_updated is not None else None
+            conn.execute("DELETE FROM issues")
+            conn.execute(
+                f"INSERT INTO issues ({', '.join(ISSUE_COLUMNS)}) "
+                f"SELECT {', '.join(ISSUE_COLUMNS)} FROM staged_issues ORDER BY rowid"
+            )
+            conn.execute("DELETE FROM staged_issues")
+            conn.execute("DELETE FROM staged_pages")
+            conn.execute("DELETE FROM meta WHERE name IN ('staging_id', 'staging_started')")
+            self._reset_changes(conn, self._bump_version(conn, last_updated))
+            return conn.execute("SELECT COUNT(*) FROM issues").fetchone()[0]
@@ -1,28 +1,63 @@
-import pandas as pd
+import argparse
+import csv
+import json
+import os
 import sys
+from itertools import islice
 from yandex_tracker import load_or_fetch_issues as load_issues
 from similarity_checker import find_similar_issues as find_issues
+from similarity_checker import iter_duplicate_pairs, find_similar_issues_batch, find_similar_issues_fused
+from text_processor import clean_text, clean_texts
+from query_cache import query_cache
+from metrics import metrics
+from issue_index import load_or_build_index, get_source_fingerprint, vocabulary_report, IssueIndex, FusedIssueIndex
+from duplicate_clusters import build_full_text_matrix, write_duplicate_clusters
+from embedding_index import EmbeddingIndex, SentenceEncoder, get_embedding_cache_path
 
+# Счетчики кэша запросов выводятся вместе с остальными метриками
+metrics.register_gauges('query_cache', query_cache.stats)
 
-def find_similar_issues(summary, description, issues):
+
+def find_similar_issues(summary, description, issues, **kwargs):
     """
     Находит похожие задачи на основе предоставленных данных.
 
+    Если передан индекс, построенный по хранилищу, результат кэшируется по очищенному
+    тексту запроса и параметрам поиска до обновления хранилища.
+
     Args:
         summary (str): Заголовок новой задачи.
         description (str): Описание новой задачи.
         issues (pd.DataFrame): DataFrame с существующими задачами.
+        **kwargs: Дополнительные параметры поиска (например, index с готовым индексом).
 
     Returns:
         pd.DataFrame: DataFrame с похожими задачами.
     """
-    return find_issues(summary, description, issues)
+    with metrics.span('search.total'):
+        version = getattr(kwargs.get('index'), 'source', None)
+        if version is None:
+            return find_issues(summary, description, issues, **kwargs)
 
+        params = tuple(sorted((name, value) for name, value in kwargs.items() if name != 'index'))
+        key = (clean_text(summary), clean_text(description), params)
+        result = query_cache.get_or_compute(version, key, lambda: find_issues(summary, description, issues, **kwargs))
+        # Копия, чтобы вызывающий код не мог изменить результат в кэше
+        return result.copy()
 
-def interactive_main():
+
+def interactive_main(fused=False, embedding_model=None):
     """
     Основная функция для интерактивного поиска похожих задач в командной строке.
+
+    Args:
+        fused (bool): Оценивать схожесть взвешенной суммой по заголовку и описанию в одном векторном пространстве.
+        embedding_model (str): Каталог локальной модели sentence-transformers. Если задан, схожесть TF-IDF
+            совмещается со схожестью по смыслу (без fused).
     """
+    # pandas нужен только для табличного вывода результатов, остальным командам он не нужен
+    import pandas as pd
+
     # Конфигурация для корректного чтения ввода в PowerShell
     if sys.platform == "win32":
         sys.stdin.reconfigure(encoding='utf-8')
@@ -30,7 +65,13 @@ def interactive_main():
 
     print("Загрузка задач из Yandex.Tracker...")
     try:
-        issues_df = load_issues()
+        issues = load_issues()
+        index = load_or_build_index(issues, index_class=FusedIssueIndex if fused else IssueIndex)
+        embeddings = None
+        if embedding_model and not fused:
+            print("Вычисление векторов задач...")
+            embeddings = EmbeddingIndex.for_index(index, SentenceEncoder(embedding_model),
+                                                  cache_path=get_embedding_cache_path())
         print("Задачи успешно загружены.")
     except Exception as e:
         print(f"Ошибка при загрузке задач: {e}")
@@ -49,7 +90,10 @@ def interactive_main():
             if description.lower() in ['exit', 'quit']:
                 break
 
-            similar_issues = find_similar_issues(title, description, issues_df)
+            if fused:
+                similar_issues = find_similar_issues_fused(title, description, index)
+            else:
+                similar_issues = find_similar_issues(title, description, issues, index=index, embeddings=embeddings)
 
             if similar_issues.empty:
                 print("\nПохожих задач не найдено.")
@@ -57,7 +101,9 @@ def interactive_main():
                 print("\nНайдены похожие задачи:")
                 # Создаем DataFrame для красивого вывода
                 results_df = pd.DataFrame(similar_issues)
-                results_df['similarity'] = results_df['similarity'].map(lambda x: f"{x:.2%}")
+                for column in ['similarity', 'summary_similarity', 'description_similarity']:
+                    if column in results_df.columns:
+                        results_df[column] = results_df[column].map(lambda x: f"{x:.2%}")
 
                 # Настройка вывода pandas
                 pd.set_option('display.max_rows', None)
@@ -70,7 +116,9 @@ def interactive_main():
                     'key': 'Ключ',
                     'similarity': 'Схожесть',
                     'found_in': 'Найдено по',
-                    'summary': 'Название'
+                    'summary': 'Название',
+                    'summary_similarity': 'По заголовку',
+                    'description_similarity': 'По описанию'
                 }, inplace=True)
 
                 print(results_df.to_string(index=False))
@@ -79,10 +127,182 @@ def interactive_main():
             print(f"Произошла ошибка: {e}")
             print("Пожалуйста, попробуйте еще раз.")
 
+    print(f"Кэш запросов: {query_cache.describe()}")
+
+
+def dedup_main(output=None, threshold=0.8, block_size=1000, workers=1):
+    """
+    Ищет дубликаты по всему бэклогу и потоково выводит найденные пары в формате JSON Lines.
+
+    Args:
+        output (str): Путь к файлу для записи пар. Если не задан, пары выводятся в stdout.
+        threshold (float): Порог схожести.
+        block_size (int): Количество строк в одном блоке при поблочном умножении матриц.
+        workers (int): Количество процессов для обработки блоков.
+    """
+    issues = load_issues()
+    tfidf_matrix = build_full_text_matrix(issues, workers=workers)
+    pairs = iter_duplicate_pairs(
+        tfidf_matrix, issues.keys.tolist(), threshold=threshold, block_size=block_size, workers=workers
+    )
+
+    out = open(output, 'w', encoding='utf-8') if output else sys.stdout
+    count = 0
+    try:
+        for pair in pairs:
+            out.write(json.dumps(pair, ensure_ascii=False) + '\n')
+            out.flush()
+            count += 1
+    finally:
+        if output:
+            out.close()
+    print(f"Найдено пар дубликатов: {count}", file=sys.stderr)
+
+
+def clusters_main(output, threshold=0.8, block_size=1000, workers=1, restart=False):
+    """
+    Ищет кластеры дубликатов по всему бэклогу и потоково записывает их в файл в формате JSON Lines.
+
+    Прерванный поиск при повторном запуске продолжается с места остановки,
+    если хранилище задач и параметры поиска не изменились.
+
+    Args:
+        output (str): Путь к файлу для записи кластеров.
+        threshold (float): Порог схожести.
+        block_size (int): Количество строк в одном блоке при поблочном умножении матриц.
+        workers (int): Количество процессов для обработки блоков.
+        restart (bool): Начать поиск заново, даже если есть сохраненное состояние.
+    """
+    issues = load_issues()
+    count = write_duplicate_clusters(issues, output, source=get_source_fingerprint(), threshold=threshold,
+                                     block_size=block_size, workers=workers, resume=not restart)
+    print(f"Найдено кластеров дубликатов: {count}", file=sys.stderr)
+
+
+def iter_candidates(path):
+    """
+    Потоково читает новые задачи из файла CSV или JSON Lines.
+
+    Каждая запись должна содержать поле 'summary' и может содержать 'description'
+    и идентификатор 'id'. Если идентификатора нет, используется номер записи.
+
+    Args:
+        path (str): Путь к файлу (.csv - CSV с заголовком, иначе JSON Lines).
+
+    Returns:
+        Генератор словарей с ключами 'id', 'summary', 'description'.
+    """
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.lower().endswith('.csv'):
+            records = csv.DictReader(f)
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+        for number, record in enumerate(records, start=1):
+            yield {
+                'id': record.get('id') or number,
+                'summary': record.get('summary') or '',
+                'description': record.get('description') or '',
+            }
+
+
+def check_main(input_path, output=None, top_n=5, batch_size=1000):
+    """
+    Проверяет на дубликаты сразу все новые задачи из файла и потоково выводит результат
+    в формате JSON Lines: по строке с найденными похожими задачами на каждую новую задачу.
+
+    Args:
+        input_path (str): Файл CSV или JSON Lines с новыми задачами.
+        output (str): Путь к файлу для записи результата. Если не задан, результат выводится в stdout.
+        top_n (int): Количество похожих задач для каждой новой задачи.
+        batch_size (int): Количество новых задач, сравниваемых с корпусом за одно умножение матриц.
+    """
+    index = load_or_build_index(load_issues())
+
+    candidates = iter_candidates(input_path)
+    out = open(output, 'w', encoding='utf-8') if output else sys.stdout
+    count = 0
+    try:
+        # Файл читается пакетами, поэтому результат для первых задач выводится, не дожидаясь чтения всего файла
+        while True:
+            batch = list(islice(candidates, batch_size))
+            if not batch:
+                break
+            results = find_similar_issues_batch(
+                ((candidate['summary'], candidate['description']) for candidate in batch),
+                index, top_n=top_n, batch_size=batch_size
+            )
+            for candidate, matches in zip(batch, results):
+                record = {'id': candidate['id'], 'summary': candidate['summary'], 'matches': matches}
+                out.write(json.dumps(record, ensure_ascii=False) + '\n')
+            out.flush()
+            count += len(batch)
+    finally:
+        if output:
+            out.close()
+    print(f"Проверено задач: {count}", file=sys.stderr)
+
+
+def vocab_main():
+    """
+    Выводит размер словаря и матриц TF-IDF без стемминга и со стеммингом по заголовкам и описаниям.
+    """
+    issues = load_issues()
+    for texts, title in ((issues.summaries, 'Заголовки'), (issues.descriptions, 'Описания')):
+        report = vocabulary_report(clean_texts(texts))
+        print(f"{title}: словарь {report['plain_vocabulary']} -> {report['analyzed_vocabulary']} терминов, "
+              f"ненулевых элементов {report['plain_nnz']} -> {report['analyzed_nnz']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Поиск дубликатов задач в Yandex Tracker.")
+    parser.add_argument('--fused', action='store_true',
+                        help="Взвешенная оценка по заголовку и описанию в одном векторном пространстве.")
+    parser.add_argument('--embedding-model', default=os.getenv('EMBEDDING_MODEL'),
+                        help="Каталог локальной модели sentence-transformers для поиска по смыслу.")
+    subparsers = parser.add_subparsers(dest='command')
+
+    dedup_parser = subparsers.add_parser('dedup', help="Поиск дубликатов по всему бэклогу.")
+    dedup_parser.add_argument('--output', '-o', help="Файл для записи пар (по умолчанию stdout).")
+    dedup_parser.add_argument('--threshold', type=float, default=0.8, help="Порог схожести.")
+    dedup_parser.add_argument('--block-size', type=int, default=1000, help="Размер блока строк.")
+    dedup_parser.add_argument('--workers', type=int, default=1, help="Количество процессов.")
+
+    clusters_parser = subparsers.add_parser('clusters', help="Кластеры дубликатов по всему бэклогу.")
+    clusters_parser.add_argument('--output', '-o', default='clusters.jsonl', help="Файл для записи кластеров.")
+    clusters_parser.add_argument('--threshold', type=float, default=0.8, help="Порог схожести.")
+    clusters_parser.add_argument('--block-size', type=int, default=1000, help="Размер блока строк.")
+    clusters_parser.add_argument('--workers', type=int, default=1, help="Количество процессов.")
+    clusters_parser.add_argument('--restart', action='store_true',
+                                 help="Начать заново, не продолжая прерванный поиск.")
+
+    check_parser = subparsers.add_parser('check', help="Пакетная проверка новых задач из файла на дубликаты.")
+    check_parser.add_argument('input', help="Файл CSV или JSON Lines с полями summary, description и id.")
+    check_parser.add_argument('--output', '-o', help="Файл для записи результата (по умолчанию stdout).")
+    check_parser.add_argument('--top-n', type=int, default=5, help="Количество похожих задач на каждую новую.")
+    check_parser.add_argument('--batch-size', type=int, default=1000, help="Количество задач в одном пакете.")
+
+    subparsers.add_parser('vocab', help="Сравнение размера словаря без стемминга и со стеммингом.")
+
+    return parser.parse_args(argv)
+
 
 if __name__ == "__main__":
+    args = parse_args()
     try:
-        interactive_main()
+        if args.command == 'dedup':
+            dedup_main(args.output, args.threshold, args.block_size, args.workers)
+        elif args.command == 'clusters':
+            clusters_main(args.output, args.threshold, args.block_size, args.workers, args.restart)
+        elif args.command == 'check':
+            check_main(args.input, args.output, args.top_n, args.batch_size)
+        elif args.command == 'vocab':
+            vocab_main()
+        else:
+            interactive_main(fused=args.fused, embedding_model=args.embedding_model)
     except KeyboardInterrupt:
         print("\nПрограмма завершена пользователем.")
         sys.exit(0)
+    finally:
+        # Метрики запуска можно сохранить в файл в формате Prometheus
+        if os.getenv('METRICS_FILE'):
+            metrics.write_prometheus(os.getenv('METRICS_FILE'))
@@ -0,0 +1,270 @@
+# metrics.py
+
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Границы корзин гистограмм задержки в секундах
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Пустой контекст, который возвращается вместо замера, когда метрики выключены
+_NO_SPAN = nullcontext()
+
+
+class Histogram:
+    """
+    Гистограмма длительностей с фиксированными границами корзин.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # Последняя корзина - для значений больше последней границы
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Оценивает квантиль линейной интерполяцией внутри корзины.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / bucket_count, self.max)
+            seen += bucket_count
+        return self.max
+
+
+class _Span:
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        if exc_type is not None:
+            self.metrics.increment(f'{self.name}.errors')
+        return False
+
+
+class Metrics:
+    """
+    Счетчики и гистограммы длительности этапов обработки запросов.
+
+    Этапы замеряются контекстным менеджером span(). Если метрики выключены, span() возвращает
+    общий пустой контекст, а increment() и observe() сразу возвращаются, поэтому
+    стоимость замеров сводится к вызову метода.
+    """
+
+    def __init__(self, enabled=True, buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self.started_at = time.time()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def span(self, name):
+        """
+        Возвращает контекстный менеджер, замеряющий длительность этапа name.
+        Если внутри этапа возникло исключение, дополнительно увеличивается счетчик '<name>.errors'.
+        """
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name)
+
+    def timed(self, name):
+        """
+        Декоратор, замеряющий каждый вызов функции как этап name.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, name, seconds):
+        """
+        Добавляет длительность этапа name в его гистограмму.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def increment(self, name, value=1):
+        """
+        Увеличивает счетчик name.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def register_gauges(self, prefix, collect):
+        """
+        Регистрирует источник текущих значений (например, статистику кэша запросов).
+
+        :param prefix: Префикс имен значений.
+        :param collect: Функция без аргументов, возвращающая словарь {имя: число}.
+        """
+        with self._lock:
+            self._gauges[prefix] = collect
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.started_at = time.time()
+
+    def snapshot(self):
+        """
+        Возвращает текущие значения метрик.
+
+        :return: Словарь с ключами 'counters' ({имя: значение}), 'histograms'
+                 ({имя: {'count', 'sum', 'p50', 'p90', 'p99', 'max', 'buckets'}}) и 'gauges' ({имя: значение}).
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {
+                name: {
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'p50': histogram.quantile(0.5),
+                    'p90': histogram.quantile(0.9),
+                    'p99': histogram.quantile(0.99),
+                    'max': histogram.max,
+                    'buckets': list(histogram.counts),
+                }
+                for name, histogram in self._histograms.items()
+            }
+            sources = list(self._gauges.items())
+        gauges = {}
+        for prefix, collect in sources:
+            for name, value in collect().items():
+                gauges[f'{prefix}.{name}'] = value
+        return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def describe(self):
+        """
+        Возвращает метрики в виде текста для вывода пользователю.
+        """
+        if not self.enabled:
+            return "Сбор метрик выключен (METRICS_ENABLED=0)."
+        snapshot = self.snapshot()
+        uptime = time.time() - self.started_at
+        lines = [f"Метрики за {uptime / 3600:.1f} ч:"]
+        if snapshot['histograms']:
+            lines.append("Этап: количество, p50 / p90 / p99 / max, мс")
+            for name, h in sorted(snapshot['histograms'].items()):
+                lines.append(f"{name}: {h['count']}, {h['p50'] * 1000:.1f} / {h['p90'] * 1000:.1f} / "
+                             f"{h['p99'] * 1000:.1f} / {h['max'] * 1000:.1f}")
+        if snapshot['counters']:
+            lines.append("Счетчики:")
+            lines.extend(f"{name}: {value}" for name, value in sorted(snapshot['counters'].items()))
+        if snapshot['gauges']:
+            lines.append("Текущие значения:")
+            lines.extend(f"{name}: {value:g}" for name, value in sorted(snapshot['gauges'].items()))
+        return '\n'.join(lines)
+
+    def to_prometheus(self, namespace='qc'):
+        """
+        Возвращает метрики в текстовом формате Prometheus.
+
+        Длительности этапов выводятся одной гистограммой <namespace>_stage_seconds с меткой stage,
+        счетчики - метрикой <namespace>_events_total с меткой event.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        if snapshot['histograms']:
+            lines.append(f'# TYPE {namespace}_stage_seconds histogram')
+            for name, h in sorted(snapshot['histograms'].items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, h['buckets']):
+                    cumulative += count
+                    lines.append(f'{namespace}_stage_seconds_bucket{{stage="{name}",le="{bound:g}"}} {cumulative}')
+                lines.append(f'{namespace}_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {h["count"]}')
+                lines.append(f'{namespace}_stage_seconds_sum{{stage="{name}"}} {h["sum"]:.6f}')
+                lines.append(f'{namespace}_stage_seconds_count{{stage="{name}"}} {h["count"]}')
+        if snapshot['counters']:
+            lines.append(f'# TYPE {namespace}_events_total counter')
+            for name, value in sorted(snapshot['counters'].items()):
+                lines.append(f'{namespace}_events_total{{event="{name}"}} {value}')
+        if snapshot['gauges']:
+            lines.append(f'# TYPE {namespace}_value gauge')
+            for name, value in sorted(snapshot['gauges'].items()):
+                lines.append(f'{namespace}_value{{name="{name}"}} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Атомарно записывает метрики в файл в формате Prometheus (например, для textfile collector).
+        """
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+def start_http_server(port, host='127.0.0.1', registry=None):
+    """
+    Запускает в фоновом потоке HTTP-сервер, отдающий метрики в формате Prometheus по пути /metrics.
+
+    :param port: Порт (0 - любой свободный).
+    :param host: Адрес. По умолчанию сервер доступен только локально.
+    :param registry: Экземпляр Metrics. По умолчанию общий экземпляр metrics.
+    :return: Экземпляр ThreadingHTTPServer; остановить сервер можно методом shutdown().
+    """
+    registry = registry if registry is not None else metrics
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.to_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+
+# Общие метрики процесса. Сбор выключается переменной окружения METRICS_ENABLED=0
+metrics = Metrics(enabled=os.getenv('METRICS_ENABLED', '1') != '0')
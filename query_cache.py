@@ -0,0 +1,99 @@
+# query_cache.py
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache:
+    """
+    LRU-кэш результатов поиска похожих задач с ограниченным временем жизни записей.
+
+    Записи привязаны к версии корпуса (отпечатку хранилища, по которому построен индекс):
+    как только приходит запрос к другой версии, все записи старой версии удаляются.
+    """
+
+    def __init__(self, max_size=1000, ttl_seconds=3600):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+
+    def _lookup(self, version, key):
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def _store(self, version, key, value):
+        with self._lock:
+            # Результат, вычисленный по уже замененной версии корпуса, не сохраняется
+            if version != self._version:
+                return
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, version, key, compute):
+        """
+        Возвращает результат из кэша или вычисляет и сохраняет его.
+
+        :param version: Версия корпуса, по которому выполняется поиск.
+        :param key: Ключ запроса (нормализованный текст запроса и параметры поиска).
+        :param compute: Функция без аргументов, вычисляющая результат при промахе.
+        :return: Результат поиска.
+        """
+        value = self._lookup(version, key)
+        if value is None:
+            value = compute()
+            self._store(version, key, value)
+        return value
+
+    def stats(self):
+        """
+        Возвращает счетчики кэша: размер, попадания, промахи, вытеснения и долю попаданий.
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+    def describe(self):
+        """
+        Возвращает счетчики кэша в виде строки для вывода пользователю.
+        """
+        stats = self.stats()
+        return (f"записей {stats['size']}, попаданий {stats['hits']}, промахов {stats['misses']} "
+                f"({stats['hit_rate']:.0%} попаданий)")
+
+
+# Общий кэш результатов для консольного режима и бота
+query_cache = QueryCache()
@@ -1,100 +1,380 @@
 # similarity_checker.py
 
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-import pandas as pd
-from text_processor import clean_text
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import numpy as np
+from scipy import sparse
+from issue_index import IssueIndex, FusedIssueIndex, make_vectorizer
+from metrics import metrics
+from text_processor import RussianAnalyzer, RUSSIAN_STOP_WORDS, clean_texts
 
-def find_similar_issues(new_title: str, new_description: str, issues_df: pd.DataFrame, top_n: int = 5):
+RESULT_COLUMNS = ['key', 'summary', 'similarity', 'found_in']
+FUSED_RESULT_COLUMNS = RESULT_COLUMNS + ['summary_similarity', 'description_similarity']
+
+# Веса полей при совмещенной оценке: точное совпадение заголовка важнее общих слов в длинном описании
+SUMMARY_WEIGHT = 0.7
+DESCRIPTION_WEIGHT = 0.3
+# Вес схожести по смыслу (векторы модели) при совмещенной с TF-IDF оценке
+EMBEDDING_WEIGHT = 0.5
+
+def find_similar_issues(new_title: str, new_description: str, issues, top_n: int = 5,
+                        index: IssueIndex = None, exact: bool = False, embeddings=None,
+                        embedding_weight: float = EMBEDDING_WEIGHT):
     """
     Находит задачи, похожие на новую, на основе анализа заголовков и описаний.
 
     :param new_title: Название новой задачи.
     :param new_description: Описание новой задачи.
-    :param issues_df: DataFrame с существующими задачами (колонки: 'key', 'summary', 'description').
+    :param issues: Существующие задачи: корпус Corpus или DataFrame (колонки: 'key', 'summary', 'description').
+                   Не изменяется.
     :param top_n: Количество самых похожих задач для вывода.
+    :param index: Предварительно построенный индекс по issues. Если не задан, строится на лету.
+    :param exact: Сравнивать запрос со всеми задачами, даже если у индекса есть приближенный индекс.
+    :param embeddings: Векторы задач индекса (EmbeddingIndex) для поиска по смыслу. Если заданы,
+                       схожесть - взвешенная сумма схожести TF-IDF и схожести векторов.
+    :param embedding_weight: Вес схожести по смыслу при заданных embeddings.
     :return: DataFrame с похожими задачами.
     """
-    if issues_df.empty:
-        return pd.DataFrame()
+    # pandas нужен только для результата поиска, поэтому импортируется при первом поиске
+    import pandas as pd
 
-    # 1. Предобработка текстов
-    cleaned_new_title = clean_text(new_title)
-    cleaned_new_description = clean_text(new_description)
-
-    issues_df['cleaned_summary'] = issues_df['summary'].apply(clean_text)
-    issues_df['cleaned_description'] = issues_df['description'].apply(clean_text)
-
-    all_similarities = []
-    
-    # 2. Поиск по Заголовкам (summary)
-    summary_corpus = list(issues_df['cleaned_summary']) + [cleaned_new_title]
-    
-    vectorizer_summary = TfidfVectorizer()
-    tfidf_summary = vectorizer_summary.fit_transform(summary_corpus)
-    
-    cosine_sim_summary = cosine_similarity(tfidf_summary[-1], tfidf_summary[:-1])
-    
-    for i, similarity in enumerate(cosine_sim_summary[0]):
-        all_similarities.append({
-            'key': issues_df.iloc[i]['key'],
-            'summary': issues_df.iloc[i]['summary'],
-            'similarity': similarity,
-            'found_in': 'заголовку'
-        })
-        
-    # 3. Поиск по Описаниям (description)
-    description_corpus = list(issues_df['cleaned_description']) + [cleaned_new_description]
-    
-    vectorizer_desc = TfidfVectorizer()
-    tfidf_desc = vectorizer_desc.fit_transform(description_corpus)
-    
-    cosine_sim_desc = cosine_similarity(tfidf_desc[-1], tfidf_desc[:-1])
-    
-    for i, similarity in enumerate(cosine_sim_desc[0]):
-        all_similarities.append({
-            'key': issues_df.iloc[i]['key'],
-            'summary': issues_df.iloc[i]['summary'],
-            'similarity': similarity,
-            'found_in': 'описанию'
-        })
-
-    # 4. Объединение и сортировка результатов
-    if not all_similarities:
+    if len(issues) == 0:
         return pd.DataFrame()
 
-    similar_issues_df = pd.DataFrame(all_similarities)
-    
-    # Удаление дубликатов по 'key', оставляя запись с наибольшим 'similarity'
-    similar_issues_df = similar_issues_df.sort_values('similarity', ascending=False).drop_duplicates('key').reset_index(drop=True)
-    
-    # Фильтрация задач с нулевой схожестью и сортировка
-    similar_issues_df = similar_issues_df[similar_issues_df['similarity'] > 0].sort_values('similarity', ascending=False)
-    
-    return similar_issues_df.head(top_n)
+    # 1. Индекс по заголовкам и описаниям (векторизаторы обучаются только на корпусе)
+    if index is None:
+        with metrics.span('search.build_index'):
+            index = IssueIndex.build(issues)
+
+    # 2. Схожесть запроса с задачами по заголовкам и описаниям: со всеми задачами
+    # или только с кандидатами из приближенного индекса
+    query_summary, query_desc = index.vectorize(new_title, new_description)
+    rows = None
+    if index.ann is not None and not exact:
+        with metrics.span('search.ann_candidates'):
+            rows = index.ann.candidates(query_summary, query_desc, n_candidates=max(index.ann.n_candidates, top_n))
+    semantic = None
+    if embeddings is not None:
+        if len(embeddings) != len(index.keys):
+            raise ValueError("Векторы задач не соответствуют индексу.")
+        with metrics.span('search.embedding'):
+            semantic = embeddings.score(new_title, new_description)
+        if rows is not None:
+            # Кандидаты приближенного индекса дополняются задачами, ближайшими по смыслу
+            rows = np.union1d(rows, _top_positions(semantic, max(index.ann.n_candidates, top_n)))
+            semantic = semantic[rows]
+    with metrics.span('search.score'):
+        cosine_sim_summary, cosine_sim_desc = index.score_vectors(query_summary, query_desc, rows)
+
+    # 3. Отбор top_n задач по наибольшей схожести из двух полей (и по смыслу, если заданы векторы)
+    with metrics.span('search.select'):
+        if semantic is None:
+            positions, best_similarity, found_in_description = select_top_matches(cosine_sim_summary,
+                                                                                  cosine_sim_desc, top_n)
+            best_similarity = best_similarity[positions]
+            found_in = np.where(found_in_description[positions], 'описанию', 'заголовку')
+        else:
+            positions, best_similarity, found_in = _select_hybrid_matches(cosine_sim_summary, cosine_sim_desc,
+                                                                          semantic, embedding_weight, top_n)
+    if rows is not None:
+        positions = rows[positions]
+
+    # 4. Формирование результата только для отобранных задач
+    return pd.DataFrame({
+        'key': index.keys[positions],
+        'summary': index.summaries[positions],
+        'similarity': best_similarity,
+        'found_in': found_in,
+    }, columns=RESULT_COLUMNS)
+
+
+def _top_positions(similarity: np.ndarray, n: int):
+    """
+    Возвращает номера n задач с наибольшей ненулевой схожестью (в произвольном порядке).
+    """
+    positions = np.flatnonzero(similarity > 0)
+    if len(positions) > n:
+        positions = positions[np.argpartition(-similarity[positions], n - 1)[:n]]
+    return positions
+
+
+def _select_hybrid_matches(sim_summary: np.ndarray, sim_desc: np.ndarray, semantic: np.ndarray,
+                           embedding_weight: float, top_n: int):
+    """
+    Выбирает top_n задач по взвешенной сумме схожести TF-IDF (максимум из заголовка и описания)
+    и схожести по смыслу.
+
+    :return: Кортеж (позиции отобранных задач по убыванию схожести, их схожесть,
+             поле совпадения: 'смыслу', если вклад схожести по смыслу больше вклада TF-IDF).
+    """
+    text_part = (1 - embedding_weight) * np.maximum(sim_summary, sim_desc)
+    semantic_part = embedding_weight * semantic
+    similarity = text_part + semantic_part
+    positions, _, _ = select_top_matches(similarity, np.zeros_like(similarity), top_n)
+    found_in = np.where(semantic_part[positions] > text_part[positions], 'смыслу',
+                        np.where(sim_desc[positions] > sim_summary[positions], 'описанию', 'заголовку'))
+    return positions, similarity[positions], found_in
+
+
+def find_similar_issues_fused(new_title: str, new_description: str, index: FusedIssueIndex, top_n: int = 5,
+                              summary_weight: float = SUMMARY_WEIGHT, description_weight: float = DESCRIPTION_WEIGHT,
+                              queue: str = None, queue_boost: float = 0.0,
+                              recency_boost: float = 0.0, recency_half_life_days: float = 90.0):
+    """
+    Находит похожие задачи по взвешенной сумме схожести заголовков и описаний в одном векторном пространстве.
+
+    Схожесть текста вычисляется одним умножением разреженной матрицы на вектор. Бусты по метаданным
+    прибавляются только к задачам с ненулевой схожестью текста, поэтому сами по себе задачу в результат не добавляют.
+
+    :param new_title: Название новой задачи.
+    :param new_description: Описание новой задачи.
+    :param index: Индекс FusedIssueIndex по существующим задачам.
+    :param top_n: Количество самых похожих задач для вывода.
+    :param summary_weight: Вес схожести заголовков.
+    :param description_weight: Вес схожести описаний.
+    :param queue: Очередь новой задачи (например, 'PLATFORM') для буста задач из той же очереди.
+    :param queue_boost: Прибавка к схожести задач из очереди queue.
+    :param recency_boost: Наибольшая прибавка к схожести недавно измененных задач.
+    :param recency_half_life_days: Возраст задачи в днях, при котором прибавка за новизну уменьшается вдвое.
+    :return: DataFrame с похожими задачами и схожестью по каждому полю.
+    """
+    import pandas as pd
+
+    total_weight = summary_weight + description_weight
+    if len(index) == 0 or total_weight <= 0:
+        return pd.DataFrame(columns=FUSED_RESULT_COLUMNS)
+
+    # 1. Взвешенная схожесть по обоим полям за одно умножение
+    with metrics.span('search.score'):
+        similarity = index.score(new_title, new_description, summary_weight / total_weight,
+                                 description_weight / total_weight)
+
+    # 2. Бусты по метаданным для задач с ненулевой схожестью текста
+    matched = np.flatnonzero(similarity > 0)
+    if queue is not None and queue_boost and queue in index.queue_names:
+        same_queue = index.queue_codes[matched] == index.queue_names.index(queue)
+        similarity[matched[same_queue]] += queue_boost
+    if recency_boost:
+        age_days = (np.datetime64('now', 'ns') - index.updated[matched]) / np.timedelta64(1, 'D')
+        boost = recency_boost * np.exp2(-np.clip(age_days, 0, None) / recency_half_life_days)
+        similarity[matched] += np.nan_to_num(boost)
+
+    # 3. Отбор top_n и разбивка схожести по полям только для отобранных задач
+    with metrics.span('search.select'):
+        positions, _, _ = select_top_matches(similarity, np.zeros_like(similarity), top_n)
+        sim_summary, sim_desc = index.field_scores(positions, new_title, new_description)
+
+    return pd.DataFrame({
+        'key': index.keys[positions],
+        'summary': index.summaries[positions],
+        'similarity': similarity[positions],
+        'found_in': np.where(sim_desc * description_weight > sim_summary * summary_weight, 'описанию', 'заголовку'),
+        'summary_similarity': sim_summary,
+        'description_similarity': sim_desc,
+    }, columns=FUSED_RESULT_COLUMNS)
+
+
+def select_top_matches(sim_summary: np.ndarray, sim_desc: np.ndarray, top_n: int):
+    """
+    Выбирает top_n задач по наибольшей схожести из заголовка и описания.
+
+    Для каждой задачи берется максимум из двух значений схожести; при равенстве
+    совпадение засчитывается по заголовку. Задачи с нулевой схожестью отбрасываются.
+
+    :param sim_summary: Схожесть запроса с заголовками задач.
+    :param sim_desc: Схожесть запроса с описаниями задач.
+    :param top_n: Количество задач для отбора.
+    :return: Кортеж (позиции отобранных задач по убыванию схожести,
+             максимальная схожесть по всем задачам, признак совпадения по описанию).
+    """
+    best_similarity = np.maximum(sim_summary, sim_desc)
+    found_in_description = sim_desc > sim_summary
+
+    if top_n <= 0:
+        return np.empty(0, dtype=np.intp), best_similarity, found_in_description
+
+    candidates = np.flatnonzero(best_similarity > 0)
+    if len(candidates) > top_n:
+        top = np.argpartition(-best_similarity[candidates], top_n - 1)[:top_n]
+        candidates = candidates[top]
+
+    # Сортировка по убыванию схожести, при равенстве - по порядку задач в корпусе
+    order = np.lexsort((candidates, -best_similarity[candidates]))
+    return candidates[order], best_similarity, found_in_description
+
+
+# Наибольшее количество значений схожести (запросы x задачи), вычисляемых за один раз
+# при пакетном поиске; ограничивает память под плотную матрицу схожести пакета
+MAX_BATCH_SCORES = 2 ** 23
+
+
+def _batch_scores(matrix, queries, n_queries: int):
+    """
+    Вычисляет схожесть всех запросов пакета с задачами по одному полю одним умножением матриц.
+
+    В умножении участвуют только термины, встречающиеся в запросах пакета.
+
+    :return: Плотная матрица (запросы x задачи).
+    """
+    if queries is None or matrix.shape[1] == 0:
+        return np.zeros((n_queries, matrix.shape[0]))
+    columns = np.unique(queries.indices)
+    scores = matrix[:, columns] @ queries[:, columns].toarray().T
+    return np.ascontiguousarray(np.asarray(scores).T)
+
+
+def find_similar_issues_batch(candidates, index: IssueIndex, top_n: int = 5, batch_size: int = 1000):
+    """
+    Находит похожие задачи сразу для многих новых задач.
+
+    Кандидаты векторизуются пакетами, и каждый пакет сравнивается со всеми задачами
+    одним умножением матриц по каждому полю. Результат совпадает с вызовом
+    find_similar_issues для каждого кандидата и отдается по мере обработки пакетов.
+
+    :param candidates: Итерируемый набор пар (название, описание) новых задач.
+    :param index: Предварительно построенный индекс по существующим задачам.
+    :param top_n: Количество самых похожих задач для каждого кандидата.
+    :param batch_size: Наибольшее количество кандидатов в одном пакете. Для больших корпусов
+                       пакет уменьшается так, чтобы матрица схожести не превышала MAX_BATCH_SCORES значений.
+    :return: Генератор списков словарей с ключами 'key', 'summary', 'similarity', 'found_in'
+             (по одному списку на кандидата, в исходном порядке).
+    """
+    batch_size = max(1, min(batch_size, MAX_BATCH_SCORES // max(len(index), 1)))
+    candidates = iter(candidates)
+    while True:
+        batch = list(islice(candidates, batch_size))
+        if not batch:
+            return
+
+        titles, descriptions = zip(*batch)
+        with metrics.span('batch.vectorize'):
+            query_summary, query_desc = index.vectorize_batch(titles, descriptions)
+        with metrics.span('batch.score'):
+            scores_summary = _batch_scores(index.tfidf_summary, query_summary, len(batch))
+            scores_desc = _batch_scores(index.tfidf_desc, query_desc, len(batch))
+        metrics.increment('batch.queries', len(batch))
+
+        for row in range(len(batch)):
+            positions, best_similarity, found_in_description = select_top_matches(
+                scores_summary[row], scores_desc[row], top_n
+            )
+            yield [
+                {
+                    'key': index.keys[position],
+                    'summary': index.summaries[position],
+                    'similarity': float(best_similarity[position]),
+                    'found_in': 'описанию' if found_in_description[position] else 'заголовку',
+                }
+                for position in positions
+            ]
+
+
+def _block_pairs(matrix, start: int, end: int, threshold: float):
+    """
+    Находит пары задач со схожестью выше порога для блока строк [start, end).
+
+    Блок умножается только на строки начиная со start, поэтому каждая пара
+    (i, j) с i < j вычисляется ровно один раз, а плотная матрица N x N не строится.
+
+    :return: Кортеж массивов (i, j, similarity) с глобальными номерами строк.
+    """
+    block = (matrix[start:end] @ matrix[start:].T).tocoo()
+    rows = block.row + start
+    cols = block.col + start
+    mask = (cols > rows) & (block.data > threshold)
+    return rows[mask], cols[mask], block.data[mask]
+
+
+_worker_matrix = None
+
 
-def calculate_similarity(df, threshold=0.8):
+def _init_pair_worker(matrix):
+    global _worker_matrix
+    _worker_matrix = matrix
+
+
+def _worker_block_pairs(start: int, end: int, threshold: float):
+    return _block_pairs(_worker_matrix, start, end, threshold)
+
+
+def iter_duplicate_pairs(tfidf_matrix, keys, threshold: float = 0.8, block_size: int = 1000, workers: int = 1):
+    """
+    Потоково находит пары задач со схожестью выше порога.
+
+    Матрица TF-IDF умножается на себя блоками по block_size строк, поэтому
+    потребление памяти ограничено размером блока, а не квадратом числа задач.
+    Пары отдаются по мере обработки блоков.
+
+    :param tfidf_matrix: Разреженная матрица TF-IDF с нормированными по L2 строками.
+    :param keys: Ключи задач в порядке строк матрицы.
+    :param threshold: Порог схожести.
+    :param block_size: Количество строк в одном блоке.
+    :param workers: Количество процессов для обработки блоков (1 - без пула процессов).
+    :return: Генератор словарей с ключами 'issue_1', 'issue_2', 'similarity'.
+    """
+    for _, (rows, cols, similarities) in iter_duplicate_blocks(tfidf_matrix, threshold, block_size, workers):
+        for i, j, similarity in zip(rows, cols, similarities):
+            yield {"issue_1": keys[i], "issue_2": keys[j], "similarity": float(similarity)}
+
+
+def iter_duplicate_blocks(tfidf_matrix, threshold: float = 0.8, block_size: int = 1000, workers: int = 1,
+                          start_row: int = 0):
+    """
+    Потоково находит пары задач со схожестью выше порога и отдает их поблочно, по порядку блоков.
+
+    После блока, заканчивающегося строкой end, найдены все пары, в которых есть задача
+    с номером меньше end: в следующих блоках обе задачи пары имеют номера не меньше end.
+
+    :param tfidf_matrix: Разреженная матрица TF-IDF с нормированными по L2 строками.
+    :param threshold: Порог схожести.
+    :param block_size: Количество строк в одном блоке.
+    :param workers: Количество процессов для обработки блоков (1 - без пула процессов).
+    :param start_row: Строка, с которой начинается обработка (например, при продолжении прерванного поиска).
+    :return: Генератор кортежей (end, (i, j, similarity)) с массивами номеров строк и схожести пар блока.
+    """
+    matrix = sparse.csr_matrix(tfidf_matrix)
+    n_rows = matrix.shape[0]
+    bounds = [(start, min(start + block_size, n_rows)) for start in range(start_row, n_rows, block_size)]
+
+    if workers <= 1:
+        for start, end in bounds:
+            yield end, _block_pairs(matrix, start, end, threshold)
+        return
+
+    # Держим в работе ограниченное число блоков, чтобы результаты не копились в памяти
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_pair_worker, initargs=(matrix,)) as executor:
+        pending = deque()
+        for start, end in bounds:
+            pending.append((end, executor.submit(_worker_block_pairs, start, end, threshold)))
+            if len(pending) >= workers * 2:
+                end, future = pending.popleft()
+                yield end, future.result()
+        while pending:
+            end, future = pending.popleft()
+            yield end, future.result()
+
+
+def calculate_similarity(df, threshold=0.8, block_size=1000, workers=1):
     """
     Вычисляет схожесть текстов задач с использованием TF-IDF и косинусного сходства.
+
+    :param df: DataFrame с задачами (колонки: 'key', 'full_text').
+    :param threshold: Порог схожести, выше которого пара считается дубликатом.
+    :param block_size: Количество строк в одном блоке при поблочном умножении матриц.
+    :param workers: Количество процессов для обработки блоков.
+    :return: Список пар задач, отсортированный по убыванию схожести.
     """
     if 'full_text' not in df.columns or df.empty:
         return []
 
-    tfidf_vectorizer = TfidfVectorizer(stop_words='english') # Можно добавить русские стоп-слова
-    tfidf_matrix = tfidf_vectorizer.fit_transform(df['full_text'])
-
-    cosine_sim_matrix = cosine_similarity(tfidf_matrix)
-    
-    duplicates = []
-    
-    # Поиск дубликатов
-    for i in range(len(cosine_sim_matrix)):
-        for j in range(i + 1, len(cosine_sim_matrix)):
-            if cosine_sim_matrix[i][j] > threshold:
-                duplicates.append({
-                    "issue_1": df.iloc[i]['key'],
-                    "issue_2": df.iloc[j]['key'],
-                    "similarity": cosine_sim_matrix[i][j]
-                })
-                
-    return sorted(duplicates, key=lambda x: x['similarity'], reverse=True)
\ No newline at end of file
+    from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+    tfidf_vectorizer = make_vectorizer(RussianAnalyzer(stop_words=RUSSIAN_STOP_WORDS | ENGLISH_STOP_WORDS))
+    # Анализатор не приводит текст к нижнему регистру, поэтому тексты очищаются так же, как при построении индекса
+    tfidf_matrix = tfidf_vectorizer.fit_transform(clean_texts(df['full_text'], workers=workers))
+
+    duplicates = list(iter_duplicate_pairs(
+        tfidf_matrix, df['key'].tolist(), threshold=threshold, block_size=block_size, workers=workers
+    ))
+
+    return sorted(duplicates, key=lambda x: x['similarity'], reverse=True)
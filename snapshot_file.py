@@ -0,0 +1,159 @@
+# snapshot_file.py
+
+import io
+import mmap
+import os
+import pickle
+import struct
+import numpy as np
+
+# Сигнатура файла снимка и выравнивание массивов в нем
+MAGIC = b'QCSNAP1\n'
+ALIGNMENT = 64
+_HEADER = struct.Struct('<QQ')
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class StringArray:
+    """
+    Неизменяемый массив строк: байты UTF-8 всех строк подряд и смещения начала каждой строки.
+
+    В отличие от массива Python-строк, хранится в двух числовых массивах, поэтому
+    в файле снимка отображается в память и не копируется в каждый процесс.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [str(value).encode('utf-8') for value in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _get(self, position):
+        return self.data[self.offsets[position]:self.offsets[position + 1]].tobytes().decode('utf-8')
+
+    def __getitem__(self, item):
+        """
+        Возвращает строку по номеру или массив строк (dtype=object) по срезу или массиву номеров.
+        """
+        if isinstance(item, (int, np.integer)):
+            if item < 0:
+                item += len(self)
+            if not 0 <= item < len(self):
+                raise IndexError(item)
+            return self._get(item)
+        positions = np.arange(len(self))[item] if isinstance(item, slice) else np.asarray(item, dtype=np.int64)
+        result = np.empty(len(positions), dtype=object)
+        result[:] = [self._get(position) for position in positions]
+        return result
+
+    def __iter__(self):
+        return (self._get(position) for position in range(len(self)))
+
+    def tolist(self):
+        return list(self)
+
+
+class _SnapshotPickler(pickle.Pickler):
+    """
+    Сохраняет числовые массивы numpy отдельно от остального объекта: в pickle остается только номер массива.
+    """
+
+    def __init__(self, file, arrays):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.arrays = arrays
+
+    def persistent_id(self, obj):
+        if type(obj) in (np.ndarray, np.memmap) and not obj.dtype.hasobject:
+            self.arrays.append(np.ascontiguousarray(obj))
+            return len(self.arrays) - 1
+        return None
+
+
+class _SnapshotUnpickler(pickle.Unpickler):
+    def __init__(self, file, arrays):
+        super().__init__(file)
+        self.arrays = arrays
+
+    def persistent_load(self, pid):
+        return self.arrays[pid]
+
+
+def dump(obj, path):
+    """
+    Атомарно сохраняет объект в файл снимка.
+
+    Объект сохраняется через pickle, а все числовые массивы numpy внутри него (в том числе
+    массивы разреженных матриц) записываются после него как есть, с выравниванием,
+    чтобы load мог отобразить их в память без копирования.
+
+    Файл сначала записывается под временным именем, затем переименовывается.
+    """
+    arrays = []
+    object_buffer = io.BytesIO()
+    _SnapshotPickler(object_buffer, arrays).dump(obj)
+    object_bytes = object_buffer.getvalue()
+
+    table, offset = [], 0
+    for array in arrays:
+        table.append((array.dtype.str, array.shape, offset))
+        offset = _align(offset + array.nbytes)
+    table_bytes = pickle.dumps(table, protocol=pickle.HIGHEST_PROTOCOL)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(_HEADER.pack(len(object_bytes), len(table_bytes)))
+            f.write(object_bytes)
+            f.write(table_bytes)
+            data_start = _align(f.tell())
+            for array, (_, _, array_offset) in zip(arrays, table):
+                f.write(b'\0' * (data_start + array_offset - f.tell()))
+                # Просмотр байтов без копирования (подходит и для dtype без буферного протокола, например datetime64)
+                f.write(array.reshape(-1).view(np.uint8))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load(path):
+    """
+    Загружает объект из файла снимка.
+
+    Числовые массивы не читаются в память, а отображаются из файла только для чтения:
+    процессы, загрузившие один и тот же файл, разделяют одну копию данных через кэш страниц ОС.
+    Файл нельзя изменять, пока объект используется; новые версии записываются в другие файлы.
+    """
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"Файл '{path}' не является файлом снимка.")
+    object_start = len(MAGIC) + _HEADER.size
+    object_size, table_size = _HEADER.unpack_from(buffer, len(MAGIC))
+    table_start = object_start + object_size
+    table = pickle.loads(buffer[table_start:table_start + table_size])
+    data_start = _align(table_start + table_size)
+
+    arrays = []
+    for dtype, shape, offset in table:
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        if count == 0:
+            array = np.empty(shape, dtype=dtype)
+        else:
+            array = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + offset).reshape(shape)
+        arrays.append(array)
+    return _SnapshotUnpickler(io.BytesIO(buffer[object_start:table_start]), arrays).load()
@@ -2,12 +2,17 @@ import os
 import telebot
 import logging
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from telebot import types
 from telebot.handler_backends import State, StatesGroup
 from telebot.custom_filters import StateFilter
 from dotenv import load_dotenv
-from main import find_similar_issues, load_issues
-from yandex_tracker import force_fetch_issues, get_cache_update_time, get_issues_count_from_cache
+from main import find_similar_issues
+from corpus_cache import corpus, refresher
+from query_cache import query_cache
+from metrics import metrics, start_http_server
 
 load_dotenv()
 
@@ -16,7 +21,20 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 
 TG_BOT_APIKEY = os.getenv('TG_BOT_APIKEY')
 
-bot = telebot.TeleBot(TG_BOT_APIKEY)
+# Количество потоков для обработчиков сообщений и для поиска похожих задач.
+# Поиск выполняется в отдельном пуле, чтобы долгий запрос одного пользователя
+# не занимал потоки, обрабатывающие сообщения остальных. Это пул потоков: очистка текста
+# и оценка схожести на Python выполняются под GIL, поэтому пул сохраняет отзывчивость
+# бота, но не добавляет параллельной вычислительной мощности на нескольких ядрах.
+BOT_WORKERS = int(os.getenv('TG_BOT_WORKERS', 4))
+SEARCH_WORKERS = int(os.getenv('TG_SEARCH_WORKERS', os.cpu_count() or 2))
+
+# Порт локального HTTP-сервера с метриками в формате Prometheus (не задан - сервер не запускается)
+METRICS_PORT = os.getenv('METRICS_PORT')
+
+# Токен проверяется при запуске бота, чтобы модуль можно было импортировать без настроек (например, в тестах)
+bot = telebot.TeleBot(TG_BOT_APIKEY or '', threaded=True, num_threads=BOT_WORKERS, validate_token=False)
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix='search')
 
 def escape_markdown(text):
     """Экранирует специальные символы для MarkdownV2."""
@@ -29,6 +47,10 @@ ALLOWED_USERS = {
     378606353: "Лилия"
 }
 
+# Пользователи, которым доступна команда /stats. Можно переопределить переменной
+# окружения TG_ADMIN_IDS (идентификаторы через запятую)
+ADMIN_USERS = {int(user_id) for user_id in os.getenv('TG_ADMIN_IDS', '112444633').split(',') if user_id.strip()}
+
 def is_allowed(message):
     user_id = message.from_user.id
     if user_id in ALLOWED_USERS:
@@ -36,6 +58,41 @@ def is_allowed(message):
     logging.warning(f"Неавторизованный доступ от пользователя с ID: {user_id}")
     return False
 
+def is_admin(message):
+    return is_allowed(message) and message.from_user.id in ADMIN_USERS
+
+class LatestRequests:
+    """
+    Учет последнего поискового запроса каждого пользователя.
+
+    Если пользователь отправил новый запрос, пока предыдущий ждет очереди или еще
+    выполняется, предыдущий считается устаревшим: он не запускается, а его результат
+    не отправляется.
+    """
+
+    def __init__(self):
+        self._latest = {}
+        self._lock = threading.Lock()
+
+    def begin(self, user_id):
+        """
+        Регистрирует новый запрос пользователя и возвращает его номер.
+        """
+        with self._lock:
+            request_id = self._latest.get(user_id, 0) + 1
+            self._latest[user_id] = request_id
+            return request_id
+
+    def is_current(self, user_id, request_id):
+        """
+        Проверяет, остается ли запрос последним для пользователя.
+        """
+        with self._lock:
+            return self._latest.get(user_id) == request_id
+
+
+latest_requests = LatestRequests()
+
 class MyStates(StatesGroup):
     search = State()
     initial = State()
@@ -59,6 +116,16 @@ def send_welcome(message):
     bot.send_message(message.chat.id, welcome_msg, reply_markup=markup)
     bot.set_state(message.from_user.id, MyStates.initial, message.chat.id)
 
+@bot.message_handler(commands=['stats'], func=is_admin)
+def send_stats(message):
+    """
+    Отправляет администратору задержки этапов поиска и загрузки, счетчики и статистику кэша запросов.
+    """
+    user_id = message.from_user.id
+    logging.info(f"Пользователь {ALLOWED_USERS.get(user_id)} ({user_id}) запросил /stats.")
+    status = f"\n{refresher.get_status()}" if refresher.is_running() else ""
+    bot.send_message(message.chat.id, f"{metrics.describe()}{status}")
+
 @bot.message_handler(state=MyStates.initial, func=lambda message: is_allowed(message) and message.text == 'Поиск дублей')
 def request_search_text(message):
     user_id = message.from_user.id
@@ -72,18 +139,28 @@ def force_update_db(message):
     user_id = message.from_user.id
     user_name = ALLOWED_USERS.get(user_id, "Неизвестный")
     logging.info(f"Пользователь {user_name} ({user_id}) нажал 'Обновить БД принудительно'.")
-    bot.send_message(message.chat.id, "Начинаю принудительное обновление базы данных...")
     markup = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
     btn_search = types.KeyboardButton('Поиск дублей')
     btn_update = types.KeyboardButton('Обновить БД принудительно')
     markup.add(btn_search, btn_update)
-    try:
-        force_fetch_issues()
-        bot.send_message(message.chat.id, "База данных успешно обновлена.", reply_markup=markup)
-    except Exception as e:
-        bot.send_message(message.chat.id, f"Произошла ошибка при обновлении: {e}", reply_markup=markup)
+
+    future, started = refresher.request_refresh()
+    if started:
+        bot.send_message(message.chat.id, "Начинаю принудительное обновление базы данных. Поиск пока работает по текущей базе.")
+    else:
+        bot.send_message(message.chat.id, f"Обновление уже выполняется ({refresher.get_status()}). Сообщу, когда оно завершится.")
+
+    def report_result(done_future):
+        error = done_future.exception()
+        if error is None:
+            bot.send_message(message.chat.id, "База данных успешно обновлена.", reply_markup=markup)
+        else:
+            bot.send_message(message.chat.id, f"Произошла ошибка при обновлении: {error}", reply_markup=markup)
+
+    future.add_done_callback(report_result)
 
 @bot.message_handler(state=MyStates.search, func=is_allowed)
+@metrics.timed('bot.handle_search_text')
 def handle_search_text(message):
     user_id = message.from_user.id
     user_name = ALLOWED_USERS.get(user_id, "Неизвестный")
@@ -96,11 +173,45 @@ def handle_search_text(message):
     summary = text_parts[0]
     description = text_parts[1] if len(text_parts) > 1 else ''
     
-    bot.reply_to(message, "Загружаю задачи из Yandex Tracker...")
-    issues = load_issues()
-    bot.reply_to(message, "Ищу похожие задачи...")
-    similar_issues = find_similar_issues(summary, description, issues)
-    
+    request_id = latest_requests.begin(user_id)
+    metrics.increment('bot.search_requests')
+    with metrics.span('telegram.send'):
+        bot.reply_to(message, "Ищу похожие задачи...")
+    search_executor.submit(run_search, message, summary, description, request_id, time.perf_counter())
+    bot.set_state(message.from_user.id, MyStates.search, message.chat.id)
+
+def run_search(message, summary, description, request_id, submitted_at=None):
+    """
+    Выполняет поиск в пуле поиска и отправляет результат, если за это время
+    пользователь не отправил более новый запрос.
+
+    :param submitted_at: Время постановки запроса в очередь (time.perf_counter()) для замера ожидания.
+    """
+    if submitted_at is not None:
+        metrics.observe('bot.queue_wait', time.perf_counter() - submitted_at)
+    user_id = message.from_user.id
+    if not latest_requests.is_current(user_id, request_id):
+        metrics.increment('bot.superseded')
+        logging.info(f"Запрос пользователя {user_id} пропущен: получен более новый запрос.")
+        return
+
+    try:
+        with metrics.span('corpus.get'):
+            snapshot = corpus.get()
+        similar_issues = find_similar_issues(summary, description, snapshot.issues, index=snapshot.index,
+                                             embeddings=snapshot.embeddings)
+        logging.info(f"Кэш запросов: {query_cache.describe()}")
+    except Exception as e:
+        metrics.increment('bot.search_errors')
+        logging.exception("Ошибка при поиске похожих задач")
+        bot.reply_to(message, f"Произошла ошибка при поиске: {e}")
+        return
+
+    if not latest_requests.is_current(user_id, request_id):
+        metrics.increment('bot.superseded')
+        logging.info(f"Результат запроса пользователя {user_id} не отправлен: получен более новый запрос.")
+        return
+
     if not similar_issues.empty:
         response = "Найдены похожие задачи:\n\n"
         for index, row in similar_issues.iterrows():
@@ -112,20 +223,28 @@ def handle_search_text(message):
     else:
         response = "Похожих задач не найдено\\."
         
-    bot.reply_to(message, response, parse_mode='MarkdownV2')
-    update_time = get_cache_update_time()
-    issues_count = get_issues_count_from_cache()
-    update_time = escape_markdown(get_cache_update_time())
-    issues_count = get_issues_count_from_cache()
-    bot.send_message(message.chat.id,
-                     f"Можете отправить следующий запрос для поиска или вернуться в главное меню, нажав /start\\.\n"
-                     f"\\(БД актуальна на: {update_time}, Записей: {issues_count}\\)", parse_mode='MarkdownV2')
-    bot.set_state(message.from_user.id, MyStates.search, message.chat.id)
+    update_time = escape_markdown(snapshot.get_update_time())
+    issues_count = snapshot.count
+    refresh_status = f", {escape_markdown(refresher.get_status())}" if refresher.is_running() else ""
+    with metrics.span('telegram.send'):
+        bot.reply_to(message, response, parse_mode='MarkdownV2')
+        bot.send_message(message.chat.id,
+                         f"Можете отправить следующий запрос для поиска или вернуться в главное меню, нажав /start\\.\n"
+                         f"\\(БД актуальна на: {update_time}, Записей: {issues_count}{refresh_status}\\)", parse_mode='MarkdownV2')
+    if submitted_at is not None:
+        metrics.observe('bot.search_response', time.perf_counter() - submitted_at)
 
 @bot.message_handler(state="*", func=lambda message: is_allowed(message) and message.text not in ['Поиск дублей', 'Обновить БД принудительно'])
 def handle_other_messages(message):
     bot.send_message(message.chat.id, "Пожалуйста, используйте кнопки для навигации.")
 
 if __name__ == '__main__':
+    if not TG_BOT_APIKEY:
+        raise ValueError("Необходимо задать TG_BOT_APIKEY в .env файле")
+    telebot.util.validate_token(TG_BOT_APIKEY)
     bot.add_custom_filter(StateFilter(bot))
+    refresher.start()
+    if METRICS_PORT:
+        start_http_server(int(METRICS_PORT))
+        logging.info(f"Метрики доступны по адресу http://127.0.0.1:{METRICS_PORT}/metrics")
     bot.polling(none_stop=True)
\ No newline at end of file
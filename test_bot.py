@@ -4,7 +4,7 @@ import pandas as pd
 
 # Импортируем функции для тестирования
 from main import find_similar_issues
-from telegram_bot import handle_text
+from telegram_bot import run_search, latest_requests, LatestRequests
 
 class TestBotLogic(unittest.TestCase):
 
@@ -61,58 +61,135 @@ class TestBotLogic(unittest.TestCase):
             mock_find_issues.assert_called_once_with(summary, description, issues_df)
 
 
+    @staticmethod
+    def make_message(user_id):
+        message = MagicMock()
+        message.from_user.id = user_id
+        message.chat.id = user_id
+        return message
+
+    @patch('telegram_bot.refresher')
+    @patch('telegram_bot.corpus')
     @patch('telegram_bot.bot') # Мокаем объект бота
-    @patch('telegram_bot.load_issues') # Мокаем загрузку задач
     @patch('telegram_bot.find_similar_issues') # Мокаем поиск похожих задач
-    def test_handle_text_with_similar_issues(self, mock_find_similar_issues, mock_load_issues, mock_bot):
+    def test_run_search_with_similar_issues(self, mock_find_similar_issues, mock_bot, mock_corpus, mock_refresher):
         """
-        Тест для обработчика сообщений handle_text, когда найдены похожие задачи.
+        Тест для поиска в пуле поиска run_search, когда найдены похожие задачи.
         """
         # 1. Настраиваем моки
-        # Мок для find_similar_issues
-        mock_find_similar_issues.return_value = [
-            {'key': 'SIMILAR-1', 'summary': 'Очень похожая задача', 'link': 'http://similar.com/1'}
-        ]
-        # Мок для load_issues
-        mock_load_issues.return_value = pd.DataFrame() # Возвращаем пустой DataFrame, т.к. find_similar_issues уже замокана
+        mock_find_similar_issues.return_value = pd.DataFrame({
+            'key': ['SIMILAR-1'], 'summary': ['Очень похожая задача'], 'similarity': [0.5], 'found_in': ['заголовку'],
+        })
+        mock_refresher.is_running.return_value = False
+        snapshot = mock_corpus.get.return_value
+        snapshot.get_update_time.return_value = '01.01.2024 10:00'
 
-        # 2. Создаем мок-сообщение от пользователя
-        mock_message = MagicMock()
-        mock_message.text = 'Новая задача\nОписание новой задачи'
+        # 2. Создаем мок-сообщение от пользователя и регистрируем запрос
+        mock_message = self.make_message(1001)
+        request_id = latest_requests.begin(1001)
 
         # 3. Вызываем обработчик
-        handle_text(mock_message)
+        run_search(mock_message, 'Новая задача', 'Описание новой задачи', request_id)
 
         # 4. Проверяем, что бот отправил правильный ответ
+        mock_find_similar_issues.assert_called_once_with('Новая задача', 'Описание новой задачи',
+                                                         snapshot.issues, index=snapshot.index,
+                                                         embeddings=snapshot.embeddings)
         expected_response = (
             "Найдены похожие задачи:\n\n"
-            "[SIMILAR-1](http://similar.com/1) - Очень похожая задача\n"
+            "[SIMILAR\\-1](https://tracker.yandex.ru/SIMILAR-1) \\- Очень похожая задача \\(Схожесть: 50\\.00%\\)\n"
         )
-        mock_bot.reply_to.assert_called_once_with(mock_message, expected_response, parse_mode='Markdown')
+        mock_bot.reply_to.assert_called_once_with(mock_message, expected_response, parse_mode='MarkdownV2')
 
 
+    @patch('telegram_bot.refresher')
+    @patch('telegram_bot.corpus')
     @patch('telegram_bot.bot')
-    @patch('telegram_bot.load_issues')
     @patch('telegram_bot.find_similar_issues')
-    def test_handle_text_no_similar_issues(self, mock_find_similar_issues, mock_load_issues, mock_bot):
+    def test_run_search_no_similar_issues(self, mock_find_similar_issues, mock_bot, mock_corpus, mock_refresher):
         """
-        Тест для обработчика сообщений handle_text, когда похожих задач не найдено.
+        Тест для поиска в пуле поиска run_search, когда похожих задач не найдено.
         """
         # 1. Настраиваем моки
-        mock_find_similar_issues.return_value = [] # Возвращаем пустой список
-        mock_load_issues.return_value = pd.DataFrame()
+        mock_find_similar_issues.return_value = pd.DataFrame()
+        mock_refresher.is_running.return_value = False
+        mock_corpus.get.return_value.get_update_time.return_value = '01.01.2024 10:00'
 
         # 2. Создаем мок-сообщение
-        mock_message = MagicMock()
-        mock_message.text = 'Уникальная задача\nНи на что не похожа'
+        mock_message = self.make_message(1002)
+        request_id = latest_requests.begin(1002)
 
         # 3. Вызываем обработчик
-        handle_text(mock_message)
+        run_search(mock_message, 'Уникальная задача', 'Ни на что не похожа', request_id)
 
         # 4. Проверяем, что бот отправил правильный ответ
-        expected_response = "Похожих задач не найдено."
-        mock_bot.reply_to.assert_called_once_with(mock_message, expected_response, parse_mode='Markdown')
+        expected_response = "Похожих задач не найдено\\."
+        mock_bot.reply_to.assert_called_once_with(mock_message, expected_response, parse_mode='MarkdownV2')
+
+
+    @patch('telegram_bot.corpus')
+    @patch('telegram_bot.bot')
+    @patch('telegram_bot.find_similar_issues')
+    def test_run_search_superseded(self, mock_find_similar_issues, mock_bot, mock_corpus):
+        """
+        Устаревший запрос не выполняется, если пользователь уже отправил новый.
+        """
+        mock_message = self.make_message(1003)
+        request_id = latest_requests.begin(1003)
+        latest_requests.begin(1003)
+
+        run_search(mock_message, 'Старый запрос', '', request_id)
+
+        mock_find_similar_issues.assert_not_called()
+        mock_bot.reply_to.assert_not_called()
+
+
+    @patch('telegram_bot.corpus')
+    @patch('telegram_bot.bot')
+    @patch('telegram_bot.find_similar_issues')
+    def test_run_search_superseded_during_search(self, mock_find_similar_issues, mock_bot, mock_corpus):
+        """
+        Результат не отправляется, если новый запрос пришел, пока выполнялся поиск.
+        """
+        mock_message = self.make_message(1004)
+        request_id = latest_requests.begin(1004)
+
+        def search_superseded(*args, **kwargs):
+            latest_requests.begin(1004)
+            return pd.DataFrame()
+
+        mock_find_similar_issues.side_effect = search_superseded
+
+        run_search(mock_message, 'Старый запрос', '', request_id)
+
+        mock_find_similar_issues.assert_called_once()
+        mock_bot.reply_to.assert_not_called()
+
+
+class TestLatestRequests(unittest.TestCase):
+
+    def test_new_request_supersedes_previous(self):
+        """
+        Последним считается только самый новый запрос пользователя.
+        """
+        requests = LatestRequests()
+        first = requests.begin(1)
+        self.assertTrue(requests.is_current(1, first))
+        second = requests.begin(1)
+        self.assertFalse(requests.is_current(1, first))
+        self.assertTrue(requests.is_current(1, second))
+
+    def test_users_are_independent(self):
+        """
+        Запрос одного пользователя не вытесняет запросы других.
+        """
+        requests = LatestRequests()
+        first = requests.begin(1)
+        other = requests.begin(2)
+        self.assertTrue(requests.is_current(1, first))
+        self.assertTrue(requests.is_current(2, other))
+        self.assertFalse(requests.is_current(3, first))
 
 
 if __name__ == '__main__':
-    unittest.main(argv=['first-arg-is-ignored'], exit=False)
\ No newline at end of file
+    unittest.main(argv=['first-arg-is-ignored'], exit=False)
@@ -0,0 +1,1096 @@
+import json
+import os
+import pickle
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import types
+import unittest
+from unittest.mock import patch
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from issue_index import IssueIndex, FusedIssueIndex, QueryVectorizer, load_or_build_index, get_index_path, make_vectorizer, vocabulary_report
+from issue_store import IssueStore
+from ann_index import AnnIndex
+from query_cache import QueryCache
+from metrics import Metrics, Histogram, start_http_server
+import snapshot_file
+from snapshot_file import StringArray
+from urllib.request import urlopen
+from corpus import Corpus
+from corpus_cache import CorpusHolder, RefreshScheduler
+from incremental_index import IncrementalIssueIndex
+from duplicate_clusters import write_duplicate_clusters, get_state_path
+from embedding_index import EmbeddingIndex
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+from sklearn.metrics.pairwise import cosine_similarity
+from text_processor import clean_text, clean_texts, RussianAnalyzer, RUSSIAN_STOP_WORDS, stem_russian
+import benchmark
+from similarity_checker import find_similar_issues, find_similar_issues_batch, find_similar_issues_fused, select_top_matches, calculate_similarity, iter_duplicate_pairs, iter_duplicate_blocks
+
+
+def make_issues_df():
+    return pd.DataFrame({
+        'key': ['TEST-1', 'TEST-2', 'TEST-3'],
+        'summary': [
+            'Ошибка при авторизации пользователя',
+            'Не работает кнопка "Сохранить"',
+            'Проблема с отображением профиля'
+        ],
+        'description': [
+            'Пользователь не может войти в систему.',
+            'Кнопка неактивна после заполнения формы.',
+            'Аватар пользователя не загружается.'
+        ]
+    })
+
+
+class TestIssueIndex(unittest.TestCase):
+
+    def test_find_similar_issues_uses_prebuilt_index(self):
+        """
+        Поиск по готовому индексу дает тот же результат, что и поиск с построением индекса на лету.
+        """
+        issues_df = make_issues_df()
+        index = IssueIndex.build(issues_df)
+
+        result = find_similar_issues('Ошибка авторизации', 'не может войти', issues_df, index=index)
+        expected = find_similar_issues('Ошибка авторизации', 'не может войти', issues_df)
+
+        self.assertEqual(result.iloc[0]['key'], 'TEST-1')
+        pd.testing.assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True))
+        # Исходный DataFrame не должен изменяться
+        self.assertListEqual(list(issues_df.columns), ['key', 'summary', 'description'])
+
+    def test_empty_descriptions(self):
+        """
+        Индекс строится, даже если все описания пустые.
+        """
+        issues_df = make_issues_df()
+        issues_df['description'] = ''
+        index = IssueIndex.build(issues_df)
+
+        sim_summary, sim_desc = index.score('кнопка сохранить', 'любое описание')
+        self.assertEqual(sim_desc.max(), 0)
+        self.assertEqual(sim_summary.argmax(), 1)
+
+    def test_load_or_build_index_persists_next_to_cache(self):
+        """
+        Индекс сохраняется рядом с хранилищем и перестраивается после его обновления.
+        """
+        issues_df = make_issues_df()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, 'issues.db')
+            store = IssueStore(cache_file)
+            store.replace_all(issues_df)
+
+            index = load_or_build_index(store.read_issues(), cache_file=cache_file)
+            self.assertTrue(os.path.exists(get_index_path(cache_file)))
+
+            reloaded = load_or_build_index(store.read_issues(), cache_file=cache_file)
+            self.assertEqual(reloaded.source, index.source)
+            self.assertListEqual(list(reloaded.keys), list(index.keys))
+
+            store.apply_changes(issues_df.head(0), removed_keys=['TEST-3'])
+            rebuilt = load_or_build_index(store.read_issues(), cache_file=cache_file)
+            self.assertNotEqual(rebuilt.source, index.source)
+            self.assertEqual(len(rebuilt), 2)
+
+    def test_query_vectorizer_matches_sklearn(self):
+        """
+        Векторизатор индекса дает те же TF-IDF векторы, что и обученный TfidfVectorizer.
+        """
+        texts = clean_texts(make_synthetic_issues_df(300)['description'])
+        vectorizer = make_vectorizer()
+        vectorizer.fit(texts[:200])
+        queries = texts[200:] + ['', 'слово вне словаря']
+        expected = vectorizer.transform(queries)
+        result = QueryVectorizer.from_fitted(vectorizer).transform(queries)
+        np.testing.assert_array_equal(result.indptr, expected.indptr)
+        np.testing.assert_array_equal(result.indices, expected.indices)
+        np.testing.assert_allclose(result.data, expected.data)
+
+    def test_saved_index_serves_without_sklearn(self):
+        """
+        Модули импортируются без настроек доступа и без pandas, а сохраненный индекс загружается
+        и обслуживает запросы без импорта scikit-learn и клиента Yandex Tracker.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, 'issues.db')
+            store = IssueStore(cache_file)
+            store.replace_all(make_issues_df())
+            load_or_build_index(store.read_issues(), cache_file=cache_file)
+
+            script = (
+                "import sys\n"
+                "import telegram_bot\n"
+                "from corpus_cache import CorpusHolder\n"
+                "from main import find_similar_issues\n"
+                "assert 'pandas' not in sys.modules\n"
+                f"snapshot = CorpusHolder({cache_file!r}).get()\n"
+                "result = find_similar_issues('Ошибка авторизации', '', snapshot.issues, index=snapshot.index)\n"
+                "assert result.iloc[0]['key'] == 'TEST-1', result\n"
+                "loaded = [name for name in sys.modules if name.startswith(('sklearn', 'yandex_tracker_client'))]\n"
+                "assert not loaded, loaded\n"
+            )
+            env = {name: value for name, value in os.environ.items()
+                   if name not in ('TG_BOT_APIKEY', 'YANDEX_TRACKER_TOKEN', 'YA_TRACKER_ORG_ID')}
+            completed = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       env=env, capture_output=True, text=True)
+            self.assertEqual(completed.returncode, 0, completed.stderr)
+
+
+class TestSnapshotFile(unittest.TestCase):
+    def test_round_trip_maps_arrays_read_only(self):
+        """
+        Числовые массивы и разреженные матрицы загружаются из снимка без копирования и только для чтения.
+        """
+        matrix = sparse.random(30, 20, density=0.2, format='csr', random_state=0)
+        obj = {
+            'matrix': matrix,
+            'keys': StringArray.from_strings(['PLATFORM-1', 'Задача', '']),
+            'updated': np.array(['2024-01-01'], dtype='datetime64[ns]'),
+            'empty': np.zeros((0, 3)),
+            'names': ['PLATFORM', 'PLATFORMUI'],
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'test.snap')
+            snapshot_file.dump(obj, path)
+            loaded = snapshot_file.load(path)
+
+            self.assertEqual((loaded['matrix'] != matrix).nnz, 0)
+            self.assertFalse(loaded['matrix'].data.flags.writeable)
+            self.assertFalse(loaded['matrix'].data.flags.owndata)
+            np.testing.assert_allclose(loaded['matrix'] @ np.ones(20), matrix @ np.ones(20))
+            self.assertListEqual(list(loaded['keys']), ['PLATFORM-1', 'Задача', ''])
+            self.assertListEqual(list(loaded['keys'][np.array([1, 0])]), ['Задача', 'PLATFORM-1'])
+            self.assertEqual(loaded['keys'][np.int64(-1)], '')
+            np.testing.assert_array_equal(loaded['updated'], obj['updated'])
+            self.assertEqual(loaded['empty'].shape, (0, 3))
+            self.assertListEqual(loaded['names'], obj['names'])
+            self.assertListEqual(os.listdir(tmp_dir), ['test.snap'])
+
+    def test_new_store_version_publishes_new_file(self):
+        """
+        Индекс новой версии хранилища публикуется в новый файл; старый индекс, уже загруженный
+        процессом, продолжает работать, а более ранние версии удаляются.
+        """
+        issues_df = make_issues_df()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, 'issues.db')
+            store = IssueStore(cache_file)
+            store.replace_all(issues_df)
+            paths = []
+            indexes = []
+            for removed in ([], ['TEST-3'], ['TEST-2']):
+                store.apply_changes(issues_df.head(0), removed_keys=removed)
+                indexes.append(load_or_build_index(store.read_issues(), cache_file=cache_file))
+                paths.append(get_index_path(cache_file, source=indexes[-1].source))
+
+            self.assertEqual(len(set(paths)), 3)
+            self.assertFalse(os.path.exists(paths[0]))
+            self.assertTrue(os.path.exists(paths[1]) and os.path.exists(paths[2]))
+            reloaded = IssueIndex.load(paths[1])
+            self.assertListEqual(list(reloaded.keys), ['TEST-1', 'TEST-2'])
+            self.assertEqual(find_similar_issues('кнопка сохранить', '', issues_df, index=reloaded).iloc[0]['key'], 'TEST-2')
+
+
+class TestIssueStore(unittest.TestCase):
+
+    def test_upsert_and_metadata(self):
+        """
+        Хранилище обновляет задачи по ключу, увеличивает версию и считает задачи без их загрузки.
+        """
+        issues_df = make_issues_df()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = IssueStore(os.path.join(tmp_dir, 'issues.db'))
+            self.assertEqual(store.count(), 0)
+            self.assertIsNone(store.get_refreshed_at())
+
+            store.replace_all(issues_df, last_updated='2024-01-01T00:00:00+00:00')
+            self.assertEqual(store.count(), 3)
+            self.assertEqual(store.get_version(), 1)
+
+            changed_df = pd.DataFrame({
+                'key': ['TEST-2', 'TEST-4'],
+                'summary': ['Кнопка "Сохранить" не нажимается', 'Новая задача'],
+                'description': ['', None],
+            })
+            store.apply_changes(changed_df, removed_keys=['TEST-1'], last_updated='2024-01-02T00:00:00+00:00')
+
+            result = store.read_issues().set_index('key')
+            self.assertListEqual(sorted(result.index), ['TEST-2', 'TEST-3', 'TEST-4'])
+            self.assertEqual(result.loc['TEST-2', 'summary'], 'Кнопка "Сохранить" не нажимается')
+            self.assertEqual(result.loc['TEST-4', 'description'], '')
+            self.assertEqual(store.get_version(), 2)
+            self.assertEqual(store.get_meta('last_updated'), '2024-01-02T00:00:00+00:00')
+            self.assertIsNotNone(store.get_refreshed_at())
+
+
+class TestCorpus(unittest.TestCase):
+
+    def test_matches_dataframe(self):
+        """
+        Корпус из хранилища содержит те же задачи, что и DataFrame, и занимает меньше памяти.
+        """
+        issues_df = benchmark.generate_issues(500, seed=3)
+        issues_df.loc[7, 'description'] = None
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = IssueStore(os.path.join(tmp_dir, 'issues.db'))
+            store.replace_all(issues_df)
+            frame = store.read_issues()
+            corpus = store.read_corpus()
+
+        self.assertEqual(len(corpus), len(frame))
+        self.assertListEqual(corpus.keys.tolist(), frame['key'].tolist())
+        self.assertListEqual(list(corpus.summaries), frame['summary'].tolist())
+        # Описания сжаты блоками: проверяем и последовательное чтение, и обращение по номеру через границу блока
+        self.assertListEqual(list(corpus.descriptions), frame['description'].tolist())
+        for position in (0, 63, 64, 65, 499, -1):
+            self.assertEqual(corpus.description(position), frame['description'].iloc[position])
+        self.assertEqual(corpus.description(7), '')
+        self.assertListEqual([corpus.queue_names[code] for code in corpus.queue_codes],
+                             [key.split('-')[0] for key in frame['key']])
+        self.assertLess(corpus.nbytes, frame.memory_usage(deep=True).sum() / 2)
+
+    def test_search_does_not_modify_corpus(self):
+        """
+        Поиск по корпусу не изменяет его, а индекс вместе с корпусом загружается без чтения хранилища.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, 'issues.db')
+            store = IssueStore(cache_file)
+            store.replace_all(make_issues_df())
+            index = load_or_build_index(store.read_corpus, cache_file=cache_file)
+            corpus = index.corpus
+            summaries = list(corpus.summaries)
+
+            result = find_similar_issues('кнопка сохранить', '', corpus, index=index)
+            self.assertEqual(result.iloc[0]['key'], 'TEST-2')
+            self.assertListEqual(list(corpus.summaries), summaries)
+
+            def read_corpus():
+                raise AssertionError("Хранилище не должно читаться")
+            loaded = load_or_build_index(read_corpus, cache_file=cache_file)
+            self.assertListEqual(loaded.corpus.keys.tolist(), ['TEST-1', 'TEST-2', 'TEST-3'])
+            self.assertEqual(loaded.corpus.description(1), 'Кнопка неактивна после заполнения формы.')
+
+
+class TestCorpusHolder(unittest.TestCase):
+
+    def test_snapshot_reloaded_only_on_store_change(self):
+        """
+        Снимок корпуса переиспользуется, пока не изменится версия хранилища.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, 'issues.db')
+            store = IssueStore(cache_file)
+            store.replace_all(make_issues_df())
+            holder = CorpusHolder(cache_file=cache_file)
+
+            snapshot = holder.get()
+            self.assertIs(holder.get(), snapshot)
+            self.assertEqual(snapshot.count, 3)
+
+            store.apply_changes(make_issues_df().head(0), removed_keys=['TEST-1'])
+            new_snapshot = holder.reload()
+            self.assertIsNot(new_snapshot, snapshot)
+            self.assertIs(holder.get(), new_snapshot)
+            self.assertEqual(new_snapshot.count, 2)
+            self.assertEqual(len(new_snapshot.index), 2)
+            # Старый снимок остается целым для запросов, которые уже с ним работают
+            self.assertEqual(snapshot.count, 3)
+
+    def test_get_does_not_wait_for_rebuild(self):
+        """
+        Пока новый снимок строится, запросы сразу получают текущий снимок.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, 'issues.db')
+            store = IssueStore(cache_file)
+            store.replace_all(make_issues_df())
+            holder = CorpusHolder(cache_file=cache_file)
+            snapshot = holder.get()
+
+            release = threading.Event()
+            started = threading.Event()
+
+            def slow_build(*args, **kwargs):
+                started.set()
+                release.wait(5)
+                return load_or_build_index(*args, **kwargs)
+
+            store.replace_all(make_issues_df().head(2))
+            with patch('corpus_cache.load_or_build_index', side_effect=slow_build):
+                self.assertIs(holder.get(), snapshot)
+                self.assertTrue(started.wait(5))
+                self.assertIs(holder.get(), snapshot)
+                future = holder.request_reload()
+                release.set()
+                new_snapshot = future.result(timeout=5)
+            self.assertEqual(new_snapshot.count, 2)
+            self.assertIs(holder.get(), new_snapshot)
+
+
+class TestRefreshScheduler(unittest.TestCase):
+
+    def test_refresh_runs_in_background_and_is_merged(self):
+        """
+        Пока идет обновление, поиск обслуживается старым снимком, а повторные запросы
+        на обновление присоединяются к уже выполняющемуся.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, 'issues.db')
+            store = IssueStore(cache_file)
+            store.replace_all(make_issues_df())
+            holder = CorpusHolder(cache_file=cache_file, cache_hours=0)
+            scheduler = RefreshScheduler(holder)
+            holder.refresher = scheduler
+            snapshot = holder.reload()
+
+            release = threading.Event()
+            calls = []
+
+            def refresh_store(target, full=False):
+                calls.append(full)
+                release.wait(5)
+                target.apply_changes(make_issues_df().head(0), removed_keys=['TEST-1'])
+
+            fake_tracker = types.ModuleType('yandex_tracker')
+            fake_tracker.refresh_store = refresh_store
+            with patch.dict(sys.modules, {'yandex_tracker': fake_tracker}):
+                future, started = scheduler.request_refresh()
+                self.assertTrue(started)
+                self.assertIs(holder.get(), snapshot)
+                same_future, started_again = scheduler.request_refresh()
+                self.assertFalse(started_again)
+                self.assertIs(same_future, future)
+                self.assertTrue(scheduler.is_running())
+
+                release.set()
+                new_snapshot = future.result(timeout=5)
+
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(new_snapshot.count, 2)
+            self.assertFalse(scheduler.is_running())
+            self.assertEqual(scheduler.get_status(), "обновление не выполняется")
+
+
+def reference_clean_text(text):
+    """
+    Прежняя реализация очистки: четыре последовательных re.sub.
+    """
+    if not isinstance(text, str):
+        return ""
+    text = text.lower()
+    text = re.sub(r'https?://\S+|www\.\S+', ' ', text)
+    text = re.sub(r'<.*?>', ' ', text)
+    text = re.sub(r'[^a-zа-я0-9\s]', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+class TestCleanText(unittest.TestCase):
+
+    def test_matches_reference_implementation(self):
+        """
+        Очистка дает точно такой же результат, как прежняя реализация.
+        """
+        rng = np.random.default_rng(3)
+        alphabet = list("abcXYZабвЁёЖ 09\t\n<>/:.-_\u00a0\u0663ßİ") + ['<b>', '</a>', 'http://x.ru/y', 'www.ru']
+        texts = [''.join(rng.choice(alphabet, size=rng.integers(0, 40))) for _ in range(2000)] + [None, 42, '']
+        expected = [reference_clean_text(text) for text in texts]
+
+        self.assertListEqual([clean_text(text) for text in texts], expected)
+        self.assertListEqual(clean_texts(texts), expected)
+
+
+class TestRussianAnalyzer(unittest.TestCase):
+
+    def test_stemming(self):
+        """
+        Словоформы сводятся к одной основе, латинские слова не изменяются.
+        """
+        self.assertEqual(len({stem_russian(w) for w in ['авторизации', 'авторизация', 'авторизацией']}), 1)
+        self.assertEqual(stem_russian('ёлками'), 'елк')
+        self.assertEqual(stem_russian('красивейшая'), 'красив')
+        self.assertEqual(stem_russian('длинный'), 'длин')
+        self.assertEqual(stem_russian('login'), 'login')
+
+    def test_analyzer_removes_stop_words_and_caches_stems(self):
+        """
+        Анализатор убирает стоп-слова и запоминает основы слов; кэш не попадает в pickle.
+        """
+        analyzer = RussianAnalyzer()
+        self.assertListEqual(analyzer('ошибка при авторизации и входе'), ['ошибк', 'авторизац', 'вход'])
+        with patch('text_processor.stem_russian') as mock_stem:
+            analyzer('ошибка авторизации')
+            mock_stem.assert_not_called()
+        self.assertEqual(pickle.loads(pickle.dumps(analyzer))._stems, {})
+
+    def test_stem_cache_is_bounded(self):
+        """
+        Кэш основ не растет больше MAX_CACHED_STEMS слов, а основы после очистки не меняются.
+        """
+        analyzer = RussianAnalyzer()
+        words = ['ошибка', 'авторизации', 'входе', 'пользователя', 'сервера']
+        with patch('text_processor.MAX_CACHED_STEMS', 2):
+            result = analyzer(' '.join(words))
+            self.assertLessEqual(len(analyzer._stems), 2)
+        self.assertListEqual(result, [stem_russian(word) for word in words])
+
+    def test_vocabulary_report(self):
+        """
+        Стемминг уменьшает словарь.
+        """
+        report = vocabulary_report(['ошибка авторизации', 'ошибки авторизация', 'ошибкой ошибки авторизацией'])
+        self.assertEqual(report['plain_vocabulary'], 6)
+        self.assertEqual(report['analyzed_vocabulary'], 2)
+        self.assertLess(report['analyzed_nnz'], report['plain_nnz'])
+
+
+def make_synthetic_issues_df(n_issues, seed=0):
+    words = ['ошибка', 'кнопка', 'форма', 'профиль', 'вход', 'отчет', 'экспорт', 'фильтр', 'сервис', 'очередь',
+             'задача', 'поле', 'таблица', 'импорт', 'права', 'роль', 'пароль', 'окно', 'список', 'поиск']
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'key': [f'TEST-{i}' for i in range(n_issues)],
+        'summary': [' '.join(rng.choice(words, size=3)) + f' модуль{i % 50}' for i in range(n_issues)],
+        'description': [' '.join(rng.choice(words, size=8)) for _ in range(n_issues)],
+    })
+
+
+class TestAnnIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.issues_df = make_synthetic_issues_df(400)
+        self.index = IssueIndex.build(self.issues_df)
+
+    def test_full_probe_matches_exact_search(self):
+        """
+        При просмотре всех кластеров приближенный поиск совпадает с точным.
+        """
+        self.index.ann = AnnIndex.build(self.index, n_components=16, n_lists=10, n_candidates=len(self.index))
+        self.index.ann.n_probe = self.index.ann.n_lists
+        for i in range(0, 400, 37):
+            title, description = self.issues_df['summary'][i], self.issues_df['description'][i]
+            approximate = find_similar_issues(title, description, self.issues_df, index=self.index)
+            exact = find_similar_issues(title, description, self.issues_df, index=self.index, exact=True)
+            pd.testing.assert_frame_equal(approximate, exact)
+
+    def test_finds_existing_issue(self):
+        """
+        Приближенный поиск с настройками по умолчанию находит задачу по ее собственному тексту.
+        """
+        self.index.ann = AnnIndex.build(self.index, n_components=16)
+        for i in range(0, 400, 23):
+            result = find_similar_issues(self.issues_df['summary'][i], self.issues_df['description'][i],
+                                         self.issues_df, index=self.index)
+            self.assertEqual(result.iloc[0]['key'], f'TEST-{i}')
+
+    def test_empty_query(self):
+        """
+        Запрос без известных слов не дает кандидатов.
+        """
+        self.index.ann = AnnIndex.build(self.index, n_components=16)
+        result = find_similar_issues('zzz', '', self.issues_df, index=self.index)
+        self.assertTrue(result.empty)
+
+
+class TestIncrementalIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.issues_df = make_synthetic_issues_df(300)
+        self.changed_df = pd.DataFrame({
+            'key': ['TEST-3', 'NEW-1', 'NEW-2'],
+            'summary': ['квазар не открывается', self.issues_df['summary'][10] + ' квазар', 'пульсар пульсар'],
+            'description': ['', self.issues_df['description'][10] + ' квазар', None],
+        })
+        self.removed = ['TEST-5', 'TEST-7']
+
+    def assert_same_results(self, index, expected_index, issues_df):
+        queries = [('квазар', 'пульсар'), (self.issues_df['summary'][3], self.issues_df['description'][3]),
+                   (self.issues_df['summary'][10], self.issues_df['description'][10])]
+        for title, description in queries:
+            result = find_similar_issues(title, description, issues_df, index=index, top_n=10)
+            expected = find_similar_issues(title, description, issues_df, index=expected_index, top_n=10)
+            self.assertListEqual(result['key'].tolist(), expected['key'].tolist())
+            np.testing.assert_allclose(result['similarity'], expected['similarity'])
+        for result, expected in zip(find_similar_issues_batch(queries, index), find_similar_issues_batch(queries, expected_index)):
+            self.assertListEqual([match['key'] for match in result], [match['key'] for match in expected])
+
+    def test_matches_full_rebuild(self):
+        """
+        Индекс, обновленный по изменениям (с новыми терминами и пересчетом IDF), дает те же результаты,
+        что и индекс, построенный заново, а исходный индекс не изменяется.
+        """
+        index = IssueIndex.build(self.issues_df)
+        updated = IncrementalIssueIndex.from_index(index).apply_changes(Corpus.from_frame(self.changed_df), self.removed)
+        updated = updated.apply_changes(Corpus.from_frame(self.changed_df.tail(1).assign(summary='пульсар квазар')), ['TEST-8'])
+
+        final_df = pd.concat([
+            self.issues_df[~self.issues_df['key'].isin(self.removed + ['TEST-3', 'TEST-8'])],
+            self.changed_df.head(2), self.changed_df.tail(1).assign(summary='пульсар квазар', description=''),
+        ])
+        self.assertEqual(len(updated), len(final_df))
+        self.assertEqual(updated.pending_changes, 7)
+        self.assertEqual(len(index), 300)
+        self.assert_same_results(updated, IssueIndex.build(final_df), final_df)
+
+        # Приближенный индекс не предлагает удаленные задачи и всегда предлагает измененные
+        index.ann = AnnIndex.build(index, n_components=16, n_lists=10, n_candidates=300)
+        index.ann.n_probe = index.ann.n_lists
+        updated = IncrementalIssueIndex.from_index(index).apply_changes(Corpus.from_frame(self.changed_df), self.removed)
+        for title, description in (('квазар не открывается', ''), (self.issues_df['summary'][5], self.issues_df['description'][5])):
+            approximate = find_similar_issues(title, description, final_df, index=updated, top_n=20)
+            exact = find_similar_issues(title, description, final_df, index=updated, top_n=20, exact=True)
+            pd.testing.assert_frame_equal(approximate, exact)
+            self.assertNotIn('TEST-5', approximate['key'].tolist())
+        self.assertEqual(find_similar_issues('квазар не открывается', '', final_df, index=updated)['key'][0], 'TEST-3')
+
+    def test_holder_applies_store_changes(self):
+        """
+        После точечного обновления хранилища индекс обновляется по журналу изменений без перестроения,
+        а сжатие перестраивает его с тем же результатом. После полной замены задач индекс перестраивается.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, 'issues.db')
+            store = IssueStore(cache_file)
+            store.replace_all(self.issues_df)
+            holder = CorpusHolder(cache_file=cache_file)
+            version = holder.get().version
+
+            store.apply_changes(self.changed_df, removed_keys=self.removed)
+            changed, removed = store.read_changes(version)
+            self.assertListEqual(changed.keys.tolist(), ['TEST-3', 'NEW-1', 'NEW-2'])
+            self.assertListEqual(removed, self.removed)
+            with patch('corpus_cache.load_or_build_index', side_effect=AssertionError("Индекс не должен перестраиваться")):
+                snapshot = holder.reload()
+            self.assertIsInstance(snapshot.index, IncrementalIssueIndex)
+            self.assertEqual(snapshot.count, 300)
+
+            compacted = holder.compact()
+            self.assertNotIsInstance(compacted.index, IncrementalIssueIndex)
+            self.assertEqual(compacted.source, snapshot.source)
+            self.assert_same_results(snapshot.index, compacted.index, store.read_issues())
+
+            store.replace_all(self.issues_df)
+            self.assertIsNone(store.read_changes(snapshot.version))
+            self.assertNotIsInstance(holder.reload().index, IncrementalIssueIndex)
+
+
+class ConceptEncoder:
+    """
+    Детерминированная модель для тестов: каждая координата вектора - количество слов одного понятия в тексте.
+    """
+
+    name = 'concepts'
+    CONCEPTS = [('логин', 'авторизац', 'войти', 'зайти'), ('кнопк', 'сохран'), ('профил', 'аватар'),
+                ('пользовател', 'юзер')]
+
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, texts):
+        texts = list(texts)
+        self.calls.append(texts)
+        return np.array([[sum(text.lower().count(stem) for stem in concept) for concept in self.CONCEPTS]
+                         for text in texts], dtype=np.float32)
+
+    @property
+    def encoded(self):
+        return [text for call in self.calls for text in call]
+
+
+class TestEmbeddingIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.issues_df = pd.DataFrame({
+            'key': ['TEST-1', 'TEST-2', 'TEST-3'],
+            'summary': ['Ошибка при авторизации пользователя', 'Не работает кнопка "Сохранить"',
+                        'Проблема с отображением профиля'],
+            'description': ['Пользователь не может войти в систему.', 'Кнопка неактивна после заполнения формы.',
+                            'Аватар пользователя не загружается.'],
+        })
+
+    def test_hybrid_finds_paraphrase(self):
+        """
+        Перефразированная задача без общих слов находится по смыслу, а на запрос модель вызывается один раз.
+        """
+        index = IssueIndex.build(self.issues_df)
+        encoder = ConceptEncoder()
+        embeddings = EmbeddingIndex.for_index(index, encoder)
+        self.assertEqual(len(encoder.calls), 1)
+
+        tfidf_only = find_similar_issues('Проблема с логином', 'Юзер не может зайти', self.issues_df, index=index)
+        self.assertNotIn('TEST-1', tfidf_only['key'].tolist())
+        result = find_similar_issues('Проблема с логином', 'Юзер не может зайти', self.issues_df, index=index,
+                                     embeddings=embeddings)
+        self.assertEqual(result['key'][0], 'TEST-1')
+        self.assertEqual(result['found_in'][0], 'смыслу')
+        self.assertListEqual(encoder.calls[1:], [['Проблема с логином\nЮзер не может зайти']])
+
+    def test_holder_reembeds_only_changed_texts(self):
+        """
+        Векторы кэшируются по ключу задачи и хэшу текста: при обновлении хранилища, перезапуске
+        и сжатии индекса модель кодирует только новые и измененные тексты.
+        """
+        changed_df = pd.DataFrame({'key': ['TEST-2'], 'summary': ['Не входит по логину'], 'description': ['']})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, 'issues.db')
+            store = IssueStore(cache_file)
+            store.replace_all(self.issues_df)
+            encoder = ConceptEncoder()
+            holder = CorpusHolder(cache_file=cache_file, embedding_encoder=encoder)
+            self.assertEqual(len(holder.get().embeddings), 3)
+            self.assertEqual(len(encoder.encoded), 3)
+
+            store.apply_changes(changed_df, removed_keys=['TEST-3'])
+            snapshot = holder.reload()
+            self.assertIsInstance(snapshot.index, IncrementalIssueIndex)
+            self.assertListEqual(encoder.encoded[3:], ['Не входит по логину'])
+            result = find_similar_issues('Логин', '', snapshot.issues, index=snapshot.index, embeddings=snapshot.embeddings)
+            self.assertListEqual(result['key'].tolist(), ['TEST-2', 'TEST-1'])
+            # Удаленная задача не находится и по смыслу
+            self.assertTrue(find_similar_issues('Аватар профиля', '', snapshot.issues, index=snapshot.index,
+                                                embeddings=snapshot.embeddings).empty)
+
+            # Новый процесс берет векторы неизменных задач из кэша на диске
+            restarted_encoder = ConceptEncoder()
+            restarted = CorpusHolder(cache_file=cache_file, embedding_encoder=restarted_encoder).get()
+            self.assertListEqual(restarted_encoder.encoded, ['Не входит по логину'])
+            np.testing.assert_allclose(restarted.embeddings.score('логин', ''), snapshot.embeddings.score('логин', '')[[0, 3]])
+
+            n_encoded = len(encoder.encoded)
+            compacted = holder.compact()
+            self.assertEqual(len(encoder.encoded), n_encoded)
+            self.assertEqual(len(compacted.embeddings), 2)
+
+
+class TestBatchSearch(unittest.TestCase):
+
+    def test_batch_matches_single_queries(self):
+        """
+        Пакетный поиск дает те же результаты, что и поиск по одной задаче.
+        """
+        issues_df = make_synthetic_issues_df(300, seed=1)
+        index = IssueIndex.build(issues_df)
+        queries = make_synthetic_issues_df(25, seed=2)
+        candidates = list(zip(queries['summary'], queries['description'])) + [('zzz', ''), ('', '')]
+
+        for batch_size in (1, 7, 1000):
+            results = list(find_similar_issues_batch(candidates, index, top_n=5, batch_size=batch_size))
+            self.assertEqual(len(results), len(candidates))
+            for (title, description), matches in zip(candidates, results):
+                expected = find_similar_issues(title, description, issues_df, index=index)
+                self.assertListEqual([m['key'] for m in matches], list(expected['key']) if len(expected) else [])
+                self.assertListEqual([m['found_in'] for m in matches],
+                                     list(expected['found_in']) if len(expected) else [])
+                np.testing.assert_allclose([m['similarity'] for m in matches],
+                                           list(expected['similarity']) if len(expected) else [])
+
+
+def run_main(args, cwd):
+    """
+    Запускает main.py с аргументами args в каталоге cwd и возвращает завершенный процесс.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    return subprocess.run([sys.executable, script] + args, cwd=cwd, capture_output=True, text=True, encoding='utf-8')
+
+
+class TestCommandLine(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        IssueStore(os.path.join(self.tmp_dir.name, 'issues.db')).replace_all(make_issues_df())
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_check_writes_json_lines_to_stdout(self):
+        """
+        Без --output в stdout выводятся только записи JSON Lines, а сообщения о ходе работы - в stderr.
+        """
+        input_path = os.path.join(self.tmp_dir.name, 'new.jsonl')
+        with open(input_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'id': 'N-1', 'summary': 'Ошибка авторизации'}, ensure_ascii=False) + '\n')
+        completed = run_main(['check', input_path], self.tmp_dir.name)
+        self.assertEqual(completed.returncode, 0, completed.stderr)
+        records = [json.loads(line) for line in completed.stdout.splitlines()]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['matches'][0]['key'], 'TEST-1')
+        self.assertIn("Построение индекса задач...", completed.stderr)
+
+    def test_dedup_writes_json_lines_to_stdout(self):
+        """
+        Пары дубликатов без --output выводятся в stdout чистым JSON Lines.
+        """
+        issues_df = pd.concat([make_issues_df(), make_issues_df().head(1).assign(key='TEST-4')])
+        IssueStore(os.path.join(self.tmp_dir.name, 'issues.db')).replace_all(issues_df)
+        completed = run_main(['dedup'], self.tmp_dir.name)
+        self.assertEqual(completed.returncode, 0, completed.stderr)
+        pairs = [json.loads(line) for line in completed.stdout.splitlines()]
+        self.assertListEqual([(pair['issue_1'], pair['issue_2']) for pair in pairs], [('TEST-1', 'TEST-4')])
+        self.assertIn("Найдено пар дубликатов: 1", completed.stderr)
+
+
+class TestFusedScoring(unittest.TestCase):
+
+    def setUp(self):
+        self.issues_df = pd.DataFrame({
+            'key': ['PLATFORM-1', 'PLATFORMUI-2', 'PLATFORM-3', 'PLATFORMUI-4'],
+            'summary': ['Ошибка авторизации', 'Отчет не выгружается', 'Кнопка сохранить', 'Ошибка авторизации'],
+            'description': ['', 'ошибка авторизации ошибка авторизации при выгрузке отчета', 'форма профиля', ''],
+            'updated': [None, '2020-01-01T00:00:00.000+0000',
+                        '2024-01-01T00:00:00.000+0000', '2024-01-01T00:00:00.000+0000'],
+        })
+        self.index = FusedIssueIndex.build(self.issues_df)
+
+    def test_weighted_sum_and_breakdown(self):
+        """
+        Схожесть равна взвешенной сумме схожести полей, разбивка по полям возвращается для каждой задачи.
+        """
+        result = find_similar_issues_fused('ошибка авторизации', 'ошибка авторизации', self.index,
+                                           summary_weight=0.7, description_weight=0.3)
+        np.testing.assert_allclose(
+            result['similarity'], 0.7 * result['summary_similarity'] + 0.3 * result['description_similarity']
+        )
+        self.assertListEqual(list(result['key'][:2]), ['PLATFORM-1', 'PLATFORMUI-4'])
+        self.assertEqual(result.set_index('key').loc['PLATFORMUI-2', 'found_in'], 'описанию')
+        self.assertNotIn('PLATFORM-3', list(result['key']))
+
+    def test_metadata_boosts(self):
+        """
+        Бусты за очередь и новизну меняют порядок, но не добавляют задачи без совпадений по тексту.
+        """
+        result = find_similar_issues_fused('ошибка авторизации', 'ошибка авторизации', self.index,
+                                           queue='PLATFORMUI', queue_boost=0.5)
+        self.assertListEqual(list(result['key']), ['PLATFORMUI-4', 'PLATFORMUI-2', 'PLATFORM-1'])
+
+        result = find_similar_issues_fused('ошибка авторизации', '', self.index)
+        self.assertListEqual(list(result['key']), ['PLATFORM-1', 'PLATFORMUI-4'])
+        result = find_similar_issues_fused('ошибка авторизации', '', self.index, recency_boost=0.1,
+                                           recency_half_life_days=3650)
+        self.assertListEqual(list(result['key']), ['PLATFORMUI-4', 'PLATFORM-1'])
+
+    def test_empty_vocabulary(self):
+        """
+        Индекс строится, даже если в текстах задач нет ни одного слова, и ничего не находит.
+        """
+        issues_df = pd.DataFrame({'key': ['A-1', 'A-2'], 'summary': ['', 'и в на'], 'description': ['', '']})
+        index = FusedIssueIndex.build(issues_df)
+        self.assertEqual(len(index), 2)
+        self.assertTrue(find_similar_issues_fused('ошибка авторизации', '', index).empty)
+
+    def test_persisted_separately(self):
+        """
+        Совмещенный индекс сохраняется в отдельный файл рядом с хранилищем.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, 'issues.db')
+            store = IssueStore(cache_file)
+            store.replace_all(self.issues_df)
+            index = load_or_build_index(store.read_issues(), cache_file=cache_file, index_class=FusedIssueIndex)
+            self.assertIsInstance(index, FusedIssueIndex)
+            self.assertTrue(os.path.exists(get_index_path(cache_file, 'fused_index')))
+            reloaded = load_or_build_index(store.read_issues(), cache_file=cache_file, index_class=FusedIssueIndex)
+            self.assertListEqual(list(reloaded.keys), list(index.keys))
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def test_lru_and_version_invalidation(self):
+        """
+        Кэш вытесняет давно не использованные записи и очищается при смене версии корпуса.
+        """
+        cache = QueryCache(max_size=2)
+        calls = []
+
+        def compute(value):
+            return lambda: calls.append(value) or value
+
+        self.assertEqual(cache.get_or_compute(1, 'a', compute('A')), 'A')
+        self.assertEqual(cache.get_or_compute(1, 'a', compute('A2')), 'A')
+        cache.get_or_compute(1, 'b', compute('B'))
+        cache.get_or_compute(1, 'a', compute('A3'))
+        cache.get_or_compute(1, 'c', compute('C'))
+        self.assertEqual(cache.get_or_compute(1, 'b', compute('B2')), 'B2')
+        self.assertListEqual(calls, ['A', 'B', 'C', 'B2'])
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+        self.assertEqual(cache.get_or_compute(2, 'a', compute('A4')), 'A4')
+        self.assertEqual(len(cache), 1)
+
+    def test_ttl(self):
+        """
+        Устаревшие записи вычисляются заново.
+        """
+        cache = QueryCache(ttl_seconds=0)
+        cache.get_or_compute(1, 'a', lambda: 'A')
+        self.assertEqual(cache.get_or_compute(1, 'a', lambda: 'A2'), 'A2')
+        self.assertEqual(cache.stats()['hits'], 0)
+
+    def test_search_results_cached_by_normalized_query(self):
+        """
+        Поиск через main кэширует результат по очищенному тексту запроса до смены версии индекса.
+        """
+        os.environ.setdefault('YANDEX_TRACKER_TOKEN', 'test-token')
+        os.environ.setdefault('YA_TRACKER_ORG_ID', 'test-org')
+        import main
+
+        issues_df = make_issues_df()
+        index = IssueIndex.build(issues_df, source=('issues.db', 1, None))
+        with patch.object(main, 'query_cache', QueryCache()) as cache, \
+                patch.object(main, 'find_issues', side_effect=find_similar_issues) as mock_find:
+            first = main.find_similar_issues('Ошибка авторизации!', '', issues_df, index=index)
+            second = main.find_similar_issues('  ошибка   АВТОРИЗАЦИИ', '', issues_df, index=index)
+            pd.testing.assert_frame_equal(first, second)
+            self.assertEqual(mock_find.call_count, 1)
+            self.assertEqual(cache.stats()['hits'], 1)
+
+            main.find_similar_issues('Ошибка авторизации', '', issues_df, index=index, top_n=1)
+            index.source = ('issues.db', 2, None)
+            main.find_similar_issues('Ошибка авторизации', '', issues_df, index=index)
+            self.assertEqual(mock_find.call_count, 3)
+
+
+def reference_top_matches(keys, sim_summary, sim_desc, top_n):
+    """
+    Прежняя реализация отбора: построчный DataFrame, сортировка и drop_duplicates.
+    """
+    rows = [{'key': key, 'similarity': sim, 'found_in': 'заголовку'} for key, sim in zip(keys, sim_summary)]
+    rows += [{'key': key, 'similarity': sim, 'found_in': 'описанию'} for key, sim in zip(keys, sim_desc)]
+    df = pd.DataFrame(rows).sort_values('similarity', ascending=False, kind='stable').drop_duplicates('key')
+    return df[df['similarity'] > 0].head(top_n)
+
+
+class TestSelectTopMatches(unittest.TestCase):
+
+    def test_matches_reference_implementation(self):
+        """
+        Векторизованный отбор совпадает с прежним построчным отбором.
+        """
+        rng = np.random.default_rng(42)
+        keys = np.array([f'TEST-{i}' for i in range(500)], dtype=object)
+        for _ in range(20):
+            sim_summary = rng.random(500) * (rng.random(500) > 0.7)
+            sim_desc = rng.random(500) * (rng.random(500) > 0.7)
+            positions, best, in_desc = select_top_matches(sim_summary, sim_desc, 5)
+            expected = reference_top_matches(keys, sim_summary, sim_desc, 5)
+
+            self.assertListEqual(list(keys[positions]), list(expected['key']))
+            np.testing.assert_allclose(best[positions], expected['similarity'])
+            self.assertListEqual(
+                list(np.where(in_desc[positions], 'описанию', 'заголовку')), list(expected['found_in'])
+            )
+
+    def test_zero_similarity_is_dropped(self):
+        """
+        Задачи с нулевой схожестью не попадают в результат.
+        """
+        positions, _, _ = select_top_matches(np.array([0.0, 0.3, 0.0]), np.array([0.0, 0.1, 0.0]), 5)
+        self.assertListEqual(list(positions), [1])
+
+
+class TestDuplicatePairs(unittest.TestCase):
+
+    def setUp(self):
+        words = ['ошибка', 'кнопка', 'форма', 'профиль', 'вход', 'отчет', 'экспорт', 'фильтр']
+        rng = np.random.default_rng(7)
+        texts = [' '.join(rng.choice(words, size=4)) for _ in range(60)]
+        self.df = pd.DataFrame({'key': [f'TEST-{i}' for i in range(60)], 'full_text': texts})
+
+    def make_matrix(self):
+        analyzer = RussianAnalyzer(stop_words=RUSSIAN_STOP_WORDS | ENGLISH_STOP_WORDS)
+        return make_vectorizer(analyzer).fit_transform(self.df['full_text'])
+
+    def dense_pairs(self, threshold):
+        sim = cosine_similarity(self.make_matrix())
+        return {
+            (self.df['key'][i], self.df['key'][j])
+            for i in range(len(sim)) for j in range(i + 1, len(sim)) if sim[i][j] > threshold
+        }
+
+    def test_blocked_pairs_match_dense_matrix(self):
+        """
+        Поблочный поиск находит те же пары, что и плотная матрица схожести.
+        """
+        expected = self.dense_pairs(0.6)
+        for block_size in (1, 7, 1000):
+            result = calculate_similarity(self.df, threshold=0.6, block_size=block_size)
+            self.assertSetEqual({(p['issue_1'], p['issue_2']) for p in result}, expected)
+            similarities = [p['similarity'] for p in result]
+            self.assertListEqual(similarities, sorted(similarities, reverse=True))
+
+    def test_case_does_not_matter(self):
+        """
+        Тексты, отличающиеся только регистром, считаются дубликатами.
+        """
+        df = pd.DataFrame({'key': ['TEST-1', 'TEST-2', 'TEST-3'],
+                           'full_text': ['Ошибка авторизации в Системе', 'ОШИБКА АВТОРИЗАЦИИ В СИСТЕМЕ',
+                                         'Кнопка сохранить не работает']})
+        result = calculate_similarity(df, threshold=0.8)
+        self.assertListEqual([(p['issue_1'], p['issue_2']) for p in result], [('TEST-1', 'TEST-2')])
+        self.assertAlmostEqual(result[0]['similarity'], 1.0, places=6)
+
+    def test_process_pool(self):
+        """
+        Обработка блоков в пуле процессов дает тот же набор пар.
+        """
+        pairs = iter_duplicate_pairs(self.make_matrix(), self.df['key'].tolist(), threshold=0.6, block_size=9, workers=2)
+        self.assertSetEqual({(p['issue_1'], p['issue_2']) for p in pairs}, self.dense_pairs(0.6))
+
+    def dense_clusters(self, threshold):
+        sim = cosine_similarity(self.make_matrix()) > threshold
+        np.fill_diagonal(sim, False)
+        _, labels = connected_components(sparse.csr_matrix(sim), directed=False)
+        clusters = {}
+        for key, label, has_pairs in zip(self.df['key'], labels, sim.any(axis=1)):
+            if has_pairs:
+                clusters.setdefault(label, []).append(key)
+        return sorted(clusters.values())
+
+    def write_clusters(self, output, **kwargs):
+        corpus = Corpus.from_frame(self.df.assign(summary=self.df['full_text']))
+        count = write_duplicate_clusters(corpus, output, source=('issues.db', 1, None), threshold=0.8,
+                                         matrix=self.make_matrix(), **kwargs)
+        with open(output, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(count, len(records))
+        return records
+
+    def test_clusters_match_connected_components(self):
+        """
+        Кластеры, собранные по потоку пар, совпадают с компонентами связности графа пар выше порога.
+        """
+        expected = self.dense_clusters(0.8)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = os.path.join(tmp_dir, 'clusters.jsonl')
+            for block_size in (1, 7, 1000):
+                records = self.write_clusters(output, block_size=block_size)
+                self.assertListEqual(sorted([issue['key'] for issue in r['issues']] for r in records), expected)
+                self.assertListEqual([r['cluster'] for r in records], list(range(1, len(records) + 1)))
+                self.assertTrue(all(r['size'] == len(r['issues']) and r['max_similarity'] > 0.8 for r in records))
+            self.assertListEqual(os.listdir(tmp_dir), ['clusters.jsonl'])
+
+    def test_clusters_resume_after_interruption(self):
+        """
+        Прерванный поиск кластеров продолжается с последнего сохраненного блока и дает тот же результат.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = os.path.join(tmp_dir, 'clusters.jsonl')
+            expected = self.write_clusters(output, block_size=7)
+
+            def interrupted(*args, **kwargs):
+                for number, block in enumerate(iter_duplicate_blocks(*args, **kwargs)):
+                    if number == 4:
+                        raise KeyboardInterrupt
+                    yield block
+
+            with patch('duplicate_clusters.iter_duplicate_blocks', interrupted):
+                with self.assertRaises(KeyboardInterrupt):
+                    self.write_clusters(output, block_size=7)
+            with open(get_state_path(output), encoding='utf-8') as f:
+                self.assertEqual(json.load(f)['next_row'], 28)
+
+            with patch('duplicate_clusters.iter_duplicate_blocks', wraps=iter_duplicate_blocks) as blocks:
+                self.assertListEqual(self.write_clusters(output, block_size=7), expected)
+            self.assertEqual(blocks.call_args.kwargs['start_row'], 28)
+            self.assertFalse(os.path.exists(get_state_path(output)))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_spans_and_counters(self):
+        """
+        Этапы попадают в гистограммы, исключение внутри этапа учитывается отдельным счетчиком.
+        """
+        metrics = Metrics()
+        for _ in range(3):
+            with metrics.span('search.score'):
+                pass
+        with self.assertRaises(ValueError):
+            with metrics.span('search.score'):
+                raise ValueError
+        metrics.increment('bot.superseded', 2)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['histograms']['search.score']['count'], 4)
+        self.assertEqual(snapshot['counters'], {'search.score.errors': 1, 'bot.superseded': 2})
+        self.assertIn('search.score: 4', metrics.describe())
+
+    def test_disabled_records_nothing(self):
+        """
+        Выключенные метрики ничего не записывают, а декорированная функция работает как обычно.
+        """
+        metrics = Metrics(enabled=False)
+        with metrics.span('search.score'):
+            pass
+        metrics.increment('bot.superseded')
+        self.assertEqual(metrics.timed('search.total')(lambda x: x * 2)(21), 42)
+        self.assertEqual(metrics.snapshot(), {'counters': {}, 'histograms': {}, 'gauges': {}})
+
+    def test_histogram_quantiles(self):
+        """
+        Квантили оцениваются в пределах корзины, в которую они попадают.
+        """
+        histogram = Histogram(buckets=(0.01, 0.1, 1.0))
+        for value in [0.005] * 90 + [0.5] * 10:
+            histogram.observe(value)
+        self.assertLessEqual(histogram.quantile(0.5), 0.01)
+        self.assertTrue(0.1 < histogram.quantile(0.95) <= 0.5)
+        self.assertEqual(histogram.quantile(1.0), 0.5)
+
+    def test_prometheus_format_and_endpoint(self):
+        """
+        Метрики отдаются в формате Prometheus по HTTP и записываются в файл.
+        """
+        metrics = Metrics(buckets=(0.1, 1.0))
+        metrics.observe('index.load', 0.5)
+        metrics.register_gauges('query_cache', lambda: {'hits': 3})
+        text = metrics.to_prometheus()
+        self.assertIn('qc_stage_seconds_bucket{stage="index.load",le="0.1"} 0', text)
+        self.assertIn('qc_stage_seconds_bucket{stage="index.load",le="1"} 1', text)
+        self.assertIn('qc_stage_seconds_count{stage="index.load"} 1', text)
+        self.assertIn('qc_value{name="query_cache.hits"} 3', text)
+
+        server = start_http_server(0, registry=metrics)
+        try:
+            with urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+                self.assertEqual(response.read().decode('utf-8'), text)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'qc.prom')
+            metrics.write_prometheus(path)
+            with open(path, encoding='utf-8') as f:
+                self.assertEqual(f.read(), text)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_generate_issues_is_deterministic(self):
+        """
+        Синтетический корпус воспроизводится при том же seed.
+        """
+        first, second = benchmark.generate_issues(200, seed=3), benchmark.generate_issues(200, seed=3)
+        pd.testing.assert_frame_equal(first, second)
+        self.assertEqual(first['key'].nunique(), 200)
+        self.assertFalse(first.equals(benchmark.generate_issues(200, seed=4)))
+
+    def test_run_benchmark_reports_metrics(self):
+        """
+        Замер на маленьком корпусе возвращает все метрики.
+        """
+        result = benchmark.run_benchmark(300, n_queries=5, batch_size=2)
+        for name in ('index_build_seconds', 'cache_load_seconds', 'batch_queries_per_second', 'dedup_pairs'):
+            self.assertIn(name, result)
+        self.assertLessEqual(result['query_latency_ms']['p50'], result['query_latency_ms']['p99'])
+
+
+if __name__ == '__main__':
+    unittest.main()
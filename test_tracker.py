@@ -0,0 +1,282 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import types
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import timedelta
+from unittest.mock import patch
+from urllib.parse import urlsplit, parse_qs
+import pandas as pd
+from issue_store import IssueStore
+from yandex_tracker import TrackerPager, get_issues, get_fetch_queries, refresh_store, QUEUES, STATUSES, SYNC_OVERLAP
+
+
+class FakeTracker:
+    """
+    Локальный HTTP-сервер, отвечающий на постраничный поиск задач как Yandex Tracker.
+
+    failures задает количество ответов 500 для страниц: {(очередь, статус, страница): количество}.
+    """
+
+    def __init__(self, issues, failures=None):
+        self.issues = issues
+        self.failures = dict(failures or {})
+        self.requests = []
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                url = urlsplit(self.path)
+                params = parse_qs(url.query)
+                per_page, page = int(params['perPage'][0]), int(params['page'][0])
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                queue, status = re.match(r'Queue: (\w+) Status: (\w+)', body['query']).groups()
+
+                with fake._lock:
+                    fake.requests.append((queue, status, page))
+                    failures = fake.failures.get((queue, status, page), 0)
+                    if failures:
+                        fake.failures[(queue, status, page)] = failures - 1
+                if failures:
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+
+                matching = sorted((issue for issue in fake.issues
+                                   if issue['queue'] == queue and issue['status'] == status),
+                                  key=lambda issue: issue['key'])
+                total_pages = -(-len(matching) // per_page)
+                payload = json.dumps([
+                    {'key': issue['key'], 'summary': issue['summary'], 'description': None,
+                     'updatedAt': issue['updatedAt']}
+                    for issue in matching[(page - 1) * per_page:page * per_page]
+                ]).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('X-Total-Pages', str(total_pages))
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+
+def make_tracker_issues():
+    issues = []
+    for i in range(120):
+        issues.append({
+            'key': f'{QUEUES[i % 2]}-{i}',
+            'queue': QUEUES[i % 2],
+            'status': STATUSES[i % 3],
+            'summary': f'Задача {i}',
+            'updatedAt': f'2024-01-{1 + i % 28:02d}T10:00:00.000+0000',
+        })
+    return issues
+
+
+class TestPagedFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = IssueStore(os.path.join(self.tmp_dir.name, 'issues.db'))
+        self.issues = make_tracker_issues()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_pager(self, tracker, max_retries=3):
+        return TrackerPager('token', 'org', base_url=tracker.url, per_page=7, requests_per_second=0,
+                            max_retries=max_retries, backoff=0.01)
+
+    def test_fetches_all_pages_with_retries(self):
+        """
+        Все страницы всех очередей загружаются параллельно, временные ошибки повторяются.
+        """
+        tracker = FakeTracker(self.issues, failures={(QUEUES[0], STATUSES[0], 2): 2})
+        try:
+            count = get_issues(self.store, pager=self.make_pager(tracker), workers=4)
+        finally:
+            tracker.close()
+
+        self.assertEqual(count, 120)
+        self.assertSetEqual(set(self.store.read_issues()['key']), {issue['key'] for issue in self.issues})
+        self.assertEqual(self.store.get_meta('last_updated'), '2024-01-28T10:00:00+00:00')
+        self.assertEqual(tracker.requests.count((QUEUES[0], STATUSES[0], 2)), 3)
+
+    def test_resume_after_failure(self):
+        """
+        После сбоя загрузка продолжается с недостающих страниц, а хранилище до конца загрузки не меняется.
+        """
+        tracker = FakeTracker(self.issues, failures={(QUEUES[1], STATUSES[1], 3): 100})
+        try:
+            with self.assertRaises(Exception):
+                get_issues(self.store, pager=self.make_pager(tracker, max_retries=1), workers=2)
+            self.assertEqual(self.store.count(), 0)
+            staged = self.store.get_staged_pages(f"7:{'|'.join(get_fetch_queries())}")
+            self.assertTrue(staged)
+
+            tracker.failures.clear()
+            tracker.requests.clear()
+            count = get_issues(self.store, pager=self.make_pager(tracker), workers=2)
+        finally:
+            tracker.close()
+
+        self.assertEqual(count, 120)
+        self.assertIn((QUEUES[1], STATUSES[1], 3), tracker.requests)
+        staged_requests = {(re.match(r'Queue: (\w+) Status: (\w+)', query).groups() + (page,))
+                           for query, page in staged}
+        self.assertTrue(staged_requests.isdisjoint(tracker.requests))
+
+    def test_resumed_crawl_watermark_not_after_start(self):
+        """
+        Загрузка, продолженная позже чем через SYNC_OVERLAP после начала, сохраняет водяной знак
+        не позже начала загрузки: изменения задач на страницах, сохраненных до перерыва, попадут
+        в следующую загрузку изменений.
+        """
+        tracker = FakeTracker(self.issues, failures={(QUEUES[1], STATUSES[1], 3): 100})
+        try:
+            with self.assertRaises(Exception):
+                get_issues(self.store, pager=self.make_pager(tracker, max_retries=1), workers=2)
+            started = pd.Timestamp(self.store.get_meta('staging_started'))
+
+            # После начала загрузки меняется задача на сохраненной странице, а через два дня - задача на недостающей
+            staged = self.store.get_staged_pages(f"7:{'|'.join(get_fetch_queries())}")
+            query, page = next(iter(staged))
+            queue, status = re.match(r'Queue: (\w+) Status: (\w+)', query).groups()
+            edited = self.page_issues(queue, status, page)[0]
+            edited['updatedAt'] = self.format_updated(started + timedelta(hours=1))
+            late = self.page_issues(QUEUES[1], STATUSES[1], 3)[0]
+            late['updatedAt'] = self.format_updated(started + SYNC_OVERLAP * 2)
+
+            tracker.failures.clear()
+            get_issues(self.store, pager=self.make_pager(tracker), workers=2)
+        finally:
+            tracker.close()
+
+        last_updated = pd.Timestamp(self.store.get_meta('last_updated'))
+        self.assertEqual(last_updated, started)
+        self.assertLess(last_updated - SYNC_OVERLAP, pd.Timestamp(edited['updatedAt']))
+        self.assertIsNone(self.store.get_meta('staging_started'))
+
+    def page_issues(self, queue, status, page, per_page=7):
+        matching = sorted((issue for issue in self.issues if issue['queue'] == queue and issue['status'] == status),
+                          key=lambda issue: issue['key'])
+        return matching[(page - 1) * per_page:page * per_page]
+
+    @staticmethod
+    def format_updated(timestamp):
+        return timestamp.strftime('%Y-%m-%dT%H:%M:%S.000+0000')
+
+
+class FakeTrackerClient:
+    """
+    Клиент Yandex Tracker для проверки загрузки изменений: issues.find возвращает заданные задачи
+    и запоминает запросы, а при заданной ошибке выбрасывает ее.
+    """
+
+    def __init__(self, issues=(), error=None):
+        self.found = list(issues)
+        self.error = error
+        self.queries = []
+        self.issues = self
+
+    def find(self, query):
+        self.queries.append(query)
+        if self.error is not None:
+            raise self.error
+        return self.found
+
+
+def make_client_issue(key, status, updated, summary='Задача'):
+    return types.SimpleNamespace(key=key, summary=summary, description=None, updatedAt=updated,
+                                 status=types.SimpleNamespace(key=status))
+
+
+class TestIncrementalSync(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = IssueStore(os.path.join(self.tmp_dir.name, 'issues.db'))
+        self.store.replace_all(pd.DataFrame({
+            'key': ['PLATFORM-1', 'PLATFORM-2', 'PLATFORM-3'],
+            'summary': ['Первая', 'Вторая', 'Третья'],
+            'description': ['', '', ''],
+            'updated': ['2024-01-05T10:00:00.000+0000'] * 3,
+        }), last_updated='2024-01-10T10:00:00+00:00')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def sync(self, client):
+        with patch('yandex_tracker.get_client', return_value=client):
+            refresh_store(self.store)
+
+    def test_changes_applied_and_left_statuses_removed(self):
+        """
+        Изменения запрашиваются с запасом SYNC_OVERLAP до водяного знака по всем статусам: задачи
+        в отслеживаемых статусах добавляются или заменяются, вышедшие из них удаляются,
+        а водяной знак сдвигается к последнему изменению.
+        """
+        client = FakeTrackerClient([
+            make_client_issue('PLATFORM-1', STATUSES[0], '2024-01-12T10:00:00.000+0000', summary='Первая изменена'),
+            make_client_issue('PLATFORM-2', 'closed', '2024-01-11T10:00:00.000+0000'),
+            make_client_issue('PLATFORM-4', STATUSES[1], '2024-01-11T12:00:00.000+0000', summary='Новая'),
+        ])
+        self.sync(client)
+
+        self.assertEqual(len(client.queries), 1)
+        self.assertIn('Updated: >= "2024-01-09 10:00:00"', client.queries[0])
+        self.assertNotIn('Status:', client.queries[0])
+        issues = self.store.read_issues().set_index('key')
+        self.assertListEqual(sorted(issues.index), ['PLATFORM-1', 'PLATFORM-3', 'PLATFORM-4'])
+        self.assertEqual(issues.loc['PLATFORM-1', 'summary'], 'Первая изменена')
+        self.assertEqual(self.store.get_meta('last_updated'), '2024-01-12T10:00:00+00:00')
+        changed, removed = self.store.read_changes(1)
+        self.assertListEqual(sorted(changed.keys.tolist()), ['PLATFORM-1', 'PLATFORM-4'])
+        self.assertListEqual(removed, ['PLATFORM-2'])
+
+    def test_overlap_window_is_queried_again(self):
+        """
+        Задачи из окна перекрытия приходят повторно и просто перезаписываются, водяной знак не уменьшается.
+        """
+        client = FakeTrackerClient([make_client_issue('PLATFORM-3', STATUSES[2], '2024-01-09T18:00:00.000+0000',
+                                                      summary='Третья')])
+        self.sync(client)
+        self.sync(client)
+
+        self.assertEqual(len(client.queries), 2)
+        self.assertEqual(client.queries[0], client.queries[1])
+        self.assertEqual(self.store.count(), 3)
+        self.assertEqual(self.store.get_meta('last_updated'), '2024-01-10T10:00:00+00:00')
+
+    def test_watermark_kept_on_failure(self):
+        """
+        Если загрузка изменений не удалась, хранилище и водяной знак не меняются.
+        """
+        version = self.store.get_version()
+        with self.assertRaises(RuntimeError):
+            self.sync(FakeTrackerClient(error=RuntimeError("сбой API")))
+
+        self.assertEqual(self.store.get_version(), version)
+        self.assertEqual(self.store.get_meta('last_updated'), '2024-01-10T10:00:00+00:00')
+        self.assertEqual(self.store.count(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,18 @@
 # text_processor.py
 
 import re
+from concurrent.futures import ProcessPoolExecutor
+
+# Шаблоны компилируются один раз при импорте модуля
+_URL_RE = re.compile(r'https?://\S+|www\.\S+')
+_HTML_TAG_RE = re.compile(r'<.*?>')
+# Любая последовательность символов, не являющихся русскими или латинскими буквами или цифрами
+# (включая пробельные), заменяется одним пробелом: это объединяет удаление спецсимволов и лишних пробелов
+_NON_WORD_RE = re.compile(r'[^a-zа-я0-9]+')
+
+# Минимальное количество текстов на процесс, при котором имеет смысл пул процессов
+_MIN_TEXTS_PER_WORKER = 10000
+
 
 def clean_text(text: str) -> str:
     """
@@ -21,15 +33,188 @@ def clean_text(text: str) -> str:
     text = text.lower()
 
     # 2. Удаление URL-адресов
-    text = re.sub(r'https?://\S+|www\.\S+', ' ', text)
+    text = _URL_RE.sub(' ', text)
 
     # 3. Удаление HTML-тегов
-    text = re.sub(r'<.*?>', ' ', text)
+    text = _HTML_TAG_RE.sub(' ', text)
+
+    # 4-5. Удаление всех символов, кроме русских и латинских букв и цифр, и лишних пробелов
+    return _NON_WORD_RE.sub(' ', text).strip()
+
+
+def clean_texts(texts, workers: int = 1) -> list:
+    """
+    Очищает список текстов так же, как clean_text.
+
+    :param texts: Итерируемый набор строк (например, колонка DataFrame).
+    :param workers: Количество процессов. Пул процессов используется,
+                    только если текстов достаточно много.
+    :return: Список очищенных строк в исходном порядке.
+    """
+    texts = list(texts)
+    workers = min(workers, len(texts) // _MIN_TEXTS_PER_WORKER)
+    if workers <= 1:
+        return [clean_text(text) for text in texts]
+
+    chunksize = -(-len(texts) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(clean_text, texts, chunksize=chunksize))
+
+
+# Стоп-слова русского языка (служебные части речи и местоимения)
+RUSSIAN_STOP_WORDS = frozenset("""
+а без более бы был была были было быть в вам вас весь во вот все всего всех вы где да даже для до
+его ее ей ему если есть еще же за здесь и из или им их к как когда кто ли либо между меня мне
+много может мы на над надо наш не него нее нет ни них но ну о об однако он она они оно от очень
+по под после потому при про с со так также такой там те тем то того тоже той только том ты у уже
+хотя чего чей чем что чтобы чье чья эта эти это этот я
+""".split())
+
+_TOKEN_RE = re.compile(r'\w\w+')
+# Наибольшее количество запоминаемых основ слов; при переполнении кэш основ очищается
+MAX_CACHED_STEMS = 200000
+
+_VOWELS = 'аеиоуыэюя'
+
+# Окончания русского стеммера Snowball. Окончания из первой группы каждого класса
+# удаляются, только если перед ними стоит 'а' или 'я'.
+_PERFECTIVE_GERUND = (('в', 'вши', 'вшись'), ('ив', 'ивши', 'ившись', 'ыв', 'ывши', 'ывшись'))
+_ADJECTIVE = ((), ('ее', 'ие', 'ые', 'ое', 'ими', 'ыми', 'ей', 'ий', 'ый', 'ой', 'ем', 'им', 'ым', 'ом',
+                   'его', 'ого', 'ему', 'ому', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею'))
+_PARTICIPLE = (('ем', 'нн', 'вш', 'ющ', 'щ'), ('ивш', 'ывш', 'ующ'))
+_REFLEXIVE = ((), ('ся', 'сь'))
+_VERB = (('ла', 'на', 'ете', 'йте', 'ли', 'й', 'л', 'ем', 'н', 'ло', 'но', 'ет', 'ют', 'ны', 'ть', 'ешь', 'нно'),
+         ('ила', 'ыла', 'ена', 'ейте', 'уйте', 'ите', 'или', 'ыли', 'ей', 'уй', 'ил', 'ыл', 'им', 'ым', 'ен',
+          'ило', 'ыло', 'ено', 'ят', 'ует', 'уют', 'ит', 'ыт', 'ены', 'ить', 'ыть', 'ишь', 'ую', 'ю'))
+_NOUN = ((), ('а', 'ев', 'ов', 'ие', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии', 'и', 'ией', 'ей', 'ой', 'ий',
+              'й', 'иям', 'ям', 'ием', 'ем', 'ам', 'ом', 'о', 'у', 'ах', 'иях', 'ях', 'ы', 'ь', 'ию', 'ью', 'ю',
+              'ия', 'ья', 'я'))
+_SUPERLATIVE = ('ейше', 'ейш')
+_DERIVATIONAL = ('ость', 'ост')
+
+
+def _region_after_vowel_consonant(word, start):
+    """
+    Возвращает начало области после первой согласной, следующей за гласной, начиная с позиции start.
+    """
+    for i in range(start + 1, len(word)):
+        if word[i] not in _VOWELS and word[i - 1] in _VOWELS:
+            return i + 1
+    return len(word)
+
+
+def _regions(word):
+    """
+    Возвращает начала областей RV и R2 слова по правилам стеммера Snowball.
+    """
+    rv = next((i + 1 for i, char in enumerate(word) if char in _VOWELS), len(word))
+    r1 = _region_after_vowel_consonant(word, 0)
+    return rv, _region_after_vowel_consonant(word, r1)
+
+
+def _remove_ending(word, rv, groups):
+    """
+    Удаляет самое длинное окончание класса, если оно целиком лежит в RV.
+
+    :return: Слово без окончания или None, если окончание не найдено
+             или для него не выполнено условие.
+    """
+    conditional, plain = groups
+    best = None
+    for ending in conditional + plain:
+        if word.endswith(ending) and len(word) - len(ending) >= rv and (best is None or len(ending) > len(best)):
+            best = ending
+    if best is None:
+        return None
+    stem = word[:-len(best)]
+    if best in conditional and best not in plain:
+        if len(stem) - 1 < rv or stem[-1] not in 'ая':
+            return None
+    return stem
+
+
+def stem_russian(word: str) -> str:
+    """
+    Возвращает основу русского слова по алгоритму стеммера Snowball.
+    Слова без русских гласных возвращаются без изменений.
+    """
+    word = word.replace('ё', 'е')
+    rv, r2 = _regions(word)
+    if rv >= len(word):
+        return word
+
+    # Шаг 1: окончания деепричастий, либо возвратные частицы и окончания прилагательных, глаголов, существительных
+    stem = _remove_ending(word, rv, _PERFECTIVE_GERUND)
+    if stem is None:
+        word = _remove_ending(word, rv, _REFLEXIVE) or word
+        stem = _remove_ending(word, rv, _ADJECTIVE)
+        if stem is not None:
+            stem = _remove_ending(stem, rv, _PARTICIPLE) or stem
+        else:
+            stem = _remove_ending(word, rv, _VERB)
+            if stem is None:
+                stem = _remove_ending(word, rv, _NOUN)
+    if stem is not None:
+        word = stem
+
+    # Шаг 2: окончание 'и'
+    if word.endswith('и') and len(word) - 1 >= rv:
+        word = word[:-1]
+
+    # Шаг 3: словообразовательные суффиксы в R2
+    for ending in _DERIVATIONAL:
+        if word.endswith(ending):
+            if len(word) - len(ending) >= r2:
+                word = word[:-len(ending)]
+            break
+
+    # Шаг 4: превосходная степень, двойная 'н' и мягкий знак
+    for ending in _SUPERLATIVE:
+        if word.endswith(ending) and len(word) - len(ending) >= rv:
+            word = word[:-len(ending)]
+            if word.endswith('нн') and len(word) - 2 >= rv:
+                word = word[:-1]
+            return word
+    if word.endswith('нн') and len(word) - 2 >= rv:
+        return word[:-1]
+    if word.endswith('ь') and len(word) - 1 >= rv:
+        return word[:-1]
+    return word
+
+
+class RussianAnalyzer:
+    """
+    Анализатор для TfidfVectorizer: разбивает очищенный текст на слова, убирает
+    стоп-слова и приводит слова к основе стеммером Snowball.
+
+    Основы слов запоминаются, поэтому в установившемся режиме стемминг сводится
+    к поиску в словаре. Кэш основ ограничен MAX_CACHED_STEMS словами, чтобы опечатки,
+    идентификаторы и прочие редкие слова не накапливались в памяти долгоживущего процесса.
+    Работает без сети и внешних словарей.
+    """
 
-    # 4. Удаление всех символов, которые не являются русскими или латинскими буквами, цифрами или пробелами
-    text = re.sub(r'[^a-zа-я0-9\s]', ' ', text)
+    def __init__(self, stop_words=RUSSIAN_STOP_WORDS, stem=True):
+        self.stop_words = frozenset(stop_words or ())
+        self.stem = stem
+        self._stems = {}
 
-    # 5. Удаление лишних пробелов
-    text = re.sub(r'\s+', ' ', text).strip()
+    def __call__(self, text):
+        tokens = [token for token in _TOKEN_RE.findall(text) if token not in self.stop_words]
+        if not self.stem:
+            return tokens
+        stems = self._stems
+        result = []
+        for token in tokens:
+            token_stem = stems.get(token)
+            if token_stem is None:
+                if len(stems) >= MAX_CACHED_STEMS:
+                    stems.clear()
+                token_stem = stems[token] = stem_russian(token)
+            result.append(token_stem)
+        return result
 
-    return text
\ No newline at end of file
+    def __getstate__(self):
+        # Кэш основ не сохраняется вместе с индексом: он быстро заполняется заново
+        state = self.__dict__.copy()
+        state['_stems'] = {}
+        return state
@@ -1,11 +1,17 @@
 # yandex_tracker.py
 
 import os
+import sys
 import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime, timedelta
-import pandas as pd
+import requests
 from dotenv import load_dotenv
-from yandex_tracker_client import TrackerClient
+from issue_store import IssueStore, ISSUE_COLUMNS
+from metrics import metrics
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
@@ -15,108 +21,369 @@ load_dotenv()
 TOKEN = os.getenv("YANDEX_TRACKER_TOKEN")
 ORG_ID = os.getenv("YA_TRACKER_ORG_ID")
 
-# Инициализация клиента Yandex Tracker
-if not TOKEN or not ORG_ID:
-    raise ValueError("Необходимо задать YANDEX_TRACKER_TOKEN и YA_TRACKER_ORG_ID в .env файле")
+# Клиент Yandex Tracker создается при первом обращении к API (см. get_client),
+# чтобы модуль импортировался без настроек доступа и без загрузки клиентской библиотеки
+_client = None
+_client_lock = threading.Lock()
 
-client = TrackerClient(token=TOKEN, org_id=ORG_ID)
+# Адрес HTTP API Yandex Tracker (можно заменить, например, на локальный тестовый сервер)
+API_URL = os.getenv("YANDEX_TRACKER_API_URL", "https://api.tracker.yandex.net")
 
-def get_issues():
+# Очереди и статусы задач, по которым ищутся дубликаты
+QUEUES = ['PLATFORM', 'PLATFORMCOMP', 'PLATFORMUI', 'PLATFORMBPMN', 'PLATFORMNSI']
+STATUSES = ['inProgress', 'open', 'readyForTest', 'tested', 'testing', 'vozvrasena', 'needInfo']
+
+# Запас при инкрементальной синхронизации: перекрывает возможное расхождение
+# часовых поясов между API и языком запросов. Повторно загруженные задачи просто перезаписываются.
+SYNC_OVERLAP = timedelta(days=1)
+
+# Параметры полной постраничной загрузки
+PER_PAGE = 100
+FETCH_WORKERS = 4
+REQUESTS_PER_SECOND = 5
+MAX_RETRIES = 5
+RETRY_BACKOFF = 1.0
+
+
+def _require_credentials():
+    if not TOKEN or not ORG_ID:
+        raise ValueError("Необходимо задать YANDEX_TRACKER_TOKEN и YA_TRACKER_ORG_ID в .env файле")
+
+
+def get_client():
+    """
+    Возвращает клиент Yandex Tracker, создавая его при первом вызове.
+
+    Raises:
+        ValueError: Если не заданы YANDEX_TRACKER_TOKEN и YA_TRACKER_ORG_ID.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _require_credentials()
+            from yandex_tracker_client import TrackerClient
+            _client = TrackerClient(token=TOKEN, org_id=ORG_ID)
+        return _client
+
+
+def _issue_to_record(issue):
+    """
+    Извлекает из задачи Yandex Tracker только необходимые поля.
+    """
+    return {
+        'key': issue.key,
+        'summary': issue.summary,
+        'description': issue.description or '',  # Присваиваем пустую строку, если описание отсутствует
+        'updated': issue.updatedAt
+    }
+
+
+def _json_to_record(item):
+    """
+    Извлекает необходимые поля из задачи в ответе HTTP API.
+    """
+    return {
+        'key': item['key'],
+        'summary': item.get('summary'),
+        'description': item.get('description') or '',
+        'updated': item.get('updatedAt')
+    }
+
+
+class RateLimiter:
+    """
+    Ограничивает частоту запросов, общую для всех потоков.
+    """
+
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self._next_at = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start_at = max(now, self._next_at)
+            self._next_at = start_at + self.interval
+        if start_at > now:
+            time.sleep(start_at - now)
+
+
+class TrackerPager:
+    """
+    Постраничный поиск задач через HTTP API Yandex Tracker.
+
+    Каждая страница запрашивается отдельно, поэтому страницы можно загружать параллельно.
+    Запросы ограничены по частоте, а при сетевых ошибках, ответах 429 и 5xx страница
+    запрашивается повторно с экспоненциально растущей паузой.
+    """
+
+    def __init__(self, token, org_id, base_url=API_URL, per_page=PER_PAGE, requests_per_second=REQUESTS_PER_SECOND,
+                 max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.per_page = per_page
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.session = requests.Session()
+        self.session.headers.update({'Authorization': f'OAuth {token}', 'X-Org-Id': str(org_id)})
+
+    def fetch_page(self, query, page):
+        """
+        Загружает одну страницу результатов поиска.
+
+        :param query: Запрос на языке запросов Yandex Tracker.
+        :param page: Номер страницы, начиная с 1.
+        :return: Кортеж (список записей задач, общее количество страниц).
+        """
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            with metrics.span('tracker.rate_limit_wait'):
+                self.rate_limiter.wait()
+            try:
+                with metrics.span('tracker.request'):
+                    response = self.session.post(
+                        f"{self.base_url}/v2/issues/_search",
+                        params={'perPage': self.per_page, 'page': page},
+                        json={'query': query},
+                        timeout=self.timeout,
+                    )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                if response.status_code != 429 and response.status_code < 500:
+                    response.raise_for_status()
+                    total_pages = int(response.headers.get('X-Total-Pages', 1))
+                    return [_json_to_record(item) for item in response.json()], total_pages
+                error = requests.HTTPError(f"HTTP {response.status_code}", response=response)
+                retry_after = response.headers.get('Retry-After')
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+
+            if attempt == self.max_retries:
+                raise error
+            metrics.increment('tracker.retries')
+            logging.warning(f"Ошибка загрузки страницы {page} ({query}): {error}. Повтор через {delay:.1f} с.")
+            time.sleep(delay)
+            delay *= 2
+
+
+def get_fetch_queries():
+    """
+    Возвращает запросы полной загрузки: по одному на каждую пару очередь-статус,
+    чтобы страницы разных запросов загружались параллельно и каждая выборка была небольшой.
+    """
+    return [f'Queue: {queue} Status: {status} "Sort by": Key ASC' for queue in QUEUES for status in STATUSES]
+
+
+@metrics.timed('tracker.get_issues')
+def get_issues(store, pager=None, workers=FETCH_WORKERS):
+    """
+    Загружает все задачи из отслеживаемых очередей и статусов в хранилище.
+
+    Страницы загружаются параллельно и сразу сохраняются в промежуточные таблицы хранилища,
+    поэтому в памяти одновременно находится лишь несколько страниц. Когда загружены все
+    страницы, задачи в хранилище заменяются одной транзакцией. Если загрузка прервалась,
+    следующий вызов загружает только недостающие страницы.
+
+    Args:
+        store (IssueStore): Хранилище задач.
+        pager (TrackerPager): Клиент постраничного поиска. По умолчанию создается из настроек .env.
+        workers (int): Количество одновременно загружаемых страниц.
+
+    Returns:
+        int: Количество задач в хранилище.
     """
-    Выполняет запрос к API Yandex Tracker для получения задач.
+    # pandas импортируется только при загрузке задач: боту и поиску по готовому индексу он не нужен
+    import pandas as pd
 
-    Фильтр запроса жестко задан для получения задач из определенных очередей
-    и с определенными статусами.
+    if pager is None:
+        _require_credentials()
+        pager = TrackerPager(TOKEN, ORG_ID)
+    queries = get_fetch_queries()
+    staged = store.get_staged_pages(f"{pager.per_page}:{'|'.join(queries)}")
+    if staged:
+        print(f"Продолжение прерванной загрузки: уже загружено страниц {len(staged)}.", file=sys.stderr)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        def submit_remaining(query, total_pages):
+            for page in range(1, total_pages + 1):
+                if (query, page) not in staged:
+                    pending[executor.submit(pager.fetch_page, query, page)] = (query, page)
+
+        for query in queries:
+            total_pages = next((total for (staged_query, _), total in staged.items() if staged_query == query), None)
+            if total_pages is None:
+                pending[executor.submit(pager.fetch_page, query, 1)] = (query, 1)
+            else:
+                submit_remaining(query, total_pages)
+
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    query, page = pending.pop(future)
+                    records, total_pages = future.result()
+                    with metrics.span('tracker.stage_page'):
+                        store.stage_page(query, page, total_pages, pd.DataFrame(records, columns=ISSUE_COLUMNS))
+                    metrics.increment('tracker.pages')
+                    staged[(query, page)] = total_pages
+                    if page == 1:
+                        submit_remaining(query, total_pages)
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+
+    with metrics.span('tracker.commit'):
+        count = store.commit_staged()
+    metrics.increment('tracker.issues', count)
+    print(f"Загружено {count} задач из Yandex Tracker.", file=sys.stderr)
+    return count
+
+
+def get_last_updated(issues_df):
+    """
+    Возвращает время последнего изменения задач в кэше (водяной знак синхронизации).
+
+    Returns:
+        pd.Timestamp | None: Время в UTC или None, если в кэше нет сведений об изменениях.
+    """
+    import pandas as pd
+
+    if issues_df.empty or 'updated' not in issues_df.columns:
+        return None
+    updated = pd.to_datetime(issues_df['updated'], utc=True, errors='coerce', format='ISO8601')
+    if updated.isna().all():
+        return None
+    return updated.max()
+
+
+@metrics.timed('tracker.sync_changes')
+def get_changed_issues(since):
+    """
+    Запрашивает задачи из отслеживаемых очередей, измененные начиная с указанного времени.
+
+    Статус в запросе не фильтруется, чтобы узнать о задачах, покинувших отслеживаемые статусы.
+
+    Args:
+        since (pd.Timestamp): Время в UTC, начиная с которого нужны изменения.
 
     Returns:
-        pd.DataFrame: DataFrame с задачами, содержащий поля 'key', 'summary' и 'description'.
-    """
-    # Фильтр для получения задач
-    query = (
-        "Queue: PLATFORM, PLATFORMCOMP, PLATFORMUI, PLATFORMBPMN, PLATFORMNSI "
-        "Status: inProgress, open, readyForTest, tested, testing, vozvrasena, needInfo"
-    )
-    
-    # Выполняем запрос к API
-    issues_from_tracker = client.issues.find(query=query)
-    
-    # Извлекаем только необходимые поля
-    issues_data = []
-    for issue in issues_from_tracker:
-        issues_data.append({
-            'key': issue.key,
-            'summary': issue.summary,
-            'description': issue.description or ''  # Присваиваем пустую строку, если описание отсутствует
-        })
-    
-    print(f"Загружено {len(issues_data)} задач из Yandex Tracker.")
-    
-    # Возвращаем данные в виде DataFrame
-    return pd.DataFrame(issues_data)
-
-def load_or_fetch_issues(cache_file='issues.json', cache_hours=1):
+        tuple: (DataFrame с измененными задачами в отслеживаемых статусах,
+                список ключей задач, вышедших из отслеживаемых статусов).
+    """
+    import pandas as pd
+
+    since_str = (since - SYNC_OVERLAP).strftime('%Y-%m-%d %H:%M:%S')
+    query = f'Queue: {", ".join(QUEUES)} Updated: >= "{since_str}"'
+
+    changed, removed_keys = [], []
+    for issue in get_client().issues.find(query=query):
+        if issue.status.key in STATUSES:
+            changed.append(_issue_to_record(issue))
+        else:
+            removed_keys.append(issue.key)
+
+    print(f"Изменено задач: {len(changed)}, вышло из отслеживаемых статусов: {len(removed_keys)}.", file=sys.stderr)
+    return pd.DataFrame(changed, columns=ISSUE_COLUMNS), removed_keys
+
+
+def refresh_store(store, full=False):
+    """
+    Обновляет хранилище задач данными из Yandex Tracker.
+
+    Если известно время последнего изменения задач, загружаются только изменения,
+    иначе (или при full=True) все задачи загружаются заново.
+
+    Args:
+        store (IssueStore): Хранилище задач.
+        full (bool): Загрузить все задачи заново.
+    """
+    import pandas as pd
+
+    last_updated = None if full else store.get_meta('last_updated')
+    if last_updated is None:
+        get_issues(store)
+        return
+
+    last_updated = pd.Timestamp(last_updated)
+    changed_df, removed_keys = get_changed_issues(last_updated)
+    changed_last_updated = get_last_updated(changed_df)
+    if changed_last_updated is not None:
+        last_updated = max(last_updated, changed_last_updated)
+    store.apply_changes(changed_df, removed_keys, last_updated=last_updated.isoformat())
+
+
+def load_or_fetch_issues(cache_file='issues.db', cache_hours=1):
     """
     Загружает задачи из кэша или выполняет новый запрос, если кэш устарел.
 
     Args:
-        cache_file (str): Путь к файлу кэша.
+        cache_file (str): Путь к файлу хранилища задач.
         cache_hours (int): Время жизни кэша в часах.
 
     Returns:
-        pd.DataFrame: DataFrame с актуальными задачами.
-    """
-    # Проверяем, существует ли файл кэша и актуален ли он
-    if os.path.exists(cache_file):
-        file_mod_time = datetime.fromtimestamp(os.path.getmtime(cache_file))
-        if datetime.now() - file_mod_time < timedelta(hours=cache_hours):
-            print(f"Загрузка задач из кэша '{cache_file}'.")
-            return pd.read_json(cache_file)
-
-    # Если кэш устарел или не существует, получаем свежие данные
-    print("Кэш не найден или устарел. Загрузка свежих задач...")
-    issues_df = get_issues()
-    
-    # Сохраняем свежие данные в кэш
-    issues_df.to_json(cache_file, orient='records', force_ascii=False, indent=4)
-    print(f"Задачи сохранены в кэш '{cache_file}'.")
-    
-    return issues_df
-
-def force_fetch_issues(cache_file='issues.json'):
+        Corpus: Компактный корпус с актуальными задачами.
+    """
+    store = IssueStore(cache_file)
+
+    # Проверяем, заполнено ли хранилище и актуально ли оно
+    refreshed_at = store.get_refreshed_at()
+    if refreshed_at is not None and datetime.now() - refreshed_at < timedelta(hours=cache_hours):
+        print(f"Загрузка задач из кэша '{cache_file}'.", file=sys.stderr)
+        return store.read_corpus()
+
+    # Если кэш устарел, догружаем изменения, а если его нет - получаем все задачи
+    print("Кэш не найден или устарел. Загрузка свежих задач...", file=sys.stderr)
+    refresh_store(store)
+    print(f"Задачи сохранены в кэш '{cache_file}'.", file=sys.stderr)
+
+    return store.read_corpus()
+
+def force_fetch_issues(cache_file='issues.db', full=False):
     """
     Принудительно загружает свежие задачи и обновляет кэш.
+
+    Args:
+        cache_file (str): Путь к файлу хранилища задач.
+        full (bool): Загрузить все задачи заново вместо загрузки изменений.
+
+    Returns:
+        Corpus: Компактный корпус с актуальными задачами.
     """
-    print("Принудительная загрузка свежих задач...")
-    issues_df = get_issues()
-    issues_df.to_json(cache_file, orient='records', force_ascii=False, indent=4)
-    print(f"Кэш '{cache_file}' принудительно обновлен.")
-    return issues_df
+    print("Принудительная загрузка свежих задач...", file=sys.stderr)
+    store = IssueStore(cache_file)
+    refresh_store(store, full=full)
+    print(f"Кэш '{cache_file}' принудительно обновлен.", file=sys.stderr)
+    return store.read_corpus()
 
 if __name__ == '__main__':
     # Пример использования:
-    # При первом запуске данные будут загружены из API и сохранены в issues.json.
+    # При первом запуске данные будут загружены из API и сохранены в issues.db.
     # При последующих запусках в течение часа данные будут загружаться из файла.
     issues = load_or_fetch_issues()
     print("\nПример полученных данных:")
-    print(issues.head())
+    for key, summary in zip(issues.keys[:5], issues.summaries[:5]):
+        print(f"{key}: {summary}")
 
-def get_cache_update_time(cache_file='issues.json'):
+def get_cache_update_time(cache_file='issues.db'):
     """
     Возвращает время последнего обновления кэша.
     """
-    if os.path.exists(cache_file):
-        mod_time = datetime.fromtimestamp(os.path.getmtime(cache_file))
-        return mod_time.strftime('%Y-%m-%d %H:%M:%S')
+    refreshed_at = IssueStore(cache_file).get_refreshed_at()
+    if refreshed_at is not None:
+        return refreshed_at.strftime('%Y-%m-%d %H:%M:%S')
     return "Кэш еще не создан."
 
-def get_issues_count_from_cache(cache_file='issues.json'):
+def get_issues_count_from_cache(cache_file='issues.db'):
     """
     Возвращает количество задач в кэше.
     """
-    if os.path.exists(cache_file):
-        try:
-            df = pd.read_json(cache_file)
-            return len(df)
-        except Exception:
-            return 0
-    return 0
+    try:
+        return IssueStore(cache_file).count()
+    except Exception:
+        return 0